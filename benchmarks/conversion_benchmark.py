@@ -0,0 +1,207 @@
+"""Throughput benchmark of the convert_data_to_tfrecord.py scripts of both pipelines.
+
+Generates a synthetic dataset of configurable size and resolution, then runs the converter for
+every combination of worker count, shard count, compression and record format and reports
+images/s, input MB/s, the peak RSS of the largest converter process and the output bytes.
+
+Usage:
+    python3 benchmarks/conversion_benchmark.py --pipeline classification --num_images 600 \\
+        --num_workers 1,4 --num_shards 8,32 --compression none,GZIP,ZLIB --record_formats encoded,raw \\
+        --output_file conversion_benchmark.json
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DAGS_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), "dags")
+
+CLASSIFICATION_CLASSES = ["buildings", "forest", "glacier", "mountain", "sea", "street"]
+SEGMENTATION_CLASSES = 12
+
+
+def synthetic_image(rng, height, width):
+    """Returns a smoothed random uint8 image, which compresses roughly like a photo."""
+    return cv2.GaussianBlur(rng.randint(0, 256, (height, width, 3), dtype=np.uint8), (0, 0), 3)
+
+
+def synthetic_mask(rng, height, width):
+    """Returns a 3 channel mask of rectangular class regions like the prepped CamVid annotations."""
+    block = 40
+    classes = rng.randint(0, SEGMENTATION_CLASSES, (height // block + 1, width // block + 1), dtype=np.uint8)
+    mask = np.kron(classes, np.ones((block, block), dtype=np.uint8))[:height, :width]
+    return np.repeat(mask[:, :, np.newaxis], 3, axis=2)
+
+
+def make_classification_dataset(root, num_images, height, width, seed=0):
+    """Writes num_images JPEGs spread evenly over the class directories.
+
+    Returns:
+        Tuple of (list of converter arguments, number of input bytes)
+    """
+    rng = np.random.RandomState(seed)
+    train_dir = os.path.join(root, "seg_train")
+    for num in range(num_images):
+        class_dir = os.path.join(train_dir, CLASSIFICATION_CLASSES[num % len(CLASSIFICATION_CLASSES)])
+        os.makedirs(class_dir, exist_ok=True)
+        cv2.imwrite(os.path.join(class_dir, "{:06d}.jpg".format(num)), synthetic_image(rng, height, width))
+    return ["--train_dir", train_dir], directory_size(train_dir)
+
+
+def make_segmentation_dataset(root, num_images, height, width, seed=0):
+    """Writes num_images PNG image and mask pairs, a fifth of them into the test split.
+
+    Returns:
+        Tuple of (list of converter arguments, number of input bytes)
+    """
+    rng = np.random.RandomState(seed)
+    for num in range(num_images):
+        split = "test" if num % 5 == 0 else "train"
+        for kind, array in [("images", synthetic_image(rng, height, width)), ("annotations", synthetic_mask(rng, height, width))]:
+            split_dir = os.path.join(root, "{}_prepped_{}".format(kind, split))
+            os.makedirs(split_dir, exist_ok=True)
+            cv2.imwrite(os.path.join(split_dir, "{:06d}.png".format(num)), array)
+    return ["--data_dir", root], directory_size(root)
+
+
+DATASETS = {
+    "classification": make_classification_dataset,
+    "segmentation": make_segmentation_dataset,
+}
+
+
+def directory_size(directory):
+    """Returns the summed size in bytes of all files below directory."""
+    return sum(
+        os.path.getsize(os.path.join(dirpath, filename))
+        for dirpath, _, filenames in os.walk(directory) for filename in filenames
+    )
+
+
+def record_size(tfrecords_dir):
+    """Returns the summed size in bytes of all TFRecord shards below tfrecords_dir."""
+    return sum(
+        os.path.getsize(os.path.join(dirpath, filename))
+        for dirpath, _, filenames in os.walk(tfrecords_dir) for filename in filenames
+        if ".tfrecords" in filename
+    )
+
+
+def run_converter(pipeline, converter_args):
+    """Runs the converter of a pipeline in its own directory.
+
+    Returns:
+        Tuple of (duration in seconds, peak RSS in bytes of the largest converter process)
+    """
+    command = [sys.executable, "convert_data_to_tfrecord.py"] + converter_args
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        command, cwd=os.path.join(DAGS_DIR, "{}_pipeline".format(pipeline)), stdout=subprocess.DEVNULL)
+    # The rusage of wait4 includes the waited for worker processes of the converter,
+    # ru_maxrss is the maximum over all of them and reported in KiB on Linux
+    _, status, rusage = os.wait4(process.pid, 0)
+    duration = time.perf_counter() - start
+    # A converter killed by a signal, e.g. by the OOM killer, has no exit status
+    if os.WIFSIGNALED(status):
+        raise RuntimeError("Converter killed by signal {}: {}".format(os.WTERMSIG(status), " ".join(command)))
+    if not os.WIFEXITED(status) or os.WEXITSTATUS(status) != 0:
+        raise RuntimeError("Converter failed: {}".format(" ".join(command)))
+    return duration, rusage.ru_maxrss * 1024
+
+
+def parse_list(value, cast=str):
+    """Parses a comma separated command line value."""
+    return [cast(item) for item in value.split(",") if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pipeline", choices=sorted(DATASETS), default="classification")
+    parser.add_argument("--num_images", type=int, default=600)
+    parser.add_argument("--height", type=int, default=None, help="Height of the synthetic images, default depends on the pipeline")
+    parser.add_argument("--width", type=int, default=None, help="Width of the synthetic images, default depends on the pipeline")
+    parser.add_argument("--num_workers", default="1,0", help="Comma separated worker counts, 0 uses all cpus")
+    parser.add_argument("--num_shards", default="8,32", help="Comma separated shard counts")
+    parser.add_argument("--compression", default="none,GZIP,ZLIB", help="Comma separated compression types")
+    parser.add_argument("--record_formats", default="encoded,raw", help="Comma separated record formats")
+    parser.add_argument("--repeats", type=int, default=1, help="Runs per configuration, the fastest run is reported")
+    parser.add_argument("--output_file", default="conversion_benchmark.json", help="JSON file the results are written to")
+    args = parser.parse_args()
+
+    default_shape = (150, 150) if args.pipeline == "classification" else (360, 480)
+    height, width = args.height or default_shape[0], args.width or default_shape[1]
+    configurations = list(itertools.product(
+        parse_list(args.num_workers, int), parse_list(args.num_shards, int),
+        parse_list(args.compression), parse_list(args.record_formats)))
+
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="conversion_benchmark_")
+    try:
+        data_dir = os.path.join(work_dir, "data")
+        dataset_args, input_bytes = DATASETS[args.pipeline](data_dir, args.num_images, height, width)
+        print("Generated {} synthetic images of {}x{} ({:.1f} MB)".format(args.num_images, height, width, input_bytes / 1e6))
+
+        for num_workers, num_shards, compression, record_format in configurations:
+            tfrecords_dir = os.path.join(work_dir, "tfrecords")
+            converter_args = dataset_args + [
+                "--tfrecords_dir", tfrecords_dir,
+                "--height", str(height),
+                "--width", str(width),
+                "--num_workers", str(num_workers),
+                "--num_shards", str(num_shards),
+                "--compression", compression,
+                "--record_format", record_format,
+            ]
+            runs = []
+            for repeat in range(args.repeats):
+                shutil.rmtree(tfrecords_dir, ignore_errors=True)
+                runs.append(run_converter(args.pipeline, converter_args))
+            duration, peak_rss = min(runs)
+
+            result = {
+                "pipeline": args.pipeline,
+                "num_images": args.num_images,
+                "height": height,
+                "width": width,
+                "num_workers": num_workers or os.cpu_count(),
+                "num_shards": num_shards,
+                "compression": compression,
+                "record_format": record_format,
+                "seconds": duration,
+                "images_per_second": args.num_images / duration,
+                "input_mb_per_second": input_bytes / 1e6 / duration,
+                "peak_rss_bytes": peak_rss,
+                "output_bytes": record_size(tfrecords_dir),
+            }
+            results.append(result)
+            print("workers {num_workers:>3} shards {num_shards:>4} {compression:<5} {record_format:<8} "
+                  "{images_per_second:8.1f} images/s {input_mb_per_second:7.2f} MB/s "
+                  "peak RSS {peak_mb:8.1f} MB output {output_mb:8.2f} MB".format(
+                      peak_mb=result["peak_rss_bytes"] / 1e6, output_mb=result["output_bytes"] / 1e6, **result))
+    finally:
+        shutil.rmtree(work_dir)
+
+    with open(args.output_file, "w") as f:
+        json.dump({
+            "environment": {
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+            },
+            "results": results,
+        }, f, indent=2)
+    print("Results written to {}".format(args.output_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""Throughput benchmark of the data path of both pipelines on a CPU-only machine.
+
+Writes a synthetic TFRecord set in the RECORD_FORMAT (and MASK_FORMAT) of the "constants.py",
+runs the preprocessing_fn of the pipeline through tf.Transform with the Beam DirectRunner and then
+iterates _input_fn with is_train=False and is_train=True. Additionally every stage of the data path
+(decode, resize, standardize, one-hot, augmentation) is timed on its own on a single batch.
+Reports examples/s, ms per batch for every stage and the RSS high-water mark of the process after
+every phase. It is cumulative over all earlier phases and pipelines, not the peak of the phase itself.
+
+Usage:
+    python3 benchmarks/data_path_benchmark.py --pipelines classification,segmentation --num_examples 256
+"""
+import argparse
+import importlib
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+import tensorflow as tf
+
+from record_format_benchmark import DAGS_DIR
+from transformed_dtype_check import transform
+
+
+def rss_high_water_bytes():
+    """Returns the highest RSS of this process since its start, which includes the in-process Beam DirectRunner."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def import_pipeline(pipeline):
+    """Imports module.py and convert_data_to_tfrecord.py of a pipeline."""
+    sys.path.insert(0, DAGS_DIR)
+    module = importlib.import_module("{}_pipeline.module".format(pipeline))
+    converter = importlib.import_module("{}_pipeline.convert_data_to_tfrecord".format(pipeline))
+    return module, converter
+
+
+def encode(array, ext):
+    """Encodes a uint8 array to JPEG or PNG bytes."""
+    return cv2.imencode(ext, array)[1].tobytes()
+
+
+def synthetic_image(rng, constants):
+    """Returns the image feature of a synthetic record and the shape of raw records."""
+    if constants.RECORD_FORMAT == "raw":
+        shape = (constants.HEIGHT, constants.WIDTH, 3)
+    else:
+        shape = (constants.RECORD_HEIGHT, constants.RECORD_WIDTH, 3)
+    noise = rng.randint(0, 256, (shape[0] // 8, shape[1] // 8, 3)).astype(np.uint8)
+    image = cv2.resize(noise, (shape[1], shape[0]))
+    if constants.RECORD_FORMAT == "raw":
+        return cv2.cvtColor(image, cv2.COLOR_BGR2RGB).tobytes(), shape
+    return image, None
+
+
+def synthetic_example(pipeline, converter, constants, rng):
+    """Returns a tf.Example like the converter of the pipeline writes it."""
+    image, image_shape = synthetic_image(rng, constants)
+    ext = ".jpg" if pipeline == "classification" else ".png"
+    image_string = image if image_shape else encode(image, ext)
+    if pipeline == "classification":
+        return converter.image_example(image_string, int(rng.randint(0, len(constants.CLASS_NAMES))), image_shape)
+
+    if constants.MASK_FORMAT == "class_index":
+        mask = rng.randint(0, constants.N_MODEL_CLASSES, (constants.HEIGHT // 40 + 1, constants.WIDTH // 40 + 1)).astype(np.uint8)
+        mask = cv2.resize(mask, (constants.WIDTH, constants.HEIGHT), interpolation=cv2.INTER_NEAREST)
+        mask_shape = (constants.HEIGHT, constants.WIDTH, 1)
+    else:
+        height, width = (constants.HEIGHT, constants.WIDTH) if image_shape else (constants.RECORD_HEIGHT, constants.RECORD_WIDTH)
+        mask = rng.randint(0, constants.N_TOTAL_CLASSES, (height // 40 + 1, width // 40 + 1)).astype(np.uint8)
+        mask = np.repeat(cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)[:, :, np.newaxis], 3, axis=2)
+        mask_shape = mask.shape
+    if image_shape:
+        return converter.image_example(image_string, mask.tobytes(), image_shape, mask_shape)
+    return converter.image_example(image_string, encode(mask, ".png"))
+
+
+def write_records(pipeline, converter, constants, record_dir, num_examples, num_shards=4, seed=0):
+    """Writes num_examples synthetic records into num_shards uncompressed shards.
+
+    Returns:
+        File pattern of the shards
+    """
+    rng = np.random.RandomState(seed)
+    os.makedirs(record_dir)
+    writers = [
+        tf.io.TFRecordWriter(os.path.join(record_dir, converter.shard_filename("train", shard, num_shards)))
+        for shard in range(num_shards)
+    ]
+    for num in range(num_examples):
+        writers[num % num_shards].write(synthetic_example(pipeline, converter, constants, rng).SerializeToString())
+    for writer in writers:
+        writer.close()
+    return os.path.join(record_dir, "*")
+
+
+def time_call(fn, iterations, *args):
+    """Runs fn once to trace it and returns the mean milliseconds of the following iterations."""
+    tf.nest.map_structure(lambda t: t.numpy() if hasattr(t, "numpy") else t, fn(*args))
+    start = time.perf_counter()
+    for _ in range(iterations):
+        tf.nest.map_structure(lambda t: t.numpy() if hasattr(t, "numpy") else t, fn(*args))
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+def stage_times(pipeline, module, batch_size, iterations, seed=0):
+    """Times every stage of the data path on a batch of synthetic images.
+
+    Returns:
+        Dict mapping the stage name to the milliseconds per batch
+    """
+    constants = module.constants
+    rng = np.random.RandomState(seed)
+    ext = ".jpg" if pipeline == "classification" else ".png"
+    image_key = module._transformed_name(constants.IMAGE_KEY)
+
+    images = [synthetic_image(rng, constants)[0] for _ in range(batch_size)]
+    if constants.RECORD_FORMAT == "raw":
+        raw_images = tf.reshape(tf.constant(images), [batch_size, 1])
+        decode = tf.function(lambda x: tf.reshape(
+            tf.io.decode_raw(x, tf.uint8), [-1, constants.HEIGHT, constants.WIDTH, 3]))
+    else:
+        raw_images = tf.reshape(tf.constant([encode(image, ext) for image in images]), [batch_size, 1])
+        decode = tf.function(lambda x: module._decode_images(x, 3, constants.RECORD_HEIGHT, constants.RECORD_WIDTH))
+
+    decoded = decode(raw_images)
+    resize = tf.function(lambda x: tf.image.resize(x, [constants.HEIGHT, constants.WIDTH]))
+    resized = resize(decoded)
+    standardize = tf.function(module._normalize_images)
+    standardized = standardize(resized)
+
+    times = {
+        "decode": time_call(decode, iterations, raw_images),
+        "resize": time_call(resize, iterations, decoded),
+        "standardize": time_call(standardize, iterations, resized),
+    }
+    if pipeline == "classification":
+        augment = tf.function(lambda x: module._data_augmentation({image_key: x}))
+        times["augmentation"] = time_call(augment, iterations, standardized)
+    else:
+        mask = tf.constant(rng.randint(0, constants.N_MODEL_CLASSES, (batch_size, constants.HEIGHT, constants.WIDTH)), tf.int64)
+        one_hot = tf.function(module._one_hot_mask)
+        times["one_hot"] = time_call(one_hot, iterations, mask)
+        augment = tf.function(lambda x, y: module._data_augmentation({image_key: x}, y, tf.constant([seed, 0], tf.int64)))
+        times["augmentation"] = time_call(augment, iterations, standardized, one_hot(mask))
+    return times
+
+
+def iterate_input_fn(module, transform_dir, batch_size, num_batches, is_train):
+    """Iterates num_batches batches of _input_fn over the transformed examples and returns the examples/s."""
+    import tensorflow_transform as tft
+
+    tf_transform_output = tft.TFTransformOutput(transform_dir)
+    file_pattern = [os.path.join(transform_dir, "transformed", "*.gz")]
+    dataset = module._input_fn(file_pattern, tf_transform_output, batch_size, is_train=is_train).repeat()
+    iterator = iter(dataset)
+    next(iterator)
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        next(iterator)
+    return num_batches * batch_size / (time.perf_counter() - start)
+
+
+def benchmark_pipeline(pipeline, args, work_dir):
+    """Runs all phases of the benchmark for one pipeline and returns its results."""
+    module, converter = import_pipeline(pipeline)
+    constants = module.constants
+    # The benchmark needs the transformed examples on disk
+    constants.MATERIALIZE_TRANSFORMED = True
+    constants.INPUT_PIPELINE_PROFILE = args.input_pipeline_profile
+    pipeline_dir = os.path.join(work_dir, pipeline)
+    result = {
+        "pipeline": pipeline,
+        "num_examples": args.num_examples,
+        "batch_size": args.batch_size,
+        "record_format": constants.RECORD_FORMAT,
+        "transformed_image_dtype": constants.TRANSFORMED_IMAGE_DTYPE,
+        "input_pipeline_profile": constants.INPUT_PIPELINE_PROFILE,
+    }
+
+    record_pattern = write_records(pipeline, converter, constants, os.path.join(pipeline_dir, "records"), args.num_examples)
+
+    start = time.perf_counter()
+    transform(pipeline, module, record_pattern, os.path.join(pipeline_dir, "transform"))
+    result["transform_examples_per_second"] = args.num_examples / (time.perf_counter() - start)
+    result["transform_rss_high_water_bytes"] = rss_high_water_bytes()
+
+    result["stage_ms_per_batch"] = stage_times(pipeline, module, args.batch_size, args.iterations)
+    result["stages_rss_high_water_bytes"] = rss_high_water_bytes()
+
+    for is_train in [False, True]:
+        key = "input_fn_{}".format("train" if is_train else "eval")
+        result[key + "_examples_per_second"] = iterate_input_fn(
+            module, os.path.join(pipeline_dir, "transform"), args.batch_size, args.num_batches, is_train)
+        result[key + "_rss_high_water_bytes"] = rss_high_water_bytes()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pipelines", default="classification,segmentation", help="Comma separated pipelines")
+    parser.add_argument("--num_examples", type=int, default=256, help="Number of synthetic records")
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--num_batches", type=int, default=20, help="Number of _input_fn batches per measurement")
+    parser.add_argument("--iterations", type=int, default=10, help="Number of runs per stage measurement")
+    parser.add_argument("--input_pipeline_profile", default="default", help="INPUT_PIPELINE_PROFILE of _input_fn, e.g. throughput")
+    parser.add_argument("--output_file", help="Optional JSON file the results are written to")
+    args = parser.parse_args()
+
+    # Comparable numbers on every machine, GPUs would only speed up some of the stages
+    tf.config.set_visible_devices([], "GPU")
+
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="data_path_benchmark_")
+    try:
+        for pipeline in args.pipelines.split(","):
+            result = benchmark_pipeline(pipeline, args, work_dir)
+            results.append(result)
+            print("{} ({} records, {} transformed images, {} input pipeline)".format(
+                pipeline, result["record_format"], result["transformed_image_dtype"], result["input_pipeline_profile"]))
+            print("  Transform        {:10.1f} examples/s  max RSS so far {:8.1f} MB".format(
+                result["transform_examples_per_second"], result["transform_rss_high_water_bytes"] / 1e6))
+            for stage, ms in result["stage_ms_per_batch"].items():
+                print("  {:<16} {:10.2f} ms/batch".format(stage, ms))
+            for split in ["eval", "train"]:
+                print("  _input_fn {:<6} {:10.1f} examples/s  max RSS so far {:8.1f} MB".format(
+                    split, result["input_fn_{}_examples_per_second".format(split)],
+                    result["input_fn_{}_rss_high_water_bytes".format(split)] / 1e6))
+    finally:
+        shutil.rmtree(work_dir)
+
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
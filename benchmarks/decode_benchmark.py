@@ -0,0 +1,101 @@
+"""Microbenchmark of the image decode of the preprocessing_fn of both pipelines.
+
+Compares the former tf.map_fn decode (default parallel_iterations, unknown output shape) with the
+parallel fixed-shape _decode_images of the pipeline module, both followed by the resize to
+(HEIGHT, WIDTH), at several Transform batch sizes.
+
+Usage:
+    python3 benchmarks/decode_benchmark.py --pipeline segmentation --batch_sizes 8,32,128
+"""
+import argparse
+import importlib
+import json
+import os
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DAGS_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), "dags")
+
+ENCODINGS = {
+    "classification": (tf.io.encode_jpeg, tf.io.decode_jpeg),
+    "segmentation": (tf.io.encode_png, tf.io.decode_png),
+}
+
+
+def import_module(pipeline):
+    """Imports the module.py of a pipeline."""
+    sys.path.insert(0, DAGS_DIR)
+    return importlib.import_module("{}_pipeline.module".format(pipeline))
+
+
+def make_encoded_batch(encode_fn, batch_size, height, width, seed=0):
+    """Returns a string tensor of shape [batch_size, 1] of encoded smooth random images, as Transform feeds them."""
+    rng = np.random.RandomState(seed)
+    images = []
+    for _ in range(batch_size):
+        noise = rng.randint(0, 256, (height // 8, width // 8, 3)).astype(np.float32)
+        image = tf.cast(tf.image.resize(noise[np.newaxis], [height, width])[0], tf.uint8)
+        images.append(encode_fn(image))
+    return tf.reshape(tf.stack(images), [batch_size, 1])
+
+
+def time_fn(fn, encoded_batch, iterations):
+    """Runs fn once to trace it and returns the images/s over the following iterations."""
+    fn(encoded_batch)
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn(encoded_batch).numpy()
+    return iterations * int(encoded_batch.shape[0]) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pipeline", choices=sorted(ENCODINGS), default="classification")
+    parser.add_argument("--batch_sizes", default="8,32,128", help="Comma separated Transform batch sizes")
+    parser.add_argument("--iterations", type=int, default=10)
+    parser.add_argument("--output_file", help="Optional JSON file the results are written to")
+    args = parser.parse_args()
+
+    module = import_module(args.pipeline)
+    constants = module.constants
+    encode_fn, decode_fn = ENCODINGS[args.pipeline]
+    output_size = [constants.HEIGHT, constants.WIDTH]
+
+    @tf.function
+    def legacy_decode(encoded_images):
+        # The former decode of preprocessing_fn
+        images = tf.map_fn(lambda x: decode_fn(x[0], channels=3), encoded_images, dtype=tf.uint8)
+        return tf.image.resize(images, output_size)
+
+    @tf.function
+    def parallel_decode(encoded_images):
+        images = module._decode_images(encoded_images, 3, constants.RECORD_HEIGHT, constants.RECORD_WIDTH)
+        return tf.image.resize(images, output_size)
+
+    results = []
+    print("{:>10} {:>22} {:>22} {:>8}".format("batch", "map_fn [images/s]", "parallel [images/s]", "speedup"))
+    for batch_size in [int(size) for size in args.batch_sizes.split(",")]:
+        encoded_batch = make_encoded_batch(encode_fn, batch_size, constants.RECORD_HEIGHT, constants.RECORD_WIDTH)
+        result = {
+            "pipeline": args.pipeline,
+            "batch_size": batch_size,
+            "parallel_iterations": constants.DECODE_PARALLEL_ITERATIONS,
+            "legacy_images_per_second": time_fn(legacy_decode, encoded_batch, args.iterations),
+            "parallel_images_per_second": time_fn(parallel_decode, encoded_batch, args.iterations),
+        }
+        results.append(result)
+        print("{:>10} {:>22.1f} {:>22.1f} {:>7.2f}x".format(
+            batch_size, result["legacy_images_per_second"], result["parallel_images_per_second"],
+            result["parallel_images_per_second"] / result["legacy_images_per_second"]))
+
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Scaling benchmark of multi-worker CPU training of both pipelines on localhost.
+
+Writes and transforms a synthetic TFRecord set like data_path_benchmark.py, then runs the run_fn of the
+pipeline in 1, 2, ... local worker processes, each with MULTI_WORKER_TRAINING and the TF_CONFIG of its
+task. Every worker reads TRAIN_BATCH_SIZE examples per step of its shard, so the global batch grows with
+the number of workers. Reports the training examples/s of model.fit and the scaling efficiency.
+
+Usage:
+    python3 benchmarks/multi_worker_benchmark.py --pipeline classification --num_workers 1,2,4 --train_steps 20
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def free_ports(count):
+    """Returns count free TCP ports of localhost."""
+    sockets = [socket.socket() for _ in range(count)]
+    for sock in sockets:
+        sock.bind(("localhost", 0))
+    ports = [sock.getsockname()[1] for sock in sockets]
+    for sock in sockets:
+        sock.close()
+    return ports
+
+
+def prepare_data(args, work_dir):
+    """Writes and transforms the synthetic records and returns the transform directory."""
+    from data_path_benchmark import import_pipeline, write_records
+    from transformed_dtype_check import transform
+
+    module, converter = import_pipeline(args.pipeline)
+    module.constants.MATERIALIZE_TRANSFORMED = True
+    record_pattern = write_records(
+        args.pipeline, converter, module.constants, os.path.join(work_dir, "records"), args.num_examples, num_shards=16)
+    transform_dir = os.path.join(work_dir, "transform")
+    transform(args.pipeline, module, record_pattern, transform_dir)
+    return transform_dir
+
+
+def run_workers(args, transform_dir, num_workers, work_dir):
+    """Runs run_fn in num_workers local processes and returns the longest model.fit duration in seconds."""
+    cluster = {"worker": ["localhost:{}".format(port) for port in free_ports(num_workers)]}
+    processes = []
+    for index in range(num_workers):
+        env = dict(os.environ, CUDA_VISIBLE_DEVICES="", TF_CONFIG=json.dumps({
+            "cluster": cluster,
+            "task": {"type": "worker", "index": index},
+        }))
+        worker_args = {
+            "pipeline": args.pipeline,
+            "transform_dir": transform_dir,
+            "output_dir": os.path.join(work_dir, "workers_{}".format(num_workers)),
+            "train_steps": args.train_steps,
+            "weights": args.weights,
+            "result_file": os.path.join(work_dir, "result_{}_{}.json".format(num_workers, index)),
+        }
+        processes.append(subprocess.Popen([sys.executable, os.path.abspath(__file__), "--worker", json.dumps(worker_args)], env=env))
+
+    for process in processes:
+        if process.wait() != 0:
+            raise RuntimeError("A worker of the {} worker run failed".format(num_workers))
+
+    durations = []
+    for index in range(num_workers):
+        with open(os.path.join(work_dir, "result_{}_{}.json".format(num_workers, index))) as f:
+            durations.append(json.load(f)["fit_seconds"])
+    return max(durations)
+
+
+def run_worker(worker_args):
+    """Runs the run_fn of the pipeline in this worker process and writes the duration of model.fit."""
+    from data_path_benchmark import import_pipeline
+    import tensorflow as tf
+    from tfx.components.trainer.executor import TrainerFnArgs
+
+    module, _ = import_pipeline(worker_args["pipeline"])
+    constants = module.constants
+    constants.MULTI_WORKER_TRAINING = True
+    constants.MATERIALIZE_TRANSFORMED = True
+    constants.EPOCHS = 1
+    constants.TRAIN_STEPS = worker_args["train_steps"]
+    constants.EVAL_STEPS = 1
+    constants.PRETRAINED_WEIGHTS = None if worker_args["weights"] == "none" else worker_args["weights"]
+
+    # Only model.fit is timed, model creation and export do not scale with the workers
+    fit_seconds = []
+    fit = tf.keras.Model.fit
+
+    def timed_fit(model, *args, **kwargs):
+        start = time.perf_counter()
+        history = fit(model, *args, **kwargs)
+        fit_seconds.append(time.perf_counter() - start)
+        return history
+
+    tf.keras.Model.fit = timed_fit
+
+    file_pattern = [os.path.join(worker_args["transform_dir"], "transformed", "*.gz")]
+    module.run_fn(TrainerFnArgs(
+        train_files=file_pattern,
+        eval_files=file_pattern,
+        train_steps=worker_args["train_steps"],
+        eval_steps=1,
+        transform_output=worker_args["transform_dir"],
+        serving_model_dir=os.path.join(worker_args["output_dir"], "serving_model"),
+        model_run_dir=os.path.join(worker_args["output_dir"], "logs"),
+    ))
+
+    with open(worker_args["result_file"], "w") as f:
+        json.dump({"fit_seconds": sum(fit_seconds)}, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pipeline", choices=["classification", "segmentation"], default="classification")
+    parser.add_argument("--num_workers", default="1,2,4", help="Comma separated worker counts")
+    parser.add_argument("--num_examples", type=int, default=256, help="Number of synthetic records")
+    parser.add_argument("--train_steps", type=int, default=20, help="Training steps of every worker")
+    parser.add_argument("--weights", default="imagenet", help="PRETRAINED_WEIGHTS of the backbone, none for random weights")
+    parser.add_argument("--output_file", help="Optional JSON file the results are written to")
+    parser.add_argument("--worker", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(json.loads(args.worker))
+        return
+
+    from data_path_benchmark import import_pipeline
+    batch_size = import_pipeline(args.pipeline)[0].constants.TRAIN_BATCH_SIZE
+
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="multi_worker_benchmark_")
+    try:
+        transform_dir = prepare_data(args, work_dir)
+        for num_workers in [int(count) for count in args.num_workers.split(",")]:
+            seconds = run_workers(args, transform_dir, num_workers, work_dir)
+            result = {
+                "pipeline": args.pipeline,
+                "num_workers": num_workers,
+                "train_steps": args.train_steps,
+                "global_batch_size": batch_size * num_workers,
+                "fit_seconds": seconds,
+                "examples_per_second": args.train_steps * batch_size * num_workers / seconds,
+            }
+            # Examples/s relative to linear scaling of the first worker count
+            reference = results[0] if results else result
+            result["scaling_efficiency"] = (
+                result["examples_per_second"] * reference["num_workers"] / (reference["examples_per_second"] * num_workers))
+            results.append(result)
+            print("workers {num_workers:>3} global batch {global_batch_size:>4} {examples_per_second:10.1f} examples/s "
+                  "scaling efficiency {scaling_efficiency:6.2f}".format(**result))
+    finally:
+        shutil.rmtree(work_dir)
+
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
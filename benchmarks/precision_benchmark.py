@@ -0,0 +1,127 @@
+"""Benchmark of mixed bfloat16 precision and XLA compilation against float32 training on a CPU.
+
+Writes and transforms a synthetic TFRecord set like data_path_benchmark.py, then trains the pipeline
+model for the same number of steps from the same seed with every combination of MIXED_PRECISION_POLICY
+and XLA_COMPILE and evaluates it. Every configuration runs in its own process, since the mixed precision
+policy is global. Reports the step time, the examples/s and the difference of the evaluation metrics to
+the float32 path.
+
+Usage:
+    python3 benchmarks/precision_benchmark.py --pipeline classification --train_steps 50 --eval_steps 20
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from multi_worker_benchmark import prepare_data
+
+CONFIGURATIONS = [
+    {"policy": None, "xla": False},
+    {"policy": "mixed_bfloat16", "xla": False},
+    {"policy": None, "xla": True},
+    {"policy": "mixed_bfloat16", "xla": True},
+]
+
+
+def train_and_evaluate(config):
+    """Trains and evaluates the pipeline model with one configuration in this process."""
+    from data_path_benchmark import import_pipeline
+    import tensorflow as tf
+    import tensorflow_transform as tft
+
+    module, _ = import_pipeline(config["pipeline"])
+    from pipeline_common import trainer_utils
+    constants = module.constants
+    constants.MIXED_PRECISION_POLICY = config["policy"]
+    constants.XLA_COMPILE = config["xla"]
+    constants.MATERIALIZE_TRANSFORMED = True
+    # The segmentation _input_fn repeats the examples EPOCHS times, None repeats them indefinitely
+    constants.EPOCHS = None
+    constants.PRETRAINED_WEIGHTS = None if config["weights"] == "none" else config["weights"]
+    trainer_utils.set_mixed_precision_policy(constants.MIXED_PRECISION_POLICY)
+    tf.random.set_seed(config["seed"])
+
+    tf_transform_output = tft.TFTransformOutput(config["transform_dir"])
+    file_pattern = [os.path.join(config["transform_dir"], "transformed", "*.gz")]
+    train_dataset = module._input_fn(file_pattern, tf_transform_output, constants.TRAIN_BATCH_SIZE, is_train=True)
+    eval_dataset = module._input_fn(file_pattern, tf_transform_output, constants.EVAL_BATCH_SIZE, is_train=False)
+
+    model = module.get_model(None)
+    performance = trainer_utils.PerformanceCallback(train_dataset, constants.TRAIN_BATCH_SIZE, config["log_dir"], probe_steps=0)
+    model.fit(train_dataset, epochs=1, steps_per_epoch=config["train_steps"], callbacks=[performance], verbose=0)
+    metrics = model.evaluate(eval_dataset, steps=config["eval_steps"], return_dict=True, verbose=0)
+
+    summary = performance._summary()
+    with open(config["result_file"], "w") as f:
+        json.dump({
+            "policy": config["policy"] or "float32",
+            "xla": config["xla"],
+            "step_ms_p50": summary["step_ms_p50"],
+            "step_ms_mean": summary["step_ms_mean"],
+            "examples_per_second": summary["examples_per_second"],
+            "metrics": {name: float(value) for name, value in metrics.items()},
+        }, f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pipeline", choices=["classification", "segmentation"], default="classification")
+    parser.add_argument("--num_examples", type=int, default=256, help="Number of synthetic records")
+    parser.add_argument("--train_steps", type=int, default=50)
+    parser.add_argument("--eval_steps", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--weights", default="imagenet", help="PRETRAINED_WEIGHTS of the backbone, none for random weights")
+    parser.add_argument("--output_file", help="Optional JSON file the results are written to")
+    parser.add_argument("--config", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.config:
+        train_and_evaluate(json.loads(args.config))
+        return
+
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="precision_benchmark_")
+    try:
+        transform_dir = prepare_data(args, work_dir)
+        for num, configuration in enumerate(CONFIGURATIONS):
+            config = dict(
+                configuration,
+                pipeline=args.pipeline,
+                transform_dir=transform_dir,
+                train_steps=args.train_steps,
+                eval_steps=args.eval_steps,
+                seed=args.seed,
+                weights=args.weights,
+                log_dir=os.path.join(work_dir, "logs_{}".format(num)),
+                result_file=os.path.join(work_dir, "result_{}.json".format(num)),
+            )
+            subprocess.check_call(
+                [sys.executable, os.path.abspath(__file__), "--config", json.dumps(config)],
+                env=dict(os.environ, CUDA_VISIBLE_DEVICES=""))
+            with open(config["result_file"]) as f:
+                results.append(json.load(f))
+    finally:
+        shutil.rmtree(work_dir)
+
+    reference = results[0]
+    for result in results:
+        result["speedup"] = reference["step_ms_mean"] / result["step_ms_mean"]
+        result["metric_differences"] = {
+            name: value - reference["metrics"][name] for name, value in result["metrics"].items()
+        }
+        print("{:<15} xla {:<5} {:8.1f} ms/step {:8.1f} examples/s {:5.2f}x  {}".format(
+            result["policy"], str(result["xla"]), result["step_ms_mean"], result["examples_per_second"], result["speedup"],
+            " ".join("{}={:.4f} ({:+.4f})".format(name, value, result["metric_differences"][name])
+                     for name, value in sorted(result["metrics"].items()))))
+
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
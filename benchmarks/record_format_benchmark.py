@@ -0,0 +1,137 @@
+"""Benchmark of the "encoded" and "raw" record formats of the convert_data_to_tfrecord.py scripts.
+
+Converts the data of a pipeline in both formats, then runs its preprocessing_fn through
+tf.Transform with the Beam DirectRunner and reports the record sizes and the Transform wall time.
+
+Usage:
+    python3 benchmarks/record_format_benchmark.py --pipeline classification
+"""
+import argparse
+import glob
+import importlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DAGS_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), "dags")
+
+RECORD_FORMATS = ["encoded", "raw"]
+
+
+def convert(pipeline, record_format, tfrecords_dir, extra_args):
+    """Runs the converter of a pipeline in its own directory and returns the duration in seconds."""
+    pipeline_dir = os.path.join(DAGS_DIR, "{}_pipeline".format(pipeline))
+    command = [
+        sys.executable, "convert_data_to_tfrecord.py",
+        "--record_format", record_format,
+        "--tfrecords_dir", tfrecords_dir,
+    ] + extra_args
+    start = time.time()
+    subprocess.run(command, cwd=pipeline_dir, check=True)
+    return time.time() - start
+
+
+def directory_size(pattern):
+    """Returns the summed size in bytes of all files matching pattern."""
+    return sum(os.path.getsize(path) for path in glob.glob(pattern, recursive=True) if os.path.isfile(path))
+
+
+def raw_feature_spec(pipeline, constants):
+    """Returns the feature spec of the raw records as SchemaGen infers it."""
+    import tensorflow as tf
+
+    feature_spec = {constants.IMAGE_KEY: tf.io.FixedLenFeature([1], tf.string)}
+    if pipeline == "classification":
+        feature_spec[constants.LABEL_KEY] = tf.io.FixedLenFeature([1], tf.int64)
+    else:
+        feature_spec[constants.MASK_KEY] = tf.io.FixedLenFeature([1], tf.string)
+    return feature_spec
+
+
+def run_transform(pipeline, record_format, record_pattern, output_dir):
+    """Analyzes and transforms the records with the preprocessing_fn of the pipeline.
+
+    Returns:
+        Duration in seconds
+    """
+    import apache_beam as beam
+    import tensorflow_transform as tft
+    import tensorflow_transform.beam as tft_beam
+    from tensorflow_transform.tf_metadata import dataset_metadata, schema_utils
+
+    sys.path.insert(0, DAGS_DIR)
+    module = importlib.import_module("{}_pipeline.module".format(pipeline))
+    module.constants.RECORD_FORMAT = record_format
+
+    raw_metadata = dataset_metadata.DatasetMetadata(
+        schema_utils.schema_from_feature_spec(raw_feature_spec(pipeline, module.constants)))
+    raw_coder = tft.coders.ExampleProtoCoder(raw_metadata.schema)
+
+    start = time.time()
+    with beam.Pipeline(runner="DirectRunner") as p:
+        with tft_beam.Context(temp_dir=os.path.join(output_dir, "tmp")):
+            raw_data = (
+                p
+                | "ReadRecords" >> beam.io.ReadFromTFRecord(record_pattern)
+                | "DecodeRecords" >> beam.Map(raw_coder.decode))
+
+            (transformed_data, transformed_metadata), _ = (
+                (raw_data, raw_metadata)
+                | "AnalyzeAndTransform" >> tft_beam.AnalyzeAndTransformDataset(module.preprocessing_fn))
+
+            _ = (
+                transformed_data
+                | "WriteTransformed" >> beam.io.WriteToTFRecord(
+                    os.path.join(output_dir, "transformed"),
+                    coder=tft.coders.ExampleProtoCoder(transformed_metadata.schema),
+                    file_name_suffix=".gz"))
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pipeline", choices=["classification", "segmentation"], default="classification")
+    parser.add_argument("--output_file", help="Optional JSON file the results are written to")
+    parser.add_argument("converter_args", nargs=argparse.REMAINDER,
+                        help="Additional arguments passed to convert_data_to_tfrecord.py, e.g. -- --num_workers 4")
+    args = parser.parse_args()
+    converter_args = [arg for arg in args.converter_args if arg != "--"]
+
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="record_format_benchmark_")
+    try:
+        for record_format in RECORD_FORMATS:
+            tfrecords_dir = os.path.join(work_dir, record_format, "tfrecords")
+            conversion_time = convert(args.pipeline, record_format, tfrecords_dir, converter_args)
+            transform_dir = os.path.join(work_dir, record_format, "transform")
+            transform_time = run_transform(
+                args.pipeline, record_format, os.path.join(tfrecords_dir, "train", "*"), transform_dir)
+            results.append({
+                "pipeline": args.pipeline,
+                "record_format": record_format,
+                "conversion_seconds": conversion_time,
+                "record_bytes": directory_size(os.path.join(tfrecords_dir, "**", "*.tfrecords")),
+                "transform_seconds": transform_time,
+                "transformed_bytes": directory_size(os.path.join(transform_dir, "transformed*")),
+            })
+    finally:
+        shutil.rmtree(work_dir)
+
+    print("{:<10} {:>14} {:>14} {:>14} {:>18}".format("format", "convert [s]", "records [MB]", "transform [s]", "transformed [MB]"))
+    for result in results:
+        print("{:<10} {:>14.1f} {:>14.2f} {:>14.1f} {:>18.2f}".format(
+            result["record_format"], result["conversion_seconds"], result["record_bytes"] / 1e6,
+            result["transform_seconds"], result["transformed_bytes"] / 1e6))
+
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
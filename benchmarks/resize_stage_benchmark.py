@@ -0,0 +1,107 @@
+"""Benchmark of the resize stage of the convert_data_to_tfrecord.py scripts.
+
+Compares the former resize_and_save_image path (decode, resize, overwrite the source file and
+read it again) with the in-memory load_and_resize_image of the converters on a synthetic dataset,
+of which a configurable fraction of images does not have the target shape.
+
+Usage:
+    python3 benchmarks/resize_stage_benchmark.py --pipeline segmentation --num_images 200
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import cv2
+import numpy as np
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+DAGS_DIR = os.path.join(os.path.dirname(BENCHMARK_DIR), "dags")
+
+PIPELINES = {
+    "classification": {"dir": "classification_pipeline", "ext": ".jpg", "height": 150, "width": 150},
+    "segmentation": {"dir": "segmentation_pipeline", "ext": ".png", "height": 360, "width": 480},
+}
+
+
+def import_converter(pipeline):
+    """Imports convert_data_to_tfrecord.py of a pipeline, which expects its own directory on the path."""
+    sys.path.insert(0, os.path.join(DAGS_DIR, PIPELINES[pipeline]["dir"]))
+    import convert_data_to_tfrecord
+    return convert_data_to_tfrecord
+
+
+def legacy_resize_and_read(filepath, height, width):
+    """The former conversion path: decode, resize and overwrite the source file, then read it again."""
+    img = cv2.imread(filepath)
+    h, w, _ = img.shape
+    if h != height or w != width:
+        cv2.imwrite(filepath, cv2.resize(img, dsize=(width, height)))
+    return open(filepath, "rb").read()
+
+
+def make_synthetic_images(image_dir, num_images, ext, height, width, resize_fraction, seed=0):
+    """Writes smoothed random images, the first resize_fraction of them 25% larger than the target shape.
+
+    Returns:
+        List of image paths
+    """
+    rng = np.random.RandomState(seed)
+    paths = []
+    for num in range(num_images):
+        h, w = (height, width) if num >= resize_fraction * num_images else (int(height * 1.25), int(width * 1.25))
+        img = cv2.GaussianBlur(rng.randint(0, 256, (h, w, 3), dtype=np.uint8), (0, 0), 3)
+        path = os.path.join(image_dir, "{:06d}{}".format(num, ext))
+        cv2.imwrite(path, img)
+        paths.append(path)
+    return paths
+
+
+def time_stage(stage_fn, paths, height, width):
+    """Runs stage_fn over all paths and returns the duration in seconds and the number of encoded bytes."""
+    start = time.perf_counter()
+    num_bytes = sum(len(stage_fn(path, height, width)) for path in paths)
+    return time.perf_counter() - start, num_bytes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pipeline", choices=sorted(PIPELINES), default="classification")
+    parser.add_argument("--num_images", type=int, default=200)
+    parser.add_argument("--resize_fraction", type=float, default=0.5, help="Fraction of images which need a resize")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    config = PIPELINES[args.pipeline]
+    converter = import_converter(args.pipeline)
+    stages = {
+        "legacy resize_and_save_image": legacy_resize_and_read,
+        "in-memory load_and_resize_image": lambda path, h, w: converter.load_and_resize_image(path, h, w)[0],
+    }
+
+    work_dir = tempfile.mkdtemp(prefix="resize_stage_benchmark_")
+    try:
+        source_dir = os.path.join(work_dir, "source")
+        os.makedirs(source_dir)
+        make_synthetic_images(source_dir, args.num_images, config["ext"], config["height"], config["width"], args.resize_fraction)
+
+        for name, stage_fn in stages.items():
+            durations = []
+            for repeat in range(args.repeats):
+                # The legacy path overwrites its input, so every run starts from a fresh copy
+                run_dir = os.path.join(work_dir, "run")
+                shutil.copytree(source_dir, run_dir)
+                paths = sorted(os.path.join(run_dir, filename) for filename in os.listdir(run_dir))
+                duration, num_bytes = time_stage(stage_fn, paths, config["height"], config["width"])
+                durations.append(duration)
+                shutil.rmtree(run_dir)
+            best = min(durations)
+            print("{:<34} {:8.1f} images/s  {:8.2f} MB encoded".format(name, args.num_images / best, num_bytes / 1e6))
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""Check that storing the transformed images with reduced precision does not change the training results.
+
+For every TRANSFORMED_IMAGE_DTYPE the records of a pipeline are transformed with its preprocessing_fn,
+then the pipeline model is trained for a few steps from the same seed on the transformed examples and
+evaluated. The script reports the size of the transformed examples, the largest difference of the
+normalized model inputs to float32 and the evaluation metrics, and fails if a metric differs from
+float32 by more than the tolerance.
+
+Usage:
+    python3 benchmarks/transformed_dtype_check.py --pipeline classification \\
+        --record_pattern "dags/classification_pipeline/data/tfrecords/train/*"
+"""
+import argparse
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+from record_format_benchmark import DAGS_DIR, directory_size, raw_feature_spec
+
+DTYPES = ["float32", "uint8", "float16"]
+
+
+def transform(pipeline, module, record_pattern, output_dir):
+    """Analyzes and transforms the records and writes the transformed examples and the transform graph to output_dir."""
+    import apache_beam as beam
+    import tensorflow_transform as tft
+    import tensorflow_transform.beam as tft_beam
+    from tensorflow_transform.tf_metadata import dataset_metadata, schema_utils
+
+    raw_metadata = dataset_metadata.DatasetMetadata(
+        schema_utils.schema_from_feature_spec(raw_feature_spec(pipeline, module.constants)))
+    raw_coder = tft.coders.ExampleProtoCoder(raw_metadata.schema)
+
+    with beam.Pipeline(runner="DirectRunner") as p:
+        with tft_beam.Context(temp_dir=os.path.join(output_dir, "tmp")):
+            raw_data = (
+                p
+                | "ReadRecords" >> beam.io.ReadFromTFRecord(record_pattern)
+                | "DecodeRecords" >> beam.Map(raw_coder.decode))
+
+            (transformed_data, transformed_metadata), transform_fn = (
+                (raw_data, raw_metadata)
+                | "AnalyzeAndTransform" >> tft_beam.AnalyzeAndTransformDataset(module.preprocessing_fn))
+
+            _ = (
+                transformed_data
+                | "WriteTransformed" >> beam.io.WriteToTFRecord(
+                    os.path.join(output_dir, "transformed", "examples"),
+                    coder=tft.coders.ExampleProtoCoder(transformed_metadata.schema),
+                    file_name_suffix=".gz"))
+            _ = transform_fn | "WriteTransformFn" >> tft_beam.WriteTransformFn(output_dir)
+
+
+def max_input_error(module, seed=0):
+    """Returns the largest absolute difference of the normalized model inputs to float32 on random pixels."""
+    import tensorflow as tf
+
+    constants = module.constants
+    pixels = tf.constant(
+        np.random.RandomState(seed).uniform(0, 255, (4, constants.HEIGHT, constants.WIDTH, 3)), dtype=tf.float32)
+    if constants.TRANSFORMED_IMAGE_DTYPE == "float32":
+        return 0.0
+    restored = module._decode_transformed_images(module._encode_transformed_images(pixels))
+    return float(tf.reduce_max(tf.abs(restored - module._normalize_images(pixels))))
+
+
+def train_and_evaluate(module, transform_dir, train_steps, eval_steps, seed):
+    """Trains the pipeline model for train_steps on the transformed examples and returns its evaluation metrics."""
+    import tensorflow as tf
+    import tensorflow_transform as tft
+
+    tf.random.set_seed(seed)
+    constants = module.constants
+    tf_transform_output = tft.TFTransformOutput(transform_dir)
+    file_pattern = [os.path.join(transform_dir, "transformed", "*.gz")]
+
+    train_dataset = module._input_fn(file_pattern, tf_transform_output, constants.TRAIN_BATCH_SIZE, is_train=True)
+    eval_dataset = module._input_fn(file_pattern, tf_transform_output, constants.EVAL_BATCH_SIZE, is_train=False)
+
+    model = module.get_model(None)
+    model.fit(train_dataset, epochs=1, steps_per_epoch=train_steps, verbose=0)
+    return model.evaluate(eval_dataset, steps=eval_steps, return_dict=True, verbose=0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pipeline", choices=["classification", "segmentation"], default="classification")
+    parser.add_argument("--record_pattern", required=True, help="File pattern of the records of convert_data_to_tfrecord.py")
+    parser.add_argument("--train_steps", type=int, default=50)
+    parser.add_argument("--eval_steps", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--tolerance", type=float, default=0.02, help="Largest accepted absolute difference of a metric to float32")
+    parser.add_argument("--output_file", help="Optional JSON file the results are written to")
+    args = parser.parse_args()
+
+    sys.path.insert(0, DAGS_DIR)
+    module = importlib.import_module("{}_pipeline.module".format(args.pipeline))
+
+    results = []
+    work_dir = tempfile.mkdtemp(prefix="transformed_dtype_check_")
+    try:
+        for dtype in DTYPES:
+            module.constants.TRANSFORMED_IMAGE_DTYPE = dtype
+            transform_dir = os.path.join(work_dir, dtype)
+            transform(args.pipeline, module, args.record_pattern, transform_dir)
+            results.append({
+                "pipeline": args.pipeline,
+                "dtype": dtype,
+                "transformed_bytes": directory_size(os.path.join(transform_dir, "transformed", "*.gz")),
+                "max_input_error": max_input_error(module, args.seed),
+                "metrics": train_and_evaluate(module, transform_dir, args.train_steps, args.eval_steps, args.seed),
+            })
+    finally:
+        shutil.rmtree(work_dir)
+
+    reference = results[0]
+    failed = False
+    for result in results:
+        differences = {name: abs(value - reference["metrics"][name]) for name, value in result["metrics"].items()}
+        result["metric_differences"] = differences
+        result["passed"] = all(difference <= args.tolerance for name, difference in differences.items() if name != "loss")
+        failed = failed or not result["passed"]
+        print("{:<8} {:>10.2f} MB  {:>5.2f}x smaller  max input error {:.4f}  {}  {}".format(
+            result["dtype"], result["transformed_bytes"] / 1e6,
+            reference["transformed_bytes"] / max(result["transformed_bytes"], 1), result["max_input_error"],
+            " ".join("{}={:.4f}".format(name, value) for name, value in sorted(result["metrics"].items())),
+            "ok" if result["passed"] else "FAILED"))
+
+    if args.output_file:
+        with open(args.output_file, "w") as f:
+            json.dump(results, f, indent=2)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
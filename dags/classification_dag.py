@@ -4,7 +4,8 @@ import os
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'  # 2: ERROR & FATAL; 3: FATAL only
 logging.getLogger('tensorflow').setLevel(logging.ERROR)
 
-from classification_pipeline import base_pipeline
+from classification_pipeline import base_pipeline, constants
+from pipeline_common.span_sensor import add_span_sensor
 
 from datetime import datetime, timedelta
 
@@ -17,6 +18,7 @@ dags_dir = "/mnt/c/dags/"
 # dags_dir = ""
 project_dir = os.path.join(dags_dir, "classification_pipeline")
 data_dir = os.path.join(project_dir, "data/tfrecords/")
+image_dir = os.path.join(project_dir, "data/Image_Classification/")
 module_file = os.path.join(project_dir, "module.py") ### write module file
 serving_model_dir = os.path.join(project_dir, "serving_model", pipeline_name)
 
@@ -35,6 +37,12 @@ airflow_config = {
     "schedule_interval": None,
     "start_date": datetime(2020, 10, 17),
 }
+if constants.USE_SPANS:
+    # Runs periodically, the span sensor skips every run without a new span
+    airflow_config["schedule_interval"] = timedelta(minutes=constants.SPAN_SCHEDULE_INTERVAL_MINUTES)
+    airflow_config["catchup"] = False
+    # The next run starts from the span the previous run recorded
+    airflow_config["max_active_runs"] = 1
 
 p = base_pipeline.init_beam_pipeline(
     pipeline_name=pipeline_name,
@@ -43,8 +51,18 @@ p = base_pipeline.init_beam_pipeline(
     module_file=module_file,
     serving_model_dir=serving_model_dir,
     metadata_path=metadata_path,
-    beam_pipeline_args=beam_pipeline_args
+    beam_pipeline_args=beam_pipeline_args,
+    image_root=image_dir
     )
 
 
-DAG = AirflowDagRunner(AirflowPipelineConfig(airflow_config)).run(p)
\ No newline at end of file
+DAG = AirflowDagRunner(AirflowPipelineConfig(airflow_config)).run(p)
+
+if constants.USE_SPANS:
+    add_span_sensor(
+        DAG,
+        input_base=image_dir if constants.USE_IMAGE_EXAMPLE_GEN else data_dir,
+        pipeline_root=pipeline_root,
+        poke_interval=constants.SPAN_POKE_INTERVAL_SECONDS,
+        timeout=constants.SPAN_SCHEDULE_INTERVAL_MINUTES * 60,
+        )
@@ -1,6 +1,8 @@
 
 IMAGE_KEY = "image_raw"
 LABEL_KEY = "label"
+# Class names in the order of the labels of get_label_from_directory in "convert_data_to_tfrecord.py"
+CLASS_NAMES = ["buildings", "forest", "glacier", "mountain", "sea", "street"]
 
 EPOCHS = 2
 TRAIN_STEPS = 5
@@ -9,4 +11,99 @@ TRAIN_BATCH_SIZE = 4
 EVAL_BATCH_SIZE = 1
 HEIGHT = 320
 WIDTH = 320
+# Shape of the encoded images in the records, Transform resizes them to (HEIGHT, WIDTH)
+RECORD_HEIGHT = 150
+RECORD_WIDTH = 150
+# Number of images of a Transform batch decoded in parallel by preprocessing_fn
+DECODE_PARALLEL_ITERATIONS = 32
+# Precision of the transformed images, "float32" stores normalized images, "uint8" and "float16" store the
+# resized pixels, which are normalized by the Trainer input pipeline (uint8 rounds to whole pixel values)
+TRANSFORMED_IMAGE_DTYPE = "float32"
+# Write the transformed examples with Transform, otherwise Transform only writes the transform graph
+# and the Trainer applies it to the raw examples inside its tf.data input pipeline
+MATERIALIZE_TRANSFORMED = True
+# tf.data settings of _input_fn, "default" reads with make_batched_features_dataset and its defaults,
+# "throughput" interleaves the files and parses and maps in parallel, -1 stands for tf.data.experimental.AUTOTUNE
+INPUT_PIPELINE_PROFILE = "default"
+INPUT_PIPELINE_PROFILES = {
+    "default": None,
+    "throughput": {
+        "interleave_cycle_length": -1,
+        "num_parallel_calls": -1,
+        "shuffle_buffer_size": 256,
+        # Only applies to training, evaluation always reads deterministically
+        "deterministic": False,
+        "prefetch_buffer_size": -1,
+        # 0 keeps the tf.data defaults
+        "private_threadpool_size": 0,
+        "max_intra_op_parallelism": 0,
+    },
+}
+# Profile the batches INPUT_PIPELINE_PROFILE_BATCHES with the TensorBoard callback,
+# the input pipeline analysis then shows up in the profile tab of TensorBoard
+INPUT_PIPELINE_STATS = False
+INPUT_PIPELINE_PROFILE_BATCHES = "10,20"
+# Cache the parsed batches before the augmentation in this local directory, so later epochs and reruns
+# with the same transform graph and files skip reading and parsing the TFRecords, None disables the cache
+DATASET_CACHE_DIR = None
+# The least recently used caches are removed once the cache directory grows beyond this size
+DATASET_CACHE_MAX_BYTES = 20 * 1024 ** 3
+# Number of cached batches shuffled between the epochs of the training dataset
+DATASET_CACHE_SHUFFLE_BATCHES = 16
+# Train with MultiWorkerMirroredStrategy on the cluster in the TF_CONFIG environment variable of the Trainer
+# processes, every worker reads batches of TRAIN_BATCH_SIZE and EVAL_BATCH_SIZE of its shard of the input
+MULTI_WORKER_TRAINING = False
+# Collective communication of the workers, "RING" for CPUs, "NCCL" for GPUs or "AUTO"
+MULTI_WORKER_COMMUNICATION = "RING"
+# Record the step latency percentiles, examples/s, the split of the step time into input wait and compute
+# and the peak RSS of training in TensorBoard and in "performance.json" next to the model. The compute time
+# is measured after training on PERFORMANCE_PROBE_STEPS steps of one cached batch, which are reverted
+PERFORMANCE_SUMMARY = True
+PERFORMANCE_PROBE_STEPS = 5
+# (first, last) training step of a tf.profiler trace in the TensorBoard logs, None disables the trace
+PROFILE_STEPS = None
+# Back up the model after every epoch and resume from the backup when a Trainer run on the same inputs was interrupted
+BACKUP_AND_RESTORE = True
+# Directory of the backups, None places them in "trainer_backup" of the pipeline root
+BACKUP_DIR = None
+# Initialize the model with the weights of the model of the previous Trainer run ("base_model"), of the latest
+# model the Pusher pushed to serving_model_dir ("pushed_model") or only with the pre-trained backbone (None)
+WARM_START = None
+# Keras mixed precision policy, "mixed_bfloat16" computes in bfloat16 on CPUs with oneDNN while the variables
+# and the final softmax stay float32, None trains in float32
+MIXED_PRECISION_POLICY = None
+# Compile the training step of model.fit and the model call of the serving signatures with XLA
+XLA_COMPILE = False
 PRETRAINED_WEIGHTS = "imagenet"
+# Name of the tf.keras.applications backbone, the preprocessing_fn normalizes the images for EfficientNet
+BACKBONE_NAME = "EfficientNetB3"
+BACKBONE_TRAINABLE = False
+# With a frozen backbone the pooled backbone embeddings of every example are computed once and stored,
+# the classification head is then trained on them instead of running the backbone in every epoch.
+# The cached examples are not augmented, a trainable backbone or STRATIFIED_SAMPLING falls back to the images
+FEATURE_CACHE = False
+# Directory of the stored embeddings, None stores them in "feature_cache" of the pipeline root
+FEATURE_CACHE_DIR = None
+FEATURE_CACHE_SHUFFLE_BUFFER = 1024
+# Read the span-N directories written by "convert_data_to_tfrecord.py --incremental"
+# instead of the train/ and test/ directories of a full conversion. Transform only analyzes the new
+# span of a run, so the preprocessing_fn has to stay free of tft analyzers while spans are on
+USE_SPANS = False
+# Number of latest spans the Trainer trains on, every span is only ingested and transformed once
+SPAN_WINDOW = 3
+# With USE_SPANS the DAG runs on this schedule and a sensor skips the run unless a new span arrived
+SPAN_SCHEDULE_INTERVAL_MINUTES = 60
+SPAN_POKE_INTERVAL_SECONDS = 300
+# Convert the image directories with the ImageExampleGenExecutor inside the pipeline
+# instead of importing the TFRecords of "convert_data_to_tfrecord.py"
+USE_IMAGE_EXAMPLE_GEN = False
+# "encoded" records hold the image files, "raw" records hold decoded uint8 pixels of shape (HEIGHT, WIDTH, 3),
+# has to match the --record_format of "convert_data_to_tfrecord.py"
+RECORD_FORMAT = "encoded"
+# Read the per-class shards of "convert_data_to_tfrecord.py --stratify" as one split per class
+# and mix them into balanced training batches
+STRATIFIED_SAMPLING = False
+# Sampling weight of every class in the order of CLASS_NAMES, None samples all classes equally
+CLASS_SAMPLING_WEIGHTS = None
+# Shuffle buffer per class, since the classes are mixed by sampling a small buffer is enough
+STRATIFIED_SHUFFLE_BUFFER = 64
@@ -1,25 +1,35 @@
 import os
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 
-import cv2
+import argparse
+import glob
+import hashlib
+import io
+import json
+import multiprocessing
 import pathlib
+import struct
+import time
+
+import cv2
 import numpy as np
 import tensorflow as tf
 from PIL import Image
-import constants
+try:
+    from classification_pipeline import constants
+except ImportError:
+    # Executed as script from within the pipeline directory
+    import constants
 
 data_dir = "data/"
 train_dir = os.path.join(data_dir, "Image_Classification/seg_train")
 # test_dir = os.path.join(data_dir, "Image_Classification/seg_test")
 
 tfrecords_dir = os.path.join(data_dir, "tfrecords")
-train_record_file = os.path.join(tfrecords_dir, "train/train.tfrecords")
-# test_record_file = os.path.join(tfrecords_dir, "test/test.tfrecords")
 
+# Beam (and therefore ImportExampleGen) detects the compression of a record file by its suffix
+COMPRESSION_SUFFIXES = {"none": "", "GZIP": ".gz", "ZLIB": ".deflate"}
 
-pathlib.Path(tfrecords_dir).mkdir(parents=True, exist_ok=True)
-pathlib.Path(os.path.join(tfrecords_dir, "train")).mkdir(parents=True, exist_ok=True)
-# pathlib.Path(os.path.join(tfrecords_dir, "test")).mkdir(parents=True, exist_ok=True)
 
 def _bytes_feature(value):
     """Returns a bytes_list from a string / byte."""
@@ -31,17 +41,20 @@ def _int64_feature(value):
     """Returns an int64_list from a bool / enum / int / uint."""
     return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
 
-def image_example(img_string, label):#, height, width, depth):
+def image_example(img_string, label, shape=None):
     # image_shape = tf.image.decode_jpg(img_string).shape
     # label_shape = tf.image.decode_jpg(lbl_string).shape
 
     feature = {
-        # "height": _int64_feature(height),
-        # "width": _int64_feature(width),
-        # "depth": _int64_feature(depth),
         "label": _int64_feature(label),
         "image_raw": _bytes_feature(img_string),
     }
+    if shape is not None:
+        # Raw records need the shape to reshape the decoded bytes
+        height, width, depth = shape
+        feature["height"] = _int64_feature(height)
+        feature["width"] = _int64_feature(width)
+        feature["depth"] = _int64_feature(depth)
 
     return tf.train.Example(features=tf.train.Features(feature=feature))
 
@@ -78,60 +91,459 @@ def get_label_from_directory(directory):
         raise NotImplementedError("Found unknown image")
     return label
 
-def resize_and_save_image(filepath, height, width):
-    """Function to resize and save images which do not have the prespecified image shape of (height, width, 3).
+def load_and_resize_image(filepath, height, width, interpolation=cv2.INTER_LINEAR):
+    """Reads an image once and resizes it in memory if it does not have the shape (height, width).
+
+    Only the image header is parsed to check the shape, so images of the right size are passed
+    through as their original bytes without being decoded. Other images are decoded once, resized
+    and re-encoded into an in-memory buffer of the same format. The source file is never modified.
+
+    Args:
+        filepath: String of imagepath
+        height: Int
+        width: Int
+        interpolation: cv2 interpolation flag used for resizing
+
+    Returns:
+        Tuple of (encoded bytes of the image with shape (height, width), original bytes of the file)
+
+    """
+    content = open(filepath, "rb").read()
+    w, h = Image.open(io.BytesIO(content)).size
+    if h == height and w == width:
+        return content, content
+
+    img = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+    res = cv2.resize(img, dsize=(width, height), interpolation=interpolation)
+    _, buffer = cv2.imencode(os.path.splitext(filepath)[1], res)
+    return buffer.tobytes(), content
+
+def load_decoded_image(filepath, height, width, interpolation=cv2.INTER_LINEAR):
+    """Reads an image and returns its pixels decoded and resized to (height, width) as raw uint8 RGB bytes.
 
     Args:
         filepath: String of imagepath
         height: Int
         width: Int
+        interpolation: cv2 interpolation flag used for resizing
+
+    Returns:
+        Tuple of (raw bytes of the image, shape of the image, original bytes of the file)
+
+    """
+    content = open(filepath, "rb").read()
+    img = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img.shape[:2] != (height, width):
+        img = cv2.resize(img, dsize=(width, height), interpolation=interpolation)
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return img.tobytes(), img.shape, content
+
+def convert_image(filepath, label, height, width, record_format):
+    """Converts a single image file to a tf.Example.
+
+    Args:
+        filepath: String of imagepath
+        label: Int
+        height: Int
+        width: Int
+        record_format: "encoded" to store the JPEG bytes or "raw" to store decoded uint8 pixels
+
+    Returns:
+        Tuple of (tf.train.Example, original bytes of the file)
+    """
+    if record_format == "raw":
+        image_string, shape, content = load_decoded_image(filepath, height, width)
+        return image_example(image_string, label, shape), content
+
+    image_string, content = load_and_resize_image(filepath, height, width)
+    return image_example(image_string, label), content
+
+def list_image_files(img_dir):
+    """Collects all images of the class sub directories of img_dir.
+
+    Args:
+        img_dir: String of directory containing one sub directory per class
+
+    Returns:
+        List of (filepath, label) tuples sorted by class and filename
+    """
+    files = []
+    for directory in sorted(os.listdir(img_dir)):
+        label = get_label_from_directory(directory)
+        for filename in sorted(os.listdir(os.path.join(img_dir, directory))):
+            files.append((os.path.join(img_dir, directory, filename), label))
+    return files
+
+def shard_filename(split, shard, num_shards, compression="none"):
+    """Returns the filename of a shard, e.g. train-00000-of-00032.tfrecords or train-00000-of-00032.tfrecords.gz"""
+    return "{}-{:05d}-of-{:05d}.tfrecords{}".format(split, shard, num_shards, COMPRESSION_SUFFIXES[compression])
+
+def index_filename(record_file):
+    """Returns the filename of the index sidecar of a shard, e.g. train-00000-of-00032.json"""
+    return os.path.basename(record_file).split(".tfrecords")[0] + ".json"
+
+def write_index(index_file, record_file, offsets, class_counts=None, compression="none"):
+    """Writes the index sidecar of a shard with its record count and the byte offset of every record.
+
+    Args:
+        index_file: String of filepath of the index
+        record_file: String of filepath of the shard
+        offsets: List of byte offsets of the records in the shard
+        class_counts: Optional dict mapping labels to their number of records
+        compression: Compression of the shard, offsets are only stored for uncompressed shards
 
     Returns:
         None
+    """
+    index = {"record_file": os.path.basename(record_file), "num_records": len(offsets)}
+    if compression == "none":
+        index["offsets"] = offsets
+    else:
+        index["compression"] = compression
+    if class_counts is not None:
+        index["class_counts"] = {str(label): count for label, count in sorted(class_counts.items())}
+    with open(index_file, "w") as f:
+        json.dump(index, f)
+
+def load_split_index(index_dir):
+    """Sums up the index sidecars of all shards of a split.
+
+    Args:
+        index_dir: String of the index directory of a split
+
+    Returns:
+        Dict with the total num_records and class_counts of the split
+    """
+    num_records, class_counts = 0, {}
+    for index_file in sorted(glob.glob(os.path.join(index_dir, "*.json"))):
+        with open(index_file) as f:
+            index = json.load(f)
+        num_records += index["num_records"]
+        for label, count in index.get("class_counts", {}).items():
+            class_counts[label] = class_counts.get(label, 0) + count
+    return {"num_records": num_records, "class_counts": class_counts}
+
+def read_record_at(record_file, offset):
+    """Reads a single serialized tf.Example at a byte offset of an uncompressed shard, e.g. for debugging or sampling.
+
+    Args:
+        record_file: String of filepath of the shard
+        offset: Int byte offset of the record as stored in the index
+
+    Returns:
+        Bytes of the serialized tf.Example
+    """
+    with open(record_file, "rb") as f:
+        f.seek(offset)
+        length = struct.unpack("<Q", f.read(8))[0]
+        f.read(4)  # masked crc32c of the length
+        return f.read(length)
+
+def split_into_shards(files, num_shards):
+    """Distributes files round robin over num_shards shards.
+
+    Since files are sorted by class, round robin keeps the shard sizes within one
+    image of each other and mixes all classes into every shard.
+
+    Args:
+        files: List of files
+        num_shards: Int
 
+    Returns:
+        List of num_shards lists of files
     """
-    img = cv2.imread(filepath)
-    h, w, d = img.shape
-    if h != height or w != width:
-        res = cv2.resize(img, dsize=(150, 150))
-        cv2.imwrite(filepath, res)
-        print("{} resized from shape {} to shape (150, 150, 3)".format(filepath, (h, w, d)))
-    if d != 3:
-        print(filepath)
+    return [files[shard::num_shards] for shard in range(num_shards)]
 
-# Write train files to TFRecord
-with tf.io.TFRecordWriter(train_record_file) as writer:
-    for dir_num, directory in enumerate(sorted(os.listdir(train_dir))):
-        for img_num, filename in enumerate(sorted(os.listdir(os.path.join(train_dir, directory)))):
-            if img_num % 299 == 0:
-                print("Directory number {} and Image number {}".format(dir_num, img_num))
+def file_fingerprint(filepath, content=None):
+    """Returns size, modification time and sha256 content hash of a file.
 
-            resize_and_save_image(os.path.join(train_dir, directory, filename), 150, 150)
+    Args:
+        filepath: String of filepath
+        content: Optional bytes of the file, avoids reading the file a second time
 
-            # ToDo: put an assert operator in here to check if every image and mask has the same shape
-            # image_string = image.tobytes()
+    Returns:
+        Dict with keys size, mtime and sha256
+    """
+    if content is None:
+        content = open(filepath, "rb").read()
+    stat = os.stat(filepath)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": hashlib.sha256(content).hexdigest()}
 
-            image_string = open(os.path.join(train_dir, directory, filename), "rb").read()
-            label = get_label_from_directory(directory)
-            tf_example = image_example(image_string, label)#, height, width, depth)
-            writer.write(tf_example.SerializeToString())
+def is_unchanged(filepath, fingerprint):
+    """Checks a file against its manifest fingerprint. The content is only hashed if size matches but mtime does not.
 
-# Write test files to TFRecord
-# with tf.io.TFRecordWriter(test_record_file) as writer:
-#     for dir_num, directory in enumerate(sorted(os.listdir(test_dir))):
-#         for img_num, filename in enumerate(sorted(os.listdir(os.path.join(test_dir, directory)))):
-#             if img_num % 200 == 0:
-#                 print("Directory number {} and Image number {}".format(dir_num, img_num))
+    Args:
+        filepath: String of filepath
+        fingerprint: Dict as returned by file_fingerprint
 
-#             image = np.array(Image.open(os.path.join(test_dir, directory, filename)))
-#             # height, width, depth = image.shape
+    Returns:
+        Bool - True if the file content did not change
+    """
+    stat = os.stat(filepath)
+    if stat.st_size != fingerprint["size"]:
+        return False
+    if stat.st_mtime == fingerprint["mtime"]:
+        return True
+    if file_fingerprint(filepath)["sha256"] == fingerprint["sha256"]:
+        # Only touched, remember the new mtime to skip hashing on the next run
+        fingerprint["mtime"] = stat.st_mtime
+        return True
+    return False
 
-#             # ToDo: put an assert operator in here to check if every image and mask has the same shape
+def load_manifest(manifest_file):
+    """Loads the conversion manifest or returns an empty one if none exists yet."""
+    if not os.path.exists(manifest_file):
+        return {"last_span": -1, "splits": {}}
+    with open(manifest_file) as f:
+        return json.load(f)
 
-#             image_string = image.tobytes()
+def save_manifest(manifest, manifest_file):
+    """Atomically writes the conversion manifest."""
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+def filter_converted(files, img_dir, split_manifest):
+    """Removes all files from the list which were already converted and did not change since.
+
+    Changed files are converted again into the new span, their previous version stays in the span
+    it was written to.
+
+    Args:
+        files: List of (filepath, label) tuples
+        img_dir: String of directory the manifest paths are relative to
+        split_manifest: Dict mapping relative filepaths to fingerprints
+
+    Returns:
+        List of (filepath, label) tuples which still need to be converted
+    """
+    pending = []
+    changed = 0
+    for filepath, label in files:
+        fingerprint = split_manifest.get(os.path.relpath(filepath, img_dir))
+        if fingerprint is None:
+            pending.append((filepath, label))
+        elif not is_unchanged(filepath, fingerprint):
+            pending.append((filepath, label))
+            changed += 1
+    if changed:
+        print("{} changed images are converted again, their previous versions are trained on as well "
+              "as long as their spans are within SPAN_WINDOW".format(changed))
+    return pending
 
-#             label = get_label_from_directory(directory)
+def write_shard(shard_args):
+    """Write the images of a single shard to a TFRecord file. Runs inside a worker process.
+
+    Args:
+        shard_args: Tuple of (record_file, index_file, files, height, width, record_format, compression)
+
+    Returns:
+        Dict mapping the filepath of every written image to its fingerprint
+    """
+    record_file, index_file, files, height, width, record_format, compression = shard_args
+    fingerprints = {}
+    offsets = []
+    class_counts = {}
+    offset = 0
+    options = tf.io.TFRecordOptions(compression_type="" if compression == "none" else compression)
+    with tf.io.TFRecordWriter(record_file, options) as writer:
+        for filepath, label in files:
+            tf_example, content = convert_image(filepath, label, height, width, record_format)
+            serialized_example = tf_example.SerializeToString()
+            writer.write(serialized_example)
+            fingerprints[filepath] = file_fingerprint(filepath, content)
+
+            offsets.append(offset)
+            # A record consists of its length, the crc of the length, the data and the crc of the data,
+            # for compressed shards these are offsets into the uncompressed stream
+            offset += 8 + 4 + len(serialized_example) + 4
+            class_counts[label] = class_counts.get(label, 0) + 1
+    write_index(index_file, record_file, offsets, class_counts, compression)
+    return fingerprints
+
+def write_files_to_tfrecord(files, record_dir, split, height, width, num_shards, num_workers, record_format="encoded", compression="none"):
+    """Write the files of a split to num_shards balanced TFRecord shards using a process pool.
+
+    Args:
+        files: List of (filepath, label) tuples
+        record_dir: String of directory the shards are written to
+        split: String of split name used as shard prefix
+        height: Int
+        width: Int
+        num_shards: Int
+        num_workers: Int, 0 means one worker per available cpu
+        record_format: "encoded" to store the JPEG bytes or "raw" to store decoded uint8 pixels
+        compression: "none", "GZIP" or "ZLIB"
+
+    Returns:
+        Dict mapping the filepath of every written image to its fingerprint
+    """
+    num_shards = max(1, min(num_shards, len(files)))
+    num_workers = num_workers or os.cpu_count()
 
-#             tf_example = image_example(image_string, label)#, height, width, depth)
+    # The index sidecars are kept in a sibling index/ directory, since "split/*" must only match TFRecord files
+    index_dir = os.path.join(os.path.dirname(os.path.normpath(record_dir)), "index", split)
+
+    pathlib.Path(record_dir).mkdir(parents=True, exist_ok=True)
+    pathlib.Path(index_dir).mkdir(parents=True, exist_ok=True)
+    # Remove the shards of a previous conversion, otherwise "split/*" would pick them up as well
+    stale_files = glob.glob(os.path.join(record_dir, "{}-*-of-*.tfrecords*".format(split)))
+    stale_files += glob.glob(os.path.join(record_dir, "{}.tfrecords*".format(split)))
+    stale_files += glob.glob(os.path.join(index_dir, "{}-*-of-*.json".format(split)))
+    for stale_file in stale_files:
+        os.remove(stale_file)
+
+    shard_args = []
+    for shard, shard_files in enumerate(split_into_shards(files, num_shards)):
+        record_file = os.path.join(record_dir, shard_filename(split, shard, num_shards, compression))
+        shard_args.append(
+            (record_file, os.path.join(index_dir, index_filename(record_file)), shard_files, height, width, record_format, compression))
+
+    start = time.time()
+    fingerprints = {}
+    if num_workers == 1:
+        for shard_arg in shard_args:
+            fingerprints.update(write_shard(shard_arg))
+    else:
+        # TensorFlow is not fork-safe, therefore the workers are spawned
+        with multiprocessing.get_context("spawn").Pool(processes=num_workers) as pool:
+            for shard_num, shard_fingerprints in enumerate(pool.imap_unordered(write_shard, shard_args)):
+                fingerprints.update(shard_fingerprints)
+                print("Shard {} of {} finished, {} images written".format(shard_num + 1, num_shards, len(fingerprints)))
+
+    duration = time.time() - start
+    print("Wrote {} images into {} shards with {} workers in {:.1f}s ({:.1f} images/s)".format(
+        len(fingerprints), num_shards, num_workers, duration, len(fingerprints) / max(duration, 1e-6)))
+    return fingerprints
+
+def split_train_eval(files, eval_buckets=1, num_buckets=6):
+    """Deterministically holds out eval_buckets of num_buckets hash buckets of the files for evaluation.
+
+    The hash of the class directory and filename decides the bucket, like the hash split of ExampleGen,
+    so an image stays in the same split across conversions.
+
+    Args:
+        files: List of (filepath, label) tuples
+        eval_buckets: Int
+        num_buckets: Int
+
+    Returns:
+        Tuple of (train files, eval files)
+    """
+    train_files, eval_files = [], []
+    for filepath, label in files:
+        key = "/".join(os.path.normpath(filepath).split(os.sep)[-2:])
+        bucket = int(hashlib.md5(key.encode("utf-8")).hexdigest(), 16) % num_buckets
+        (eval_files if bucket < eval_buckets else train_files).append((filepath, label))
+    return train_files, eval_files
+
+def write_stratified_files_to_tfrecord(files, output_dir, height, width, num_shards, num_workers, record_format="encoded", compression="none"):
+    """Write the train files to per-class shards (e.g. train-forest-00000-of-00005.tfrecords) and hold out an eval split.
+
+    Args:
+        files: List of (filepath, label) tuples
+        output_dir: String of directory the train/ and eval/ directories are written to
+        height: Int
+        width: Int
+        num_shards: Int, number of train shards summed over all classes
+        num_workers: Int, 0 means one worker per available cpu
+        record_format: "encoded" to store the JPEG bytes or "raw" to store decoded uint8 pixels
+        compression: "none", "GZIP" or "ZLIB"
+
+    Returns:
+        Dict mapping the filepath of every written image to its fingerprint
+    """
+    train_files, eval_files = split_train_eval(files)
+    record_dir = os.path.join(output_dir, "train")
+    num_class_shards = max(1, num_shards // len(constants.CLASS_NAMES))
+
+    # Remove the mixed shards of a previous conversion, write_files_to_tfrecord replaces the per-class shards
+    for stale_file in glob.glob(os.path.join(record_dir, "train-[0-9]*-of-*.tfrecords*")) + glob.glob(os.path.join(record_dir, "train.tfrecords*")):
+        os.remove(stale_file)
+
+    fingerprints = {}
+    for label, class_name in enumerate(constants.CLASS_NAMES):
+        class_files = [(filepath, file_label) for filepath, file_label in train_files if file_label == label]
+        if not class_files:
+            # ExampleGen declares a split per class, so every class gets shards, possibly a single empty one,
+            # which also replaces the shards of the class of a previous conversion
+            print("No images of class {} found, writing an empty shard".format(class_name))
+        fingerprints.update(write_files_to_tfrecord(
+            class_files, record_dir, "train-{}".format(class_name),
+            height, width, num_class_shards, num_workers, record_format, compression
+            ))
+
+    fingerprints.update(write_files_to_tfrecord(
+        eval_files, os.path.join(output_dir, "eval"), "eval",
+        height, width, max(1, num_shards // 4), num_workers, record_format, compression
+        ))
+    return fingerprints
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert the image classification data to sharded TFRecord files.")
+    parser.add_argument("--train_dir", default=train_dir, help="Directory with one sub directory per class")
+    parser.add_argument("--tfrecords_dir", default=tfrecords_dir, help="Output directory of the TFRecord files")
+    parser.add_argument("--height", type=int, default=constants.RECORD_HEIGHT, help="Height of the encoded images in the records")
+    parser.add_argument("--width", type=int, default=constants.RECORD_WIDTH, help="Width of the encoded images in the records")
+    parser.add_argument("--record_format", choices=["encoded", "raw"], default=constants.RECORD_FORMAT,
+                        help="Store encoded JPEG bytes or decoded uint8 pixels resized to (constants.HEIGHT, constants.WIDTH)")
+    parser.add_argument("--num_shards", type=int, default=32, help="Number of shards per split")
+    parser.add_argument("--num_workers", type=int, default=0, help="Number of worker processes, 0 uses all cpus")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only convert images missing from the manifest and write them as a new span-N directory")
+    parser.add_argument("--compression", choices=sorted(COMPRESSION_SUFFIXES), default="none",
+                        help="Compression of the TFRecord files, the shards get the matching suffix for ImportExampleGen")
+    parser.add_argument("--stratify", action="store_true",
+                        help="Write one set of shards per class and a held out eval split, see constants.STRATIFIED_SAMPLING")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.record_format == "raw":
+        args.height, args.width = constants.HEIGHT, constants.WIDTH
+
+    # Write train files to TFRecord
+    files = list_image_files(args.train_dir)
+    if not args.incremental and args.stratify:
+        write_stratified_files_to_tfrecord(
+            files, args.tfrecords_dir,
+            args.height, args.width, args.num_shards, args.num_workers, args.record_format, args.compression
+            )
+    elif not args.incremental:
+        write_files_to_tfrecord(
+            files, os.path.join(args.tfrecords_dir, "train"), "train",
+            args.height, args.width, args.num_shards, args.num_workers, args.record_format, args.compression
+            )
+    else:
+        manifest_file = os.path.join(args.tfrecords_dir, "manifest.json")
+        manifest = load_manifest(manifest_file)
+        split_manifest = manifest["splits"].setdefault("train", {})
+        files = filter_converted(files, args.train_dir, split_manifest)
+        if files:
+            span = manifest["last_span"] + 1
+            span_dir = os.path.join(args.tfrecords_dir, "span-{}".format(span))
+            if args.stratify:
+                fingerprints = write_stratified_files_to_tfrecord(
+                    files, span_dir,
+                    args.height, args.width, args.num_shards, args.num_workers, args.record_format, args.compression
+                    )
+            else:
+                fingerprints = write_files_to_tfrecord(
+                    files, os.path.join(span_dir, "train"), "train",
+                    args.height, args.width, args.num_shards, args.num_workers, args.record_format, args.compression
+                    )
+            for filepath, fingerprint in fingerprints.items():
+                fingerprint["span"] = span
+                split_manifest[os.path.relpath(filepath, args.train_dir)] = fingerprint
+            manifest["last_span"] = span
+        else:
+            print("No new images found, no span written")
+        save_manifest(manifest, manifest_file)
 
-#             writer.write(tf_example.SerializeToString())
\ No newline at end of file
+    # Write test files to TFRecord
+    # write_files_to_tfrecord(
+    #     list_image_files(test_dir), os.path.join(args.tfrecords_dir, "test"), "test",
+    #     args.height, args.width, args.num_shards, args.num_workers, args.record_format, args.compression
+    #     )
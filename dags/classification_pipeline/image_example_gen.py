@@ -0,0 +1,63 @@
+import os
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+
+from typing import Any, Dict, Text
+
+import apache_beam as beam
+import tensorflow as tf
+from tfx.components.example_gen.base_example_gen_executor import BaseExampleGenExecutor
+
+from classification_pipeline import constants
+from classification_pipeline import convert_data_to_tfrecord as converter
+from pipeline_common.example_counts import ExampleCountsMixin
+
+
+def _image_to_example(filepath: Text) -> tf.train.Example:
+    """Converts an image to a tf.Example, the label is taken from the name of its class directory."""
+    label = converter.get_label_from_directory(os.path.basename(os.path.dirname(filepath)))
+    if constants.RECORD_FORMAT == "raw":
+        height, width = constants.HEIGHT, constants.WIDTH
+    else:
+        height, width = constants.RECORD_HEIGHT, constants.RECORD_WIDTH
+    tf_example, _ = converter.convert_image(filepath, label, height, width, constants.RECORD_FORMAT)
+    return tf_example
+
+
+@beam.ptransform_fn
+@beam.typehints.with_input_types(beam.Pipeline)
+@beam.typehints.with_output_types(tf.train.Example)
+def _ImageToExample(
+    pipeline: beam.Pipeline,
+    exec_properties: Dict[Text, Any],
+    split_pattern: Text) -> beam.pvalue.PCollection:
+    """Reads the images matching split_pattern and transforms them to tf.Examples.
+
+    Args:
+        pipeline: beam pipeline.
+        exec_properties: A dict of execution properties, input_base is the image directory.
+        split_pattern: Split.pattern in Input config, glob pattern of the images relative to input_base,
+                       e.g. "seg_train/*/*".
+
+    Returns:
+        PCollection of tf.Example.
+    """
+    image_pattern = os.path.join(exec_properties["input_base"], split_pattern)
+    image_files = tf.io.gfile.glob(image_pattern)
+    if not image_files:
+        raise RuntimeError("Split pattern {} does not match any files.".format(image_pattern))
+
+    return (
+        pipeline
+        | "CreateFileList" >> beam.Create(sorted(image_files))
+        # Redistribute the file list, so that all workers of the direct runner decode images
+        | "Reshuffle" >> beam.Reshuffle()
+        | "ImageToExample" >> beam.Map(_image_to_example)
+        )
+
+
+class ImageExampleGenExecutor(ExampleCountsMixin, BaseExampleGenExecutor):
+    """ExampleGen executor which converts image directories to tf.Examples inside the Beam pipeline and counts the examples of every split."""
+
+    def GetInputSourceToExamplePTransform(self) -> beam.PTransform:
+        """Returns PTransform for converting images to tf.Examples."""
+        return _ImageToExample
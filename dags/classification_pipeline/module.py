@@ -12,6 +12,7 @@ import tensorflow_transform as tft
 from datetime import datetime
 
 from tfx.components.trainer.executor import TrainerFnArgs
+from pipeline_common import trainer_utils
 
 
 def _transformed_name(key: Text) -> Text:
@@ -27,7 +28,7 @@ def _gzip_reader_fn(filenames):
 def _get_serve_image_fn(model):
   """Returns a function that feeds the input tensor into the model."""
 
-  @tf.function
+  @tf.function(experimental_compile=constants.XLA_COMPILE)
   def serve_image_fn(image_tensor):
     """Returns the output to be used in the serving signature.
     
@@ -43,20 +44,135 @@ def _get_serve_image_fn(model):
   return serve_image_fn
 
 
+def _get_serve_image_bytes_fn(model, tf_transform_output):
+  """Returns a function that applies the transform graph to encoded images and feeds them into the model."""
+
+  # Tracked by the model, so that the transform graph is exported with it
+  model.tft_layer = tf_transform_output.transform_features_layer()
+  # The decode can not be compiled with XLA, only the model call is
+  predict = tf.function(model, experimental_compile=constants.XLA_COMPILE)
+
+  @tf.function
+  def serve_image_bytes_fn(image_bytes):
+    """Returns the output to be used in the image bytes serving signature.
+
+    Args:
+        image_bytes: A string tensor of shape [batch_size] of encoded JPEG images
+                     (or of raw uint8 pixels if constants.RECORD_FORMAT is "raw").
+
+    Returns:
+        The model's predicton on the transformed images
+    """
+    raw_features = {constants.IMAGE_KEY: tf.reshape(image_bytes, [-1, 1])}
+    # Only the image is fed, the parts of the transform graph which depend on other features are pruned
+    transformed_features = model.tft_layer(raw_features)
+    model_inputs = _prepare_model_inputs({
+        _transformed_name(constants.IMAGE_KEY): transformed_features[_transformed_name(constants.IMAGE_KEY)]
+    })
+    return predict(model_inputs[_transformed_name(constants.IMAGE_KEY)])
+
+  return serve_image_bytes_fn
+
+
+def _decode_images(encoded_images: tf.Tensor, channels: int, height: int, width: int) -> tf.Tensor:
+    """Decodes a batch of encoded JPEG images in parallel into a tensor of fixed shape.
+
+    The converter writes all images with the same shape, so every decode has a static output
+    shape and the following resize and mask operations run vectorized over the whole batch.
+    Images of another shape, e.g. sent to the serving signature, are resized to (height, width) first.
+
+    Args:
+        encoded_images: String tensor of shape [batch_size, 1]
+        channels: Number of channels of the decoded images
+        height: Height of the encoded images
+        width: Width of the encoded images
+
+    Returns:
+        uint8 tensor of shape [batch_size, height, width, channels]
+    """
+    image_shape = [height, width, channels]
+
+    def decode(encoded_image):
+        image = tf.io.decode_jpeg(encoded_image[0], channels=channels)
+        image = tf.cond(
+            tf.reduce_all(tf.equal(tf.shape(image)[:2], [height, width])),
+            lambda: image,
+            lambda: tf.cast(tf.image.resize(image, [height, width]), tf.uint8)
+            )
+        return tf.ensure_shape(image, image_shape)
+
+    return tf.map_fn(
+        decode,
+        encoded_images,
+        fn_output_signature=tf.TensorSpec(image_shape, tf.uint8),
+        parallel_iterations=constants.DECODE_PARALLEL_ITERATIONS
+        )
+
+
+def _normalize_images(image_features: tf.Tensor) -> tf.Tensor:
+    """Normalizes a batch of float32 images with pixel values in [0, 255] for the model."""
+    return tf.keras.applications.efficientnet.preprocess_input(image_features)
+
+
+def _encode_transformed_images(image_features: tf.Tensor) -> tf.Tensor:
+    """Stores a batch of float32 images with pixel values in [0, 255] with the precision of constants.TRANSFORMED_IMAGE_DTYPE.
+
+    tf.Transform only outputs int64, float32 and string features, therefore uint8 pixels are stored
+    as int64 and float16 pixels as the int64 of their bit pattern, both as varints of 1 to 3 bytes.
+
+    Args:
+        image_features: float32 tensor of shape [batch_size, HEIGHT, WIDTH, 3]
+
+    Returns:
+        int64 tensor of the same shape
+    """
+    if constants.TRANSFORMED_IMAGE_DTYPE == "uint8":
+        image_features = tf.cast(tf.round(tf.clip_by_value(image_features, 0.0, 255.0)), tf.uint8)
+    else:
+        image_features = tf.bitcast(tf.cast(image_features, tf.float16), tf.uint16)
+    return tf.cast(image_features, tf.int64)
+
+
+def _decode_transformed_images(image_features: tf.Tensor) -> tf.Tensor:
+    """Restores the float32 images stored by _encode_transformed_images and normalizes them.
+
+    Args:
+        image_features: Tensor of transformed images as read from the transformed examples
+
+    Returns:
+        Normalized float32 tensor of shape [batch_size, HEIGHT, WIDTH, 3]
+    """
+    if constants.TRANSFORMED_IMAGE_DTYPE == "float32":
+        # Already normalized by preprocessing_fn
+        return image_features
+    if constants.TRANSFORMED_IMAGE_DTYPE == "uint8":
+        image_features = tf.cast(image_features, tf.float32)
+    else:
+        image_features = tf.cast(tf.bitcast(tf.cast(image_features, tf.uint16), tf.float16), tf.float32)
+    return _normalize_images(image_features)
+
+
 def preprocessing_fn(inputs: Dict[str, Union[tf.Tensor, tf.SparseTensor]]) -> Dict[str, tf.Tensor]:
     """tf.transform's callback function for preprocessing inputs.
     """
     outputs = {}
 
-    image_features = tf.map_fn(
-        lambda x: tf.io.decode_jpeg(x[0], channels=3),
-        inputs[constants.IMAGE_KEY],
-        dtype=tf.uint8
-        )
-
-    # image_features = tf.cast(image_features, tf.float32)
-    image_features = tf.image.resize(image_features, [constants.HEIGHT, constants.WIDTH])
-    image_features = tf.keras.applications.efficientnet.preprocess_input(image_features)
+    if constants.RECORD_FORMAT == "raw":
+        # Images are already decoded and resized by convert_data_to_tfrecord.py
+        image_features = tf.io.decode_raw(inputs[constants.IMAGE_KEY], tf.uint8)
+        image_features = tf.reshape(image_features, [-1, constants.HEIGHT, constants.WIDTH, 3])
+        image_features = tf.cast(image_features, tf.float32)
+    else:
+        image_features = _decode_images(
+            inputs[constants.IMAGE_KEY], 3, constants.RECORD_HEIGHT, constants.RECORD_WIDTH)
+
+        # image_features = tf.cast(image_features, tf.float32)
+        image_features = tf.image.resize(image_features, [constants.HEIGHT, constants.WIDTH])
+    if constants.TRANSFORMED_IMAGE_DTYPE == "float32":
+        image_features = _normalize_images(image_features)
+    else:
+        # Stored with reduced precision, the Trainer normalizes the images in _input_fn
+        image_features = _encode_transformed_images(image_features)
 
     outputs[_transformed_name(constants.IMAGE_KEY)] = image_features
     # TODO(b/157064428): Support label transformation for Keras.
@@ -96,39 +212,156 @@ def _data_augmentation(feature_dict):
     return feature_dict
 
 
+def _input_pipeline_profile() -> Union[Dict, None]:
+    """Returns the tf.data settings of constants.INPUT_PIPELINE_PROFILE, None for the defaults."""
+    return constants.INPUT_PIPELINE_PROFILES[constants.INPUT_PIPELINE_PROFILE]
+
+
+def _num_parallel_calls() -> Union[int, None]:
+    """Returns the num_parallel_calls of the dataset maps of _input_fn."""
+    profile = _input_pipeline_profile()
+    return profile["num_parallel_calls"] if profile else None
+
+
+def _cache_key(file_pattern: List[Text], tf_transform_output: tft.TFTransformOutput, **settings) -> Text:
+    """Returns the trainer_utils.cache_key of the input, which also depends on constants.MATERIALIZE_TRANSFORMED."""
+    return trainer_utils.cache_key(
+        file_pattern, tf_transform_output, materialize_transformed=constants.MATERIALIZE_TRANSFORMED, **settings)
+
+
+def _prepare_model_inputs(feature_dict):
+    """Restores the float32 normalized images of a batch of transformed features.
+
+    Args:
+        feature_dict: a dict containing features of samples
+
+    Returns:
+        The feature dict with the model inputs
+    """
+    feature_dict[_transformed_name(constants.IMAGE_KEY)] = _decode_transformed_images(
+        feature_dict[_transformed_name(constants.IMAGE_KEY)])
+    return feature_dict
+
+
+def _stratified_dataset(file_pattern: List[Text],
+                        feature_spec: Dict,
+                        batch_size: int) -> tf.data.Dataset:
+    """Builds one dataset per class split and mixes them with sample_from_datasets into balanced batches.
+
+    Args:
+        file_pattern: List of input tfrecord file patterns, the patterns of all examples artifacts of a class
+                      follow each other in the order of constants.CLASS_NAMES
+        feature_spec: Feature spec of the examples
+        batch_size: representing the number of consecutive elements of returned
+                    dataset to combine in a single batch
+
+    Returns:
+        A dataset that contains dictionaries of batched feature Tensors.
+    """
+    # With USE_SPANS the Trainer resolves up to SPAN_WINDOW examples artifacts and lists the patterns
+    # split by split, i.e. [class 0 of every artifact, class 1 of every artifact, ...]
+    if len(file_pattern) % len(constants.CLASS_NAMES):
+        raise ValueError("Expected the same number of file patterns for each of the {} classes, got {}".format(
+            len(constants.CLASS_NAMES), len(file_pattern)))
+    patterns_per_class = len(file_pattern) // len(constants.CLASS_NAMES)
+
+    class_datasets = []
+    for start in range(0, len(file_pattern), patterns_per_class):
+        class_dataset = tf.data.Dataset.list_files(file_pattern[start:start + patterns_per_class], shuffle=True)
+        class_dataset = class_dataset.interleave(_gzip_reader_fn, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+        class_datasets.append(class_dataset.repeat().shuffle(constants.STRATIFIED_SHUFFLE_BUFFER))
+
+    weights = constants.CLASS_SAMPLING_WEIGHTS or [1.0 / len(class_datasets)] * len(class_datasets)
+    dataset = tf.data.experimental.sample_from_datasets(class_datasets, weights=weights)
+
+    def parse_batch(serialized_examples):
+        return tf.io.parse_example(serialized_examples, feature_spec)
+
+    dataset = dataset.batch(batch_size).map(parse_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
 def _input_fn(file_pattern: List[Text], 
               tf_transform_output: tft.TFTransformOutput, 
               batch_size: int = 8, 
-              is_train: bool = False) -> tf.data.Dataset:
+              is_train: bool = False,
+              stratified: bool = False,
+              num_epochs: Union[int, None] = None) -> tf.data.Dataset:
     """Generates features and label for tuning/training.
 
     Args:
-        file_pattern: input tfrecord file pattern.
+        file_pattern: input tfrecord file pattern, of the raw examples if not constants.MATERIALIZE_TRANSFORMED.
         tf_transform_output: A TFTransformOutput.
         batch_size: representing the number of consecutive elements of returned
                     dataset to combine in a single batch
         is_train: Whether the input dataset is train split or not
+        stratified: Whether file_pattern holds the patterns of every class which are sampled into balanced batches
+        num_epochs: Number of passes over the examples, None repeats them indefinitely
 
     Returns:
         A dataset that contains (features, indices) tuple where features is a
         dictionary of Tensors, and indices is a single Tensor of label indices.
     """
-    transformed_feature_spec = (
-        tf_transform_output.transformed_feature_spec().copy())
-
-    dataset = tf.data.experimental.make_batched_features_dataset(
-        file_pattern=file_pattern,
-        batch_size=batch_size,
-        features=transformed_feature_spec,
-        reader=_gzip_reader_fn,
-        label_key=_transformed_name(constants.LABEL_KEY))
+    if constants.MATERIALIZE_TRANSFORMED:
+        feature_spec = tf_transform_output.transformed_feature_spec().copy()
+        tft_layer = None
+    else:
+        # Transform only wrote the transform graph, the raw examples are transformed on the fly
+        feature_spec = tf_transform_output.raw_feature_spec().copy()
+        tft_layer = tf_transform_output.transform_features_layer()
+
+    # The mix of the stratified datasets never ends and can not be cached
+    cache_path = None
+    if constants.DATASET_CACHE_DIR and not stratified:
+        # The workers of a multi-worker Trainer read different shards of the same files
+        key = _cache_key(file_pattern, tf_transform_output, batch_size=batch_size, is_train=is_train, task=_tf_config().get("task"))
+        cache_path = trainer_utils.dataset_cache_path(constants.DATASET_CACHE_DIR, key, constants.DATASET_CACHE_MAX_BYTES)
+
+    if stratified:
+        dataset = _stratified_dataset(file_pattern, feature_spec, batch_size)
+    else:
+        dataset = trainer_utils.read_examples(
+            file_pattern, feature_spec, batch_size, is_train, _input_pipeline_profile(), num_epochs=1 if cache_path else num_epochs)
+
+    def to_model_inputs(features):
+        if tft_layer is not None:
+            features = dict(tft_layer(features))
+        label = features.pop(_transformed_name(constants.LABEL_KEY))
+        return _prepare_model_inputs(features), label
+
+    dataset = dataset.map(to_model_inputs, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    if cache_path:
+        # The cache is written before training, the augmentation after it still differs in every epoch
+        dataset = trainer_utils.fill_dataset_cache(dataset, cache_path, _tf_config())
+        if is_train:
+            dataset = dataset.shuffle(constants.DATASET_CACHE_SHUFFLE_BATCHES)
+        dataset = dataset.repeat(num_epochs)
 
     if is_train:
-        dataset = dataset.map(lambda x, y: (_data_augmentation(x), y))
+        dataset = dataset.map(lambda x, y: (_data_augmentation(x), y), num_parallel_calls=_num_parallel_calls())
 
+    if _input_pipeline_profile():
+        dataset = dataset.prefetch(_input_pipeline_profile()["prefetch_buffer_size"])
     return dataset
 
 
+def _tf_config() -> Dict:
+    """Returns the parsed TF_CONFIG of a multi-worker Trainer, empty for a single process."""
+    if not constants.MULTI_WORKER_TRAINING:
+        return {}
+    return trainer_utils.parse_tf_config()
+
+
+def _compile(model: tf.keras.Model):
+    """Compiles the classification model or its head."""
+    model.compile(optimizer=tf.optimizers.RMSprop(lr=0.01),
+        loss="sparse_categorical_crossentropy",
+        metrics=["sparse_categorical_accuracy"])
+    if constants.XLA_COMPILE:
+        trainer_utils.compile_train_step(model)
+
+
 def get_model(fn_args) -> tf.keras.Model:
     """Creates a CNN Keras model based on transfer learning for classifying image data.
 
@@ -137,14 +370,14 @@ def get_model(fn_args) -> tf.keras.Model:
     """
     img_shape = (constants.HEIGHT, constants.WIDTH, 3)
 
-    # Create the base model from the pre-trained model EfficientNetB3
-    base_model = tf.keras.applications.EfficientNetB3(
+    # Create the base model from the pre-trained model of constants.BACKBONE_NAME
+    base_model = getattr(tf.keras.applications, constants.BACKBONE_NAME)(
         input_shape=img_shape,
         include_top=False,
         weights=constants.PRETRAINED_WEIGHTS,
     )
     
-    base_model.trainable = False
+    base_model.trainable = constants.BACKBONE_TRAINABLE
     # base_model.summary()
     global_average_layer = tf.keras.layers.GlobalAveragePooling2D()
       
@@ -154,55 +387,193 @@ def get_model(fn_args) -> tf.keras.Model:
         base_model,
         global_average_layer,
         tf.keras.layers.Dropout(0.15),
-        tf.keras.layers.Dense(6, activation="softmax")
+        # The softmax stays float32 with a mixed precision policy
+        tf.keras.layers.Dense(len(constants.CLASS_NAMES), activation="softmax", dtype="float32")
     ])
 
-    model.compile(optimizer=tf.optimizers.RMSprop(lr=0.01),
-        loss="sparse_categorical_crossentropy",
-        metrics=["sparse_categorical_accuracy"])
+    _compile(model)
     model.summary(print_fn=absl.logging.info)
     
     return model
 
 
+def _use_feature_cache() -> bool:
+    """Returns whether the head is trained on cached backbone embeddings."""
+    if not constants.FEATURE_CACHE:
+        return False
+    if constants.BACKBONE_TRAINABLE or constants.STRATIFIED_SAMPLING:
+        absl.logging.info('The backbone is trainable or the classes are sampled, training on the images instead of the feature cache')
+        return False
+    return True
+
+
+def _embedding_file(fn_args: TrainerFnArgs,
+                    file_pattern: List[Text],
+                    tf_transform_output: tft.TFTransformOutput) -> Text:
+    """Returns the file of the cached embeddings of the examples of file_pattern.
+
+    The file is keyed by the backbone, its weights and the input, so every run with the same backbone
+    and examples reuses the embeddings of the first run.
+
+    Args:
+        fn_args: Holds args used to train the model as name/value pairs.
+        file_pattern: input tfrecord file pattern.
+        tf_transform_output: A TFTransformOutput.
+
+    Returns:
+        Path of the TFRecord file of the embeddings
+    """
+    cache_root = constants.FEATURE_CACHE_DIR or (fn_args.custom_config or {}).get("feature_cache_root")
+    if not cache_root:
+        cache_root = os.path.join(os.path.dirname(fn_args.serving_model_dir), "feature_cache")
+    key = _cache_key(
+        file_pattern,
+        tf_transform_output,
+        backbone=constants.BACKBONE_NAME,
+        weights=constants.PRETRAINED_WEIGHTS,
+        shape=[constants.HEIGHT, constants.WIDTH])
+    return os.path.join(cache_root, "{}-{}.tfrecords".format(constants.BACKBONE_NAME, key))
+
+
+def _write_embeddings(embedding_model: tf.keras.Model,
+                      file_pattern: List[Text],
+                      tf_transform_output: tft.TFTransformOutput,
+                      embedding_file: Text):
+    """Writes the float16 pooled backbone embedding and the label of every example to embedding_file.
+
+    Args:
+        embedding_model: Maps a batch of images to their pooled backbone embeddings
+        file_pattern: input tfrecord file pattern.
+        tf_transform_output: A TFTransformOutput.
+        embedding_file: Path of the TFRecord file
+    """
+    tf.io.gfile.makedirs(os.path.dirname(embedding_file))
+    # Written under a temporary name, so an interrupted run never leaves an incomplete cache behind
+    temp_file = "{}.tmp-{}".format(embedding_file, os.getpid())
+    num_examples = 0
+    with tf.io.TFRecordWriter(temp_file) as writer:
+        for features, labels in _input_fn(file_pattern, tf_transform_output, constants.TRAIN_BATCH_SIZE, num_epochs=1):
+            embeddings = embedding_model(features[_transformed_name(constants.IMAGE_KEY)], training=False)
+            for embedding, label in zip(tf.cast(embeddings, tf.float16).numpy(), labels.numpy().reshape(-1)):
+                example = tf.train.Example(features=tf.train.Features(feature={
+                    "embedding": tf.train.Feature(bytes_list=tf.train.BytesList(value=[embedding.tobytes()])),
+                    "label": tf.train.Feature(int64_list=tf.train.Int64List(value=[int(label)])),
+                }))
+                writer.write(example.SerializeToString())
+                num_examples += 1
+    tf.io.gfile.rename(temp_file, embedding_file, overwrite=True)
+    absl.logging.info('Cached the embeddings of {} examples in {}'.format(num_examples, embedding_file))
+
+
+def _embedding_dataset(embedding_file: Text, batch_size: int, is_train: bool = False) -> tf.data.Dataset:
+    """Generates embeddings and labels from the feature cache.
+
+    Args:
+        embedding_file: Path of the TFRecord file of _write_embeddings
+        batch_size: representing the number of consecutive elements of returned
+                    dataset to combine in a single batch
+        is_train: Whether the input dataset is train split or not
+
+    Returns:
+        A dataset that contains (embeddings, labels) tuples of float32 embeddings.
+    """
+    feature_spec = {
+        "embedding": tf.io.FixedLenFeature([], tf.string),
+        "label": tf.io.FixedLenFeature([], tf.int64),
+    }
+
+    def parse_batch(serialized_examples):
+        features = tf.io.parse_example(serialized_examples, feature_spec)
+        return tf.cast(tf.io.decode_raw(features["embedding"], tf.float16), tf.float32), features["label"]
+
+    # The embeddings are small enough to be kept in memory after the first epoch
+    dataset = tf.data.TFRecordDataset(embedding_file).cache()
+    if is_train:
+        dataset = dataset.shuffle(constants.FEATURE_CACHE_SHUFFLE_BUFFER)
+    dataset = dataset.repeat().batch(batch_size)
+    dataset = dataset.map(parse_batch, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return dataset.prefetch(tf.data.experimental.AUTOTUNE)
+
+
+def _fit_head_on_feature_cache(model: tf.keras.Model,
+                               fn_args: TrainerFnArgs,
+                               tf_transform_output: tft.TFTransformOutput,
+                               **fit_kwargs):
+    """Trains the layers after the frozen backbone on the cached backbone embeddings.
+
+    The head shares its layers with model, so model is trained as well and is exported as usual.
+
+    Args:
+        model: The model of get_model
+        fn_args: Holds args used to train the model as name/value pairs.
+        tf_transform_output: A TFTransformOutput.
+        fit_kwargs: Arguments of model.fit besides the datasets
+    """
+    # The first two layers are the backbone and the pooling
+    embedding_model = tf.keras.Model(model.inputs, model.layers[1].output)
+    with model.distribute_strategy.scope():
+        head = tf.keras.Sequential([tf.keras.layers.Input(shape=embedding_model.output_shape[1:])] + model.layers[2:])
+        _compile(head)
+
+    num_replicas = model.distribute_strategy.num_replicas_in_sync
+    datasets = []
+    for files, batch_size, is_train in [(fn_args.train_files, constants.TRAIN_BATCH_SIZE * num_replicas, True),
+                                        (fn_args.eval_files, constants.EVAL_BATCH_SIZE * num_replicas, False)]:
+        embedding_file = _embedding_file(fn_args, files, tf_transform_output)
+        if not tf.io.gfile.exists(embedding_file):
+            _write_embeddings(embedding_model, files, tf_transform_output, embedding_file)
+        else:
+            absl.logging.info('Reading the cached embeddings of {}'.format(embedding_file))
+        datasets.append(_embedding_dataset(embedding_file, batch_size, is_train))
+
+    for callback in fit_kwargs.get("callbacks", []):
+        if isinstance(callback, trainer_utils.PerformanceCallback):
+            # The compute time is measured on the inputs of the head
+            callback.dataset = datasets[0]
+
+    head.fit(datasets[0], validation_data=datasets[1], **fit_kwargs)
+
+
 def run_fn(fn_args: TrainerFnArgs):
     """Train the model based on given args.
 
     Args:
         fn_args: Holds args used to train the model as name/value pairs.
     """
+    # MultiWorkerMirroredStrategy has to be created before any other op
+    strategy = trainer_utils.get_distribution_strategy(_tf_config(), constants.MULTI_WORKER_COMMUNICATION)
+    trainer_utils.set_mixed_precision_policy(constants.MIXED_PRECISION_POLICY)
+    # Every worker reads batches of the configured size, the model steps on the global batch
+    train_batch_size = constants.TRAIN_BATCH_SIZE * strategy.num_replicas_in_sync
+    eval_batch_size = constants.EVAL_BATCH_SIZE * strategy.num_replicas_in_sync
+
     tf_transform_output = tft.TFTransformOutput(fn_args.transform_output)
 
+    # The datasets are auto-sharded across the workers, by file if there are enough files, otherwise by example
     train_dataset = _input_fn(
         fn_args.train_files,
         tf_transform_output,
-        constants.TRAIN_BATCH_SIZE,
-        is_train=True
+        train_batch_size,
+        is_train=True,
+        stratified=constants.STRATIFIED_SAMPLING
     )
 
     eval_dataset = _input_fn(
         fn_args.eval_files,
         tf_transform_output,
-        constants.EVAL_BATCH_SIZE,
+        eval_batch_size,
         is_train=False
     )
 
-    # # check for availabe tpu and gpu units
-    # try:
-    #   tpu = tf.distribute.cluster_resolver.TPUClusterResolver()
-    #   tf.config.experimental_connect_to_cluster(tpu)
-    #   tf.tpu.experimental.initialize_tpu_system(tpu)
-    #   strategy = tf.distribute.experimental.TPUStrategy(tpu)
-    # except ValueError:
-    #   strategy = tf.distribute.MirroredStrategy()
-
-    # with strategy.scope():
-    model = get_model(fn_args)
+    with strategy.scope():
+        model = get_model(fn_args)
+        trainer_utils.warm_start(model, fn_args, constants.WARM_START)
 
     try:
         log_dir = fn_args.model_run_dir
     except KeyError:
         log_dir = os.path.join(os.path.dirname(fn_args.serving_model_dir), "logs")
+    log_dir = trainer_utils.worker_path(log_dir, _tf_config())
 
     absl.logging.info('Tensorboard logging to {}'.format(log_dir))
 
@@ -210,19 +581,59 @@ def run_fn(fn_args: TrainerFnArgs):
                 #  tf.keras.callbacks.ModelCheckpoint("DeepLabV3plus.ckpt", verbose=1, save_weights_only=True, save_best_only=True),
                  tf.keras.callbacks.ReduceLROnPlateau(monitor="iou_score", factor=0.2, patience=6, verbose=1, mode="max"),
                  tf.keras.callbacks.EarlyStopping(monitor="iou_score", patience=16, mode="max", verbose=1, restore_best_weights=True),
-                 tf.keras.callbacks.TensorBoard(log_dir=log_dir, update_freq="batch")
+                 tf.keras.callbacks.TensorBoard(
+                     log_dir=log_dir,
+                     update_freq="batch",
+                     # The profile tab of TensorBoard then contains the input pipeline analysis,
+                     # only one profiler can run at a time, PROFILE_STEPS traces in the PerformanceCallback
+                     profile_batch=0 if constants.PROFILE_STEPS else (
+                         constants.INPUT_PIPELINE_PROFILE_BATCHES if constants.INPUT_PIPELINE_STATS else 2)
+                     )
     ]
+    if constants.BACKUP_AND_RESTORE:
+        # Restores the model and the epoch of an interrupted attempt and removes the backup after training
+        key = _cache_key(
+            list(fn_args.train_files) + list(fn_args.eval_files),
+            tf_transform_output,
+            backbone=constants.BACKBONE_NAME,
+            feature_cache=_use_feature_cache(),
+            warm_start=constants.WARM_START)
+        callbacks.append(tf.keras.callbacks.experimental.BackupAndRestore(trainer_utils.backup_dir(fn_args, key, constants.BACKUP_DIR)))
+    if constants.PERFORMANCE_SUMMARY:
+        callbacks.append(trainer_utils.PerformanceCallback(
+            train_dataset,
+            train_batch_size,
+            log_dir,
+            summary_file=os.path.join(os.path.dirname(fn_args.serving_model_dir), "performance.json") if trainer_utils.is_chief(_tf_config()) else None,
+            probe_steps=constants.PERFORMANCE_PROBE_STEPS,
+            profile_steps=constants.PROFILE_STEPS
+        ))
 
     absl.logging.info('Start training the top classifier')
     
-    model.fit(
-        train_dataset,
-        epochs=constants.EPOCHS,
-        steps_per_epoch=fn_args.train_steps,
-        validation_data=eval_dataset,
-        validation_steps=fn_args.eval_steps,
-        callbacks=callbacks
-    )
+    train_steps = trainer_utils.num_steps(trainer_utils.num_examples(fn_args.train_files), train_batch_size, fn_args.train_steps)
+    eval_steps = trainer_utils.num_steps(trainer_utils.num_examples(fn_args.eval_files), eval_batch_size, fn_args.eval_steps)
+    absl.logging.info('Training for {} steps per epoch with {} validation steps'.format(train_steps, eval_steps))
+
+    if _use_feature_cache():
+        _fit_head_on_feature_cache(
+            model,
+            fn_args,
+            tf_transform_output,
+            epochs=constants.EPOCHS,
+            steps_per_epoch=train_steps,
+            validation_steps=eval_steps,
+            callbacks=callbacks
+        )
+    else:
+        model.fit(
+            train_dataset,
+            epochs=constants.EPOCHS,
+            steps_per_epoch=train_steps,
+            validation_data=eval_dataset,
+            validation_steps=eval_steps,
+            callbacks=callbacks
+        )
 
     signatures = {
         'serving_default':
@@ -232,7 +643,20 @@ def run_fn(fn_args: TrainerFnArgs):
                     dtype=tf.float32,
                     name=_transformed_name(constants.IMAGE_KEY)
                 )
+            ),
+        # Accepts the encoded images and applies decode, resize and normalization in-graph
+        'serving_image_bytes':
+            _get_serve_image_bytes_fn(model, tf_transform_output).get_concrete_function(
+                tf.TensorSpec(
+                    shape=[None],
+                    dtype=tf.string,
+                    name=constants.IMAGE_KEY
+                )
             )
     }
 
-    model.save(fn_args.serving_model_dir, save_format='tf', signatures=signatures)
\ No newline at end of file
+    # Every worker has to save the model, only the model of the chief is kept
+    model_dir = trainer_utils.worker_path(fn_args.serving_model_dir, _tf_config())
+    model.save(model_dir, save_format='tf', signatures=signatures)
+    if not trainer_utils.is_chief(_tf_config()):
+        tf.io.gfile.rmtree(model_dir)
\ No newline at end of file
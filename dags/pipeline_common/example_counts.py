@@ -0,0 +1,95 @@
+"""ExampleGen and Transform executors which store the number of examples of every split in their artifacts.
+
+The Trainer derives its steps per epoch from these counts with trainer_utils.num_examples. They are
+part of the Examples artifacts, so they always match the artifacts the Trainer resolved, e.g. the
+spans of the rolling window.
+"""
+import os
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+
+from typing import Any, Dict, List, Text
+
+import json
+import apache_beam as beam
+import tensorflow as tf
+from tfx import types
+from tfx.components import ImportExampleGen, Transform
+from tfx.components.base import executor_spec
+from tfx.components.example_gen import utils
+from tfx.components.example_gen.import_example_gen import executor as import_example_gen_executor
+from tfx.components.transform import executor as transform_executor
+from tfx.types import artifact_utils
+
+from pipeline_common import trainer_utils
+
+
+def _write_count(num_records: int, count_file: Text):
+    """Writes the number of examples of a split."""
+    tf.io.gfile.makedirs(os.path.dirname(count_file))
+    with tf.io.gfile.GFile(count_file, "w") as f:
+        json.dump({"num_records": int(num_records)}, f)
+
+
+class ExampleCountsMixin(object):
+    """Counts the examples of every split in the Beam pipeline of an ExampleGen executor.
+
+    Has to precede the ExampleGen executor in the bases, e.g.
+    class Executor(ExampleCountsMixin, BaseExampleGenExecutor).
+    """
+
+    def Do(self,
+           input_dict: Dict[Text, List[types.Artifact]],
+           output_dict: Dict[Text, List[types.Artifact]],
+           exec_properties: Dict[Text, Any]) -> None:
+        # GenerateExamplesByBeam only receives the exec_properties
+        self._examples_uri = artifact_utils.get_single_uri(output_dict[utils.EXAMPLES_KEY])
+        super(ExampleCountsMixin, self).Do(input_dict, output_dict, exec_properties)
+
+    def GenerateExamplesByBeam(self,
+                               pipeline: beam.Pipeline,
+                               exec_properties: Dict[Text, Any]) -> Dict[Text, beam.pvalue.PCollection]:
+        example_splits = super(ExampleCountsMixin, self).GenerateExamplesByBeam(pipeline, exec_properties)
+        for split_name, example_split in example_splits.items():
+            (example_split
+             | "CountSplit[{}]".format(split_name) >> beam.combiners.Count.Globally()
+             | "WriteCount[{}]".format(split_name) >> beam.Map(
+                 _write_count, trainer_utils.counts_file(self._examples_uri, split_name)))
+        return example_splits
+
+
+class ImportExampleGenExecutor(ExampleCountsMixin, import_example_gen_executor.Executor):
+    """ImportExampleGen executor which counts the examples of every split."""
+
+
+class CountingImportExampleGen(ImportExampleGen):
+    """ImportExampleGen component whose examples carry the counts of their splits."""
+
+    EXECUTOR_SPEC = executor_spec.ExecutorClassSpec(ImportExampleGenExecutor)
+
+
+class TransformExecutor(transform_executor.Executor):
+    """Transform executor which copies the counts of the examples to the transformed examples."""
+
+    def Do(self,
+           input_dict: Dict[Text, List[types.Artifact]],
+           output_dict: Dict[Text, List[types.Artifact]],
+           exec_properties: Dict[Text, Any]) -> None:
+        super(TransformExecutor, self).Do(input_dict, output_dict, exec_properties)
+        if not output_dict.get(transform_executor.TRANSFORMED_EXAMPLES_KEY):
+            return
+
+        examples = artifact_utils.get_single_instance(input_dict[transform_executor.EXAMPLES_KEY])
+        transformed_examples = artifact_utils.get_single_instance(output_dict[transform_executor.TRANSFORMED_EXAMPLES_KEY])
+        # The preprocessing_fn maps every example to exactly one transformed example
+        for split in artifact_utils.decode_split_names(transformed_examples.split_names):
+            count_file = trainer_utils.counts_file(examples.uri, split)
+            if tf.io.gfile.exists(count_file):
+                transformed_count_file = trainer_utils.counts_file(transformed_examples.uri, split)
+                tf.io.gfile.makedirs(os.path.dirname(transformed_count_file))
+                tf.io.gfile.copy(count_file, transformed_count_file, overwrite=True)
+
+
+class CountingTransform(Transform):
+    """Transform component whose transformed examples carry the counts of the examples."""
+
+    EXECUTOR_SPEC = executor_spec.ExecutorClassSpec(TransformExecutor)
@@ -0,0 +1,108 @@
+"""ExampleGen components which ingest the spans of "convert_data_to_tfrecord.py --incremental" one after another.
+
+The number of the last span a run trained on and pushed is stored in "trained_span.json" of the pipeline
+root. The span sensor of the DAG waits for the span after it, the driver of ExampleGen ingests exactly
+that span and the last task of the DAG records it once the Pusher succeeded. A failed run records
+nothing, so the next run retries the same span, and no span is skipped if several arrive between two runs.
+"""
+import json
+import os
+import re
+from typing import Any, Dict, Text
+
+from tfx.components import FileBasedExampleGen
+from tfx.components.example_gen import driver, utils
+from tfx.orchestration import data_types
+from tfx.proto import example_gen_pb2
+
+from google.protobuf import json_format
+
+from pipeline_common.example_counts import CountingImportExampleGen
+
+
+def latest_complete_span(input_base: Text) -> int:
+    """Returns the number of the latest complete span of an input directory.
+
+    The converter only updates the manifest once all shards of a span are written, so spans which are
+    still being written are never reported. Directories without a manifest, e.g. the image directories
+    of ImageExampleGenExecutor, report their highest "span-N" directory.
+
+    Args:
+        input_base: String of the tfrecords or image directory
+
+    Returns:
+        Int - number of the latest span, -1 if no span was written yet
+    """
+    manifest_file = os.path.join(input_base, "manifest.json")
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            return json.load(f)["last_span"]
+    if not os.path.isdir(input_base):
+        return -1
+    spans = [int(name[len("span-"):]) for name in os.listdir(input_base) if re.match(r"^span-\d+$", name)]
+    return max(spans, default=-1)
+
+
+def last_trained_span(pipeline_root: Text) -> int:
+    """Returns the number of the last span which was trained on and pushed, -1 before the first run."""
+    state_file = os.path.join(pipeline_root, "trained_span.json")
+    if not os.path.exists(state_file):
+        return -1
+    with open(state_file) as f:
+        return json.load(f)["last_span"]
+
+
+def record_trained_span(pipeline_root: Text, span: int):
+    """Records span as trained on and pushed, the next run ingests the span after it."""
+    os.makedirs(pipeline_root, exist_ok=True)
+    state_file = os.path.join(pipeline_root, "trained_span.json")
+    with open(state_file + ".tmp", "w") as f:
+        json.dump({"last_span": span}, f)
+    os.replace(state_file + ".tmp", state_file)
+
+
+def next_span(input_base: Text, pipeline_root: Text) -> int:
+    """Returns the span the next run ingests or -1 if there is no complete span after the last trained one."""
+    span = last_trained_span(pipeline_root) + 1
+    return span if span <= latest_complete_span(input_base) else -1
+
+
+class NextSpanDriver(driver.Driver):
+    """ExampleGen driver which resolves {SPAN} to the span after the last trained one instead of the latest span."""
+
+    def resolve_exec_properties(self,
+                                exec_properties: Dict[Text, Any],
+                                pipeline_info: data_types.PipelineInfo,
+                                component_info: data_types.ComponentInfo) -> Dict[Text, Any]:
+        input_base = exec_properties[utils.INPUT_BASE_KEY]
+        span = next_span(input_base, pipeline_info.pipeline_root)
+        if span < 0:
+            # Without the span sensor, e.g. with the BeamDagRunner, a run without a new span trains on the latest span again
+            span = latest_complete_span(input_base)
+        if span < 0:
+            raise RuntimeError("No complete span in {}".format(input_base))
+
+        input_config = example_gen_pb2.Input()
+        json_format.Parse(exec_properties[utils.INPUT_CONFIG_KEY], input_config)
+        for split in input_config.splits:
+            split.pattern = split.pattern.replace(utils.SPAN_SPEC, str(span))
+        exec_properties[utils.INPUT_CONFIG_KEY] = json_format.MessageToJson(
+            input_config, sort_keys=True, preserving_proto_field_name=True)
+
+        exec_properties = super(NextSpanDriver, self).resolve_exec_properties(
+            exec_properties, pipeline_info, component_info)
+        # The patterns no longer contain {SPAN}, so the base driver reports span 0
+        exec_properties[utils.SPAN_PROPERTY_NAME] = span
+        return exec_properties
+
+
+class NextSpanImportExampleGen(CountingImportExampleGen):
+    """ImportExampleGen which ingests the span after the last trained one."""
+
+    DRIVER_CLASS = NextSpanDriver
+
+
+class NextSpanFileBasedExampleGen(FileBasedExampleGen):
+    """FileBasedExampleGen which ingests the span after the last trained one."""
+
+    DRIVER_CLASS = NextSpanDriver
@@ -0,0 +1,74 @@
+from airflow.operators.python_operator import PythonOperator
+from airflow.sensors.base_sensor_operator import BaseSensorOperator
+from airflow.utils.decorators import apply_defaults
+
+from pipeline_common.span_example_gen import next_span, record_trained_span
+
+
+class NewSpanSensor(BaseSensorOperator):
+    """Waits until the span after the last trained one is complete in input_base.
+
+    The sensor only reads the state in "trained_span.json" of the pipeline root and passes the span to the
+    record_trained_span task by XCom, the state is only updated once the whole run succeeded.
+    """
+
+    @apply_defaults
+    def __init__(self, input_base, pipeline_root, *args, **kwargs):
+        super(NewSpanSensor, self).__init__(*args, **kwargs)
+        self.input_base = input_base
+        self.pipeline_root = pipeline_root
+
+    def poke(self, context):
+        span = next_span(self.input_base, self.pipeline_root)
+        self.log.info("Next span to ingest %s", span if span >= 0 else "not complete yet")
+        if span < 0:
+            return False
+        context["ti"].xcom_push(key="span", value=span)
+        return True
+
+
+def _record_trained_span(pipeline_root, sensor_task_id, **context):
+    """Records the span the sensor of this run passed on as trained on and pushed."""
+    span = context["ti"].xcom_pull(task_ids=sensor_task_id, key="span")
+    record_trained_span(pipeline_root, span)
+
+
+def add_span_sensor(dag, input_base, pipeline_root, poke_interval, timeout):
+    """Adds a NewSpanSensor upstream of all root tasks and a task recording the span downstream of all leaves.
+
+    Args:
+        dag: Airflow DAG created by the AirflowDagRunner, with max_active_runs 1
+        input_base: String of the directory the ExampleGen reads the spans from
+        pipeline_root: String of the pipeline root holding the last trained span
+        poke_interval: Int seconds between two checks
+        timeout: Int seconds after which the run is skipped if no new span arrived
+
+    Returns:
+        The NewSpanSensor task
+    """
+    roots = list(dag.roots)
+    leaves = list(dag.leaves)
+    sensor = NewSpanSensor(
+        task_id="new_span_sensor",
+        input_base=input_base,
+        pipeline_root=pipeline_root,
+        poke_interval=poke_interval,
+        timeout=timeout,
+        mode="reschedule",
+        soft_fail=True,
+        dag=dag,
+        )
+    for task in roots:
+        sensor.set_downstream(task)
+
+    # Only runs if all tasks, the Pusher included, succeeded, a failed run retries the same span
+    record_span = PythonOperator(
+        task_id="record_trained_span",
+        python_callable=_record_trained_span,
+        op_kwargs={"pipeline_root": pipeline_root, "sensor_task_id": sensor.task_id},
+        provide_context=True,
+        dag=dag,
+        )
+    for task in leaves:
+        task.set_downstream(record_span)
+    return sensor
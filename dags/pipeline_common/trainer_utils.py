@@ -0,0 +1,449 @@
+"""Trainer helpers shared by the run_fn of the classification and the segmentation pipeline.
+
+None of the helpers reads the constants of a pipeline, the module.py of each pipeline passes its settings in.
+"""
+import os
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+
+from typing import Dict, List, Text, Union
+
+import absl
+import hashlib
+import json
+import math
+import resource
+import shutil
+import time
+import numpy as np
+import tensorflow as tf
+import tensorflow_transform as tft
+
+
+def gzip_reader_fn(filenames):
+    """Small utility returning a record reader that can read gzip'ed files."""
+    return tf.data.TFRecordDataset(filenames, compression_type='GZIP')
+
+
+def read_examples(file_pattern: List[Text],
+                  feature_spec: Dict,
+                  batch_size: int,
+                  is_train: bool,
+                  profile: Union[Dict, None],
+                  num_epochs: Union[int, None] = None,
+                  **default_kwargs) -> tf.data.Dataset:
+    """Reads and parses batches of examples with the tf.data settings of an input pipeline profile.
+
+    Args:
+        file_pattern: input tfrecord file pattern.
+        feature_spec: Feature spec of the examples
+        batch_size: representing the number of consecutive elements of returned
+                    dataset to combine in a single batch
+        is_train: Whether the examples are shuffled and may be read in a non-deterministic order
+        profile: Entry of INPUT_PIPELINE_PROFILES, None reads with make_batched_features_dataset
+        num_epochs: Number of passes over the files, None repeats them indefinitely
+        default_kwargs: Additional arguments of make_batched_features_dataset if profile is None
+
+    Returns:
+        A dataset that contains dictionaries of batched feature Tensors.
+    """
+    if profile is None:
+        return tf.data.experimental.make_batched_features_dataset(
+            file_pattern=file_pattern,
+            batch_size=batch_size,
+            features=feature_spec,
+            reader=gzip_reader_fn,
+            num_epochs=num_epochs,
+            **default_kwargs)
+
+    dataset = tf.data.Dataset.list_files(file_pattern, shuffle=is_train)
+    dataset = dataset.interleave(
+        gzip_reader_fn,
+        cycle_length=profile["interleave_cycle_length"],
+        num_parallel_calls=profile["num_parallel_calls"])
+    if is_train:
+        dataset = dataset.shuffle(profile["shuffle_buffer_size"])
+    dataset = dataset.repeat(num_epochs)
+    # Parsing whole batches is much cheaper than parsing single examples
+    dataset = dataset.batch(batch_size).map(
+        lambda serialized_examples: tf.io.parse_example(serialized_examples, feature_spec),
+        num_parallel_calls=profile["num_parallel_calls"])
+
+    options = tf.data.Options()
+    options.experimental_deterministic = profile["deterministic"] or not is_train
+    if profile["private_threadpool_size"]:
+        options.experimental_threading.private_threadpool_size = profile["private_threadpool_size"]
+    if profile["max_intra_op_parallelism"]:
+        options.experimental_threading.max_intra_op_parallelism = profile["max_intra_op_parallelism"]
+    return dataset.with_options(options)
+
+
+def cache_key(file_pattern: List[Text], tf_transform_output: tft.TFTransformOutput, **settings) -> Text:
+    """Returns a hash of the input files, the transform graph and the settings of a cache.
+
+    Args:
+        file_pattern: input tfrecord file pattern.
+        tf_transform_output: A TFTransformOutput.
+        settings: Further values the cached data depends on
+
+    Returns:
+        Hex digest which changes whenever the cached data would change
+    """
+    paths = sorted(path for pattern in file_pattern for path in tf.io.gfile.glob(pattern))
+    paths.append(os.path.join(tf_transform_output.transform_savedmodel_dir, "saved_model.pb"))
+    key = dict(
+        settings,
+        files=[(path, tf.io.gfile.stat(path).length, tf.io.gfile.stat(path).mtime_nsec) for path in paths])
+    return hashlib.md5(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+
+def dataset_cache_path(cache_root: Text, key: Text, max_bytes: int) -> Text:
+    """Returns the cache file of a parsed dataset in cache_root and evicts old caches.
+
+    The cache is keyed by the inputs of the dataset, so reruns with identical inputs read the cache
+    of the previous run. An incomplete cache of an interrupted run is rewritten and the least
+    recently used caches are removed while cache_root exceeds max_bytes.
+
+    Args:
+        cache_root: Local directory of the dataset caches
+        key: cache_key of the dataset
+        max_bytes: Size of cache_root beyond which the least recently used caches are removed
+
+    Returns:
+        Filename prefix for tf.data.Dataset.cache
+    """
+    cache_dir = os.path.join(cache_root, key)
+    cache_path = os.path.join(cache_dir, "cache")
+    if not os.path.exists(cache_path + ".index"):
+        # Left over from an interrupted first epoch, tf.data refuses to write over its lockfile
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    os.makedirs(cache_dir, exist_ok=True)
+    # The modification time of the cache directory marks when it was used last
+    os.utime(cache_dir)
+
+    caches = []
+    for name in os.listdir(cache_root):
+        entry = os.path.join(cache_root, name)
+        # Caches without an index may still be written by the other dataset of this run
+        if entry != cache_dir and not os.path.exists(os.path.join(entry, "cache.index")):
+            continue
+        size = sum(os.path.getsize(os.path.join(entry, filename)) for filename in os.listdir(entry))
+        caches.append((os.path.getmtime(entry), size, entry))
+
+    total_size = sum(size for _, size, _ in caches)
+    for _, size, entry in sorted(caches):
+        if total_size <= max_bytes:
+            break
+        if entry != cache_dir:
+            absl.logging.info("Evicting dataset cache {}".format(entry))
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
+    return cache_path
+
+
+def fill_dataset_cache(dataset: tf.data.Dataset, cache_path: Text, tf_config: Dict) -> tf.data.Dataset:
+    """Caches dataset in cache_path and writes the complete cache before training.
+
+    tf.data only finalizes a cache file once an iterator reads past the end of its input, which
+    model.fit with steps_per_epoch never does in its last epoch. A full pass over the dataset writes
+    the cache, so a single epoch run leaves it behind for the next run as well.
+
+    Args:
+        dataset: The parsed dataset of one pass over the examples
+        cache_path: dataset_cache_path of the dataset
+        tf_config: Parsed TF_CONFIG, empty for a single process
+
+    Returns:
+        The cached dataset
+    """
+    cluster = tf_config.get("cluster", {})
+    tasks = [("chief", index) for index in range(len(cluster.get("chief", [])))]
+    tasks += [("worker", index) for index in range(len(cluster.get("worker", [])))]
+    if len(tasks) > 1:
+        # Every worker caches its own shard, model.fit must not shard the cached dataset again
+        task = tf_config["task"]
+        dataset = dataset.shard(len(tasks), tasks.index((task["type"], task["index"])))
+        options = tf.data.Options()
+        options.experimental_distribute.auto_shard_policy = tf.data.experimental.AutoShardPolicy.OFF
+        dataset = dataset.with_options(options)
+
+    dataset = dataset.cache(cache_path)
+    if not tf.io.gfile.exists(cache_path + ".index"):
+        num_batches = dataset.reduce(tf.constant(0, tf.int64), lambda count, _: count + 1)
+        absl.logging.info("Wrote {} batches to the dataset cache {}".format(int(num_batches), cache_path))
+    return dataset
+
+
+def counts_file(examples_uri: Text, split: Text) -> Text:
+    """Returns the file with the number of examples of a split of an Examples artifact."""
+    return os.path.join(examples_uri, "counts", "{}.json".format(split))
+
+
+def num_examples(file_pattern: List[Text]) -> Union[int, None]:
+    """Counts the examples of the Trainer file patterns from the counts of their Examples artifacts.
+
+    TFX passes one pattern "<artifact uri>/<split>/*" per split of every resolved artifact, the counts are
+    written by the executors of pipeline_common.example_counts.
+
+    Args:
+        file_pattern: train_files or eval_files of the Trainer
+
+    Returns:
+        The number of examples or None if a count is missing, e.g. for artifacts of an older run
+    """
+    total = 0
+    for pattern in file_pattern:
+        split_dir = os.path.dirname(pattern)
+        count_file = counts_file(os.path.dirname(split_dir), os.path.basename(split_dir))
+        if not tf.io.gfile.exists(count_file):
+            return None
+        with tf.io.gfile.GFile(count_file) as f:
+            total += json.load(f)["num_records"]
+    return total
+
+
+def num_steps(num_examples: Union[int, None], batch_size: int, default_steps: int) -> int:
+    """Returns the number of batches of a split, or default_steps if the number of examples is unknown."""
+    if not num_examples:
+        return default_steps
+    return int(math.ceil(num_examples / batch_size))
+
+
+def parse_tf_config() -> Dict:
+    """Returns the parsed TF_CONFIG environment variable of the Trainer process, empty if it is not set."""
+    return json.loads(os.environ.get("TF_CONFIG", "{}"))
+
+
+def get_distribution_strategy(tf_config: Dict, communication: Text) -> tf.distribute.Strategy:
+    """Returns a MultiWorkerMirroredStrategy for the cluster of tf_config, otherwise the default strategy.
+
+    The strategy has to be created before any other TensorFlow op of the process.
+
+    Args:
+        tf_config: Parsed TF_CONFIG, empty for a single process
+        communication: Name of the CollectiveCommunication of the workers, e.g. "RING"
+    """
+    if tf_config:
+        return tf.distribute.experimental.MultiWorkerMirroredStrategy(
+            communication=getattr(tf.distribute.experimental.CollectiveCommunication, communication))
+    return tf.distribute.get_strategy()
+
+
+def is_chief(tf_config: Dict) -> bool:
+    """Returns whether this process keeps the model, which is worker 0 unless tf_config has a chief."""
+    task = tf_config.get("task", {})
+    if "chief" in tf_config.get("cluster", {}):
+        return task.get("type") == "chief"
+    return task.get("index", 0) == 0
+
+
+def worker_path(path: Text, tf_config: Dict) -> Text:
+    """Returns path for the chief and a path next to it for the other workers.
+
+    All workers have to take part in saving a model or writing logs, but only the chief writes to path.
+    """
+    if is_chief(tf_config):
+        return path
+    task = tf_config["task"]
+    return "{}_{}_{}".format(path.rstrip("/"), task["type"], task["index"])
+
+
+def set_mixed_precision_policy(mixed_precision_policy: Union[Text, None]):
+    """Applies the Keras mixed precision policy, has to be called before the model is built.
+
+    Args:
+        mixed_precision_policy: Name of the Keras policy, None for float32
+    """
+    tf.keras.mixed_precision.experimental.set_policy(mixed_precision_policy or "float32")
+
+
+def compile_train_step(model: tf.keras.Model):
+    """Compiles the training step of model.fit with XLA, has to be called after model.compile.
+
+    TF 2.3 has no jit_compile option of model.compile, so the train_step of the model is replaced
+    by a tf.function with experimental_compile.
+
+    Args:
+        model: The compiled Keras model
+    """
+    if model.distribute_strategy.num_replicas_in_sync > 1:
+        # The optimizer step reduces the gradients across the replicas, which XLA can not compile here
+        absl.logging.warning('The training step of {} replicas is not compiled with XLA'.format(
+            model.distribute_strategy.num_replicas_in_sync))
+        return
+    model.train_step = tf.function(model.train_step, experimental_compile=True)
+
+
+def latest_pushed_model(serving_model_dir: Union[Text, None]) -> Union[Text, None]:
+    """Returns the directory of the latest model version the Pusher wrote to serving_model_dir or None."""
+    if not serving_model_dir or not tf.io.gfile.exists(serving_model_dir):
+        return None
+    versions = [name.rstrip("/") for name in tf.io.gfile.listdir(serving_model_dir) if name.rstrip("/").isdigit()]
+    if not versions:
+        return None
+    return os.path.join(serving_model_dir, max(versions, key=int))
+
+
+def warm_start(model: tf.keras.Model, fn_args, mode: Union[Text, None]):
+    """Initializes the model with the weights of the model of a WARM_START mode if there is one.
+
+    Args:
+        model: The model of get_model
+        fn_args: Holds args used to train the model as name/value pairs.
+        mode: "base_model", "pushed_model" or None
+    """
+    if mode is None:
+        return
+    if mode == "base_model":
+        model_dir = fn_args.base_model
+    elif mode == "pushed_model":
+        model_dir = latest_pushed_model((fn_args.custom_config or {}).get("serving_model_dir"))
+    else:
+        raise ValueError("Unknown WARM_START {}, expected base_model, pushed_model or None".format(mode))
+
+    if not model_dir:
+        absl.logging.info('No model to warm start from, training from the pre-trained backbone')
+        return
+    absl.logging.info('Warm starting from {}'.format(model_dir))
+    # The variables of the exported SavedModel are a checkpoint of the same Keras model
+    status = model.load_weights(os.path.join(model_dir, "variables", "variables"))
+    try:
+        # Fails if a variable of the model, e.g. of another backbone, is not in the checkpoint
+        status.assert_existing_objects_matched()
+    except AssertionError as e:
+        raise ValueError("The model in {} does not match the model of get_model, "
+                         "set WARM_START = None after changing the model: {}".format(model_dir, e)) from e
+    # The serving signatures, the transform layer and the optimizer slots of the checkpoint are not restored
+    status.expect_partial()
+
+
+def backup_dir(fn_args, key: Text, backup_root: Union[Text, None] = None) -> Text:
+    """Returns the backup directory of BackupAndRestore.
+
+    The directory is keyed by the inputs of the run, so a retried Trainer run finds the backup of the
+    interrupted attempt, while runs on new spans start a new backup.
+
+    Args:
+        fn_args: Holds args used to train the model as name/value pairs.
+        key: cache_key of the inputs and settings of the run
+        backup_root: Directory of the backups, None for the "backup_root" of the custom_config, which
+                     the pipeline places in its pipeline root, or a directory next to the model otherwise
+
+    Returns:
+        Path of the backup directory
+    """
+    if not backup_root:
+        backup_root = (fn_args.custom_config or {}).get("backup_root")
+    if not backup_root:
+        backup_root = os.path.join(os.path.dirname(fn_args.serving_model_dir), "trainer_backup")
+    return os.path.join(backup_root, key)
+
+
+class PerformanceCallback(tf.keras.callbacks.Callback):
+    """Records the step latency, examples/s, input wait and compute time and peak RSS of model.fit.
+
+    The summary goes to TensorBoard after every epoch and to a JSON file after training.
+    """
+
+    def __init__(self, dataset, batch_size, log_dir, summary_file=None, probe_steps=5, profile_steps=None):
+        """
+        Args:
+            dataset: The training dataset, a batch of it is used to measure the compute time
+            batch_size: Global batch size of the training steps
+            log_dir: TensorBoard log directory
+            summary_file: Path of the JSON summary, None skips it
+            probe_steps: Number of steps on a cached batch that measure the compute time, 0 skips them
+            profile_steps: (first, last) training step of a tf.profiler trace or None
+        """
+        super().__init__()
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.log_dir = log_dir
+        self.summary_file = summary_file
+        self.probe_steps = probe_steps
+        self.profile_steps = profile_steps
+        self.step_seconds = []
+        self._step_start = None
+        self._profiling = False
+        self._writer = None
+
+    def on_train_begin(self, logs=None):
+        self._writer = tf.summary.create_file_writer(os.path.join(self.log_dir, "performance"))
+
+    def on_train_batch_begin(self, batch, logs=None):
+        if self.profile_steps and len(self.step_seconds) == self.profile_steps[0]:
+            tf.profiler.experimental.start(self.log_dir)
+            self._profiling = True
+        self._step_start = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        # The logs are converted to numpy before this is called, so the step has finished
+        self.step_seconds.append(time.perf_counter() - self._step_start)
+        if self._profiling and len(self.step_seconds) > self.profile_steps[1]:
+            self._stop_profiler()
+
+    def on_epoch_end(self, epoch, logs=None):
+        summary = self._summary()
+        with self._writer.as_default():
+            for name in ["step_ms_p50", "step_ms_p90", "step_ms_p99", "examples_per_second", "peak_rss_bytes"]:
+                tf.summary.scalar(name, summary[name], step=epoch)
+
+    def on_train_end(self, logs=None):
+        if self._profiling:
+            self._stop_profiler()
+        if not self.step_seconds:
+            return
+
+        summary = self._summary()
+        if self.probe_steps:
+            compute_ms = self._compute_seconds_per_step() * 1000
+            summary["compute_ms_per_step"] = compute_ms
+            summary["input_wait_ms_per_step"] = max(summary["step_ms_mean"] - compute_ms, 0.0)
+            summary["input_wait_fraction"] = summary["input_wait_ms_per_step"] / summary["step_ms_mean"]
+            with self._writer.as_default():
+                for name in ["compute_ms_per_step", "input_wait_ms_per_step", "input_wait_fraction"]:
+                    tf.summary.scalar(name, summary[name], step=len(self.step_seconds))
+        self._writer.flush()
+
+        if self.summary_file:
+            with tf.io.gfile.GFile(self.summary_file, "w") as f:
+                json.dump(summary, f, indent=2)
+        absl.logging.info("Training performance: {}".format(json.dumps(summary)))
+
+    def _stop_profiler(self):
+        """Stops the tf.profiler trace."""
+        tf.profiler.experimental.stop()
+        self._profiling = False
+
+    def _summary(self) -> Dict:
+        """Returns the statistics of the training steps so far."""
+        # Except for a single step the first step is left out, it includes tracing the train function
+        step_ms = np.array(self.step_seconds[1:] or self.step_seconds) * 1000
+        return {
+            "steps": len(self.step_seconds),
+            "batch_size": self.batch_size,
+            "first_step_ms": self.step_seconds[0] * 1000,
+            "step_ms_mean": float(step_ms.mean()),
+            "step_ms_p50": float(np.percentile(step_ms, 50)),
+            "step_ms_p90": float(np.percentile(step_ms, 90)),
+            "step_ms_p99": float(np.percentile(step_ms, 99)),
+            "examples_per_second": self.batch_size * len(step_ms) / (step_ms.sum() / 1000),
+            # ru_maxrss is reported in KiB on Linux
+            "peak_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        }
+
+    def _compute_seconds_per_step(self) -> float:
+        """Returns the mean duration of a training step on a cached batch, which never waits for the input pipeline.
+
+        The weights and the optimizer state are restored afterwards, so the probe steps do not change the model.
+        """
+        inputs, targets = next(iter(self.dataset))
+        weights = self.model.get_weights()
+        optimizer_weights = self.model.optimizer.get_weights()
+        self.model.train_on_batch(inputs, targets)
+        start = time.perf_counter()
+        for _ in range(self.probe_steps):
+            self.model.train_on_batch(inputs, targets)
+        seconds = (time.perf_counter() - start) / self.probe_steps
+        self.model.set_weights(weights)
+        self.model.optimizer.set_weights(optimizer_weights)
+        return seconds
@@ -27,7 +27,8 @@ from tfx.dsl.experimental import latest_blessed_model_resolver
 from tfx.types.standard_artifacts import Model, ModelBlessing
 from tfx.types import Channel
 
-from segmentation_pipeline import base_pipeline
+from segmentation_pipeline import base_pipeline, constants
+from pipeline_common.span_sensor import add_span_sensor
 
 # Pipeline arguments for Beam powered Components.
 beam_pipeline_args = [
@@ -41,12 +42,19 @@ airflow_config = {
     "schedule_interval": None,
     "start_date": datetime(2020, 10, 17),
 }
+if constants.USE_SPANS:
+    # Runs periodically, the span sensor skips every run without a new span
+    airflow_config["schedule_interval"] = timedelta(minutes=constants.SPAN_SCHEDULE_INTERVAL_MINUTES)
+    airflow_config["catchup"] = False
+    # The next run starts from the span the previous run recorded
+    airflow_config["max_active_runs"] = 1
 
 pipeline_name = "segmentation_dag"
 dags_dir = "/mnt/c/dags/"
 project_dir = os.path.join(dags_dir, "segmentation_pipeline")
 # airflow_dir = os.path.join(os.environ["HOME"], "airflow") # ok
 data_dir = os.path.join(project_dir, "data/tfrecords/")
+image_dir = os.path.join(project_dir, "data/")
 module_file = os.path.join(project_dir, "module.py") ### write module file
 serving_model_dir = os.path.join(project_dir, "serving_model", pipeline_name)
 
@@ -61,8 +69,19 @@ p = base_pipeline.init_beam_pipeline(
     module_file=module_file,
     serving_model_dir=serving_model_dir,
     metadata_path=metadata_path,
-    beam_pipeline_args=beam_pipeline_args
+    beam_pipeline_args=beam_pipeline_args,
+    image_root=image_dir
     )
 
 
 DAG = AirflowDagRunner(AirflowPipelineConfig(airflow_config)).run(p)
+
+if constants.USE_SPANS:
+    add_span_sensor(
+        DAG,
+        input_base=image_dir if constants.USE_IMAGE_EXAMPLE_GEN else data_dir,
+        pipeline_root=pipeline_root,
+        poke_interval=constants.SPAN_POKE_INTERVAL_SECONDS,
+        timeout=constants.SPAN_SCHEDULE_INTERVAL_MINUTES * 60,
+        )
+
@@ -7,16 +7,18 @@ logging.getLogger('tensorflow').setLevel(logging.ERROR)
 import absl
 import tensorflow_model_analysis as tfma
 from typing import Any, Dict, Iterable, List, Text
-from tfx.components import Evaluator, Pusher, ResolverNode, StatisticsGen, Trainer
+from tfx.components import FileBasedExampleGen, StatisticsGen, SchemaGen, ExampleValidator, Trainer, ResolverNode, Evaluator, Pusher
 from tfx.components.base import executor_spec
-from tfx.components import ImportExampleGen, StatisticsGen, SchemaGen, ExampleValidator, Transform, Trainer, ResolverNode, Evaluator, Pusher
 from tfx.components.trainer.executor import GenericExecutor
-from tfx.dsl.experimental import latest_blessed_model_resolver
+from tfx.dsl.experimental import latest_artifacts_resolver, latest_blessed_model_resolver
 from tfx.orchestration import metadata, pipeline
 from tfx.proto import example_gen_pb2, trainer_pb2, pusher_pb2
 from tfx.types import Channel
-from tfx.types.standard_artifacts import Model, ModelBlessing
-from classification_pipeline import constants
+from tfx.types.standard_artifacts import Examples, Model, ModelBlessing
+from segmentation_pipeline import constants
+from segmentation_pipeline.image_example_gen import ImageExampleGenExecutor
+from pipeline_common.example_counts import CountingImportExampleGen, CountingTransform
+from pipeline_common.span_example_gen import NextSpanFileBasedExampleGen, NextSpanImportExampleGen
 
 
 def init_beam_pipeline(
@@ -26,23 +28,44 @@ def init_beam_pipeline(
     module_file: Text,
     serving_model_dir: Text,
     metadata_path: Text,
-    beam_pipeline_args: List[Text]) -> pipeline.Pipeline:
+    beam_pipeline_args: List[Text],
+    image_root: Text = None) -> pipeline.Pipeline:
 
     absl.logging.info(f"Pipeline root set to: {pipeline_root}")
 
+    # With spans ExampleGen resolves {SPAN} to the span-N directory after the last trained span
+    span_prefix = "span-{SPAN}/" if constants.USE_SPANS else ""
+
     input_config = example_gen_pb2.Input(
         splits=[
-        example_gen_pb2.Input.Split(name='train', pattern='train/*'),
-        example_gen_pb2.Input.Split(name="eval", pattern="test/*")
+        example_gen_pb2.Input.Split(name='train', pattern=span_prefix + 'train/*'),
+        example_gen_pb2.Input.Split(name="eval", pattern=span_prefix + "test/*")
         ]
         )
 
-    example_gen = ImportExampleGen(
-        input_base=data_root,
-        input_config=input_config,
-        # output_config=output,
-        # custom_executor_spec=executor_spec.ExecutorClassSpec(ImageExampleGenExecutor)
-        )
+    if constants.USE_IMAGE_EXAMPLE_GEN:
+        # Converts the images and masks inside the Beam pipeline instead of reading the output of convert_data_to_tfrecord.py
+        image_input_config = example_gen_pb2.Input(
+            splits=[
+            example_gen_pb2.Input.Split(name='train', pattern=span_prefix + 'images_prepped_train/*'),
+            example_gen_pb2.Input.Split(name="eval", pattern=span_prefix + "images_prepped_test/*")
+            ]
+            )
+
+        image_example_gen = NextSpanFileBasedExampleGen if constants.USE_SPANS else FileBasedExampleGen
+        example_gen = image_example_gen(
+            input_base=image_root,
+            input_config=image_input_config,
+            custom_executor_spec=executor_spec.ExecutorClassSpec(ImageExampleGenExecutor)
+            )
+    else:
+        # Stores the number of examples of every split in the examples artifact
+        import_example_gen = NextSpanImportExampleGen if constants.USE_SPANS else CountingImportExampleGen
+        example_gen = import_example_gen(
+            input_base=data_root,
+            input_config=input_config,
+            # output_config=output,
+            )
 
     statistics_gen = StatisticsGen(
         examples=example_gen.outputs['examples']
@@ -58,20 +81,72 @@ def init_beam_pipeline(
         schema=schema_gen.outputs['schema']
         )
 
-    transform = Transform(
+    # Copies the counts of the examples to the transformed examples. With USE_SPANS every run only
+    # analyzes its new span, while the Trainer reads the examples of the whole window, which earlier
+    # transform graphs transformed, so the preprocessing_fn must not use any tft analyzer
+    transform = CountingTransform(
         examples=example_gen.outputs['examples'],
         schema=schema_gen.outputs['schema'],
-        module_file=module_file
+        module_file=module_file,
+        materialize=constants.MATERIALIZE_TRANSFORMED
         )
 
+    if constants.MATERIALIZE_TRANSFORMED:
+        trainer_examples = transform.outputs['transformed_examples']
+        examples_producer, examples_key = transform.id, 'transformed_examples'
+    else:
+        # The Trainer applies the transform graph to the raw examples on the fly
+        trainer_examples = example_gen.outputs['examples']
+        examples_producer, examples_key = example_gen.id, 'examples'
+
+    if constants.USE_SPANS:
+        # ExampleGen and Transform only process the new span, the Trainer reads the
+        # examples of the latest SPAN_WINDOW spans as a rolling window. The Trainer of TFX 0.24
+        # accepts several examples artifacts, fn_args.train_files holds one pattern per split of each
+        examples_resolver = ResolverNode(
+            instance_name='latest_examples_resolver',
+            resolver_class=latest_artifacts_resolver.LatestArtifactsResolver,
+            resolver_configs={'desired_num_of_artifacts': constants.SPAN_WINDOW},
+            examples=Channel(
+                type=Examples,
+                producer_component_id=examples_producer,
+                output_key=examples_key
+                )
+            )
+        # Waits for the Transform of the current run before resolving
+        examples_resolver.add_upstream_node(transform)
+        trainer_examples = examples_resolver.outputs['examples']
+    else:
+        examples_resolver = None
+
+    if constants.WARM_START == "base_model":
+        # Resolves the model of the previous Trainer run, the first run starts without one
+        base_model_resolver = ResolverNode(
+            instance_name='latest_model_resolver',
+            resolver_class=latest_artifacts_resolver.LatestArtifactsResolver,
+            model=Channel(type=Model)
+            )
+        base_model = base_model_resolver.outputs['model']
+    else:
+        base_model_resolver = None
+        base_model = None
+
     trainer = Trainer(
         module_file=module_file,
         custom_executor_spec=executor_spec.ExecutorClassSpec(GenericExecutor),
-        examples=transform.outputs['transformed_examples'],
+        # run_fn derives the steps per epoch from the example counts of these artifacts
+        examples=trainer_examples,
         transform_graph=transform.outputs['transform_graph'],
         schema=schema_gen.outputs['schema'],
+        base_model=base_model,
         train_args=trainer_pb2.TrainArgs(splits=["train"]),
         eval_args=trainer_pb2.EvalArgs(splits=["eval"]),
+        custom_config={
+            # WARM_START = "pushed_model" starts from the latest model in serving_model_dir
+            "serving_model_dir": serving_model_dir,
+            # BackupAndRestore keeps the state of interrupted runs outside of the data and of the model artifacts
+            "backup_root": os.path.join(pipeline_root, "trainer_backup"),
+        },
         )
 
     # model_resolver = ResolverNode(
@@ -124,17 +199,19 @@ def init_beam_pipeline(
     p = pipeline.Pipeline(
         pipeline_name=pipeline_name,
         pipeline_root=pipeline_root,
-        components=[
+        components=[component for component in [
             example_gen,
             statistics_gen,
             schema_gen,
             example_validator,
             transform,
+            examples_resolver,
+            base_model_resolver,
             trainer,
             # model_resolver,
             # evaluator,
             pusher
-        ],
+        ] if component is not None],
         enable_cache=True,
         metadata_connection_config=metadata.sqlite_metadata_connection_config(
             metadata_path
@@ -9,9 +9,98 @@ TRAIN_BATCH_SIZE = 4
 EVAL_BATCH_SIZE = 1
 HEIGHT = 320
 WIDTH = 320
+# Shape of the encoded images in the records, Transform resizes them to (HEIGHT, WIDTH)
+RECORD_HEIGHT = 360
+RECORD_WIDTH = 480
+# Number of images of a Transform batch decoded in parallel by preprocessing_fn
+DECODE_PARALLEL_ITERATIONS = 32
+# Precision of the transformed images, "float32" stores normalized images, "uint8" and "float16" store the
+# resized pixels, which are normalized by the Trainer input pipeline (uint8 rounds to whole pixel values)
+TRANSFORMED_IMAGE_DTYPE = "float32"
+# Write the transformed examples with Transform, otherwise Transform only writes the transform graph
+# and the Trainer applies it to the raw examples inside its tf.data input pipeline
+MATERIALIZE_TRANSFORMED = True
+# tf.data settings of _input_fn, "default" reads with make_batched_features_dataset and its defaults,
+# "throughput" interleaves the files and parses and maps in parallel, -1 stands for tf.data.experimental.AUTOTUNE
+INPUT_PIPELINE_PROFILE = "default"
+INPUT_PIPELINE_PROFILES = {
+    "default": None,
+    "throughput": {
+        "interleave_cycle_length": -1,
+        "num_parallel_calls": -1,
+        "shuffle_buffer_size": 256,
+        # Only applies to training, evaluation always reads deterministically
+        "deterministic": False,
+        "prefetch_buffer_size": -1,
+        # 0 keeps the tf.data defaults
+        "private_threadpool_size": 0,
+        "max_intra_op_parallelism": 0,
+    },
+}
+# Profile the batches INPUT_PIPELINE_PROFILE_BATCHES with the TensorBoard callback,
+# the input pipeline analysis then shows up in the profile tab of TensorBoard
+INPUT_PIPELINE_STATS = False
+INPUT_PIPELINE_PROFILE_BATCHES = "10,20"
+# Cache the parsed batches before the augmentation in this local directory, so later epochs and reruns
+# with the same transform graph and files skip reading and parsing the TFRecords, None disables the cache
+DATASET_CACHE_DIR = None
+# The least recently used caches are removed once the cache directory grows beyond this size
+DATASET_CACHE_MAX_BYTES = 20 * 1024 ** 3
+# Number of cached batches shuffled between the epochs of the training dataset
+DATASET_CACHE_SHUFFLE_BATCHES = 16
+# The random values of every training batch are drawn from a stateless seed of the sequence of
+# AUGMENTATION_SEED, image and mask are augmented together in one pass and runs are reproducible
+AUGMENTATION_SEED = 0
+# The batches are padded by AUGMENTATION_CROP_PADDING pixels and cropped back to (HEIGHT, WIDTH) at a random offset
+AUGMENTATION_CROP_PADDING = 30
+# Largest random rotation in radians and (min, max) of the random scale factor, 0 and None disable them
+AUGMENTATION_MAX_ROTATION = 0.0
+AUGMENTATION_SCALE_RANGE = None
+# Train with MultiWorkerMirroredStrategy on the cluster in the TF_CONFIG environment variable of the Trainer
+# processes, every worker reads batches of TRAIN_BATCH_SIZE and EVAL_BATCH_SIZE of its shard of the input
+MULTI_WORKER_TRAINING = False
+# Collective communication of the workers, "RING" for CPUs, "NCCL" for GPUs or "AUTO"
+MULTI_WORKER_COMMUNICATION = "RING"
+# Record the step latency percentiles, examples/s, the split of the step time into input wait and compute
+# and the peak RSS of training in TensorBoard and in "performance.json" next to the model. The compute time
+# is measured after training on PERFORMANCE_PROBE_STEPS steps of one cached batch, which are reverted
+PERFORMANCE_SUMMARY = True
+PERFORMANCE_PROBE_STEPS = 5
+# (first, last) training step of a tf.profiler trace in the TensorBoard logs, None disables the trace
+PROFILE_STEPS = None
+# Back up the model after every epoch and resume from the backup when a Trainer run on the same inputs was interrupted
+BACKUP_AND_RESTORE = True
+# Directory of the backups, None places them in "trainer_backup" of the pipeline root
+BACKUP_DIR = None
+# Initialize the model with the weights of the model of the previous Trainer run ("base_model"), of the latest
+# model the Pusher pushed to serving_model_dir ("pushed_model") or only with the pre-trained backbone (None)
+WARM_START = None
+# Keras mixed precision policy, "mixed_bfloat16" computes in bfloat16 on CPUs with oneDNN while the variables
+# and the final softmax stay float32, None trains in float32
+MIXED_PRECISION_POLICY = None
+# Compile the training step of model.fit and the model call of the serving signatures with XLA
+XLA_COMPILE = False
 PRETRAINED_WEIGHTS = "imagenet"
 BACKBONE_TRAINABLE = False
 BACKBONE_NAME = "efficientnetb3"
+# Read the span-N directories written by "convert_data_to_tfrecord.py --incremental"
+# instead of the train/ and test/ directories of a full conversion. Transform only analyzes the new
+# span of a run, so the preprocessing_fn has to stay free of tft analyzers while spans are on
+USE_SPANS = False
+# Number of latest spans the Trainer trains on, every span is only ingested and transformed once
+SPAN_WINDOW = 3
+# With USE_SPANS the DAG runs on this schedule and a sensor skips the run unless a new span arrived
+SPAN_SCHEDULE_INTERVAL_MINUTES = 60
+SPAN_POKE_INTERVAL_SECONDS = 300
+# Convert the image directories with the ImageExampleGenExecutor inside the pipeline
+# instead of importing the TFRecords of "convert_data_to_tfrecord.py"
+USE_IMAGE_EXAMPLE_GEN = False
+# "encoded" records hold the image files, "raw" records hold decoded uint8 pixels of shape (HEIGHT, WIDTH, 3),
+# has to match the --record_format of "convert_data_to_tfrecord.py"
+RECORD_FORMAT = "encoded"
+# "rgb" records hold the 3 channel masks, "class_index" records hold single channel masks of shape (HEIGHT, WIDTH)
+# with the MODEL_CLASSES remapping applied, has to match the --mask_format of "convert_data_to_tfrecord.py"
+MASK_FORMAT = "rgb"
 
 TOTAL_CLASSES = ['sky', 'building', 'pole', 'road', 'pavement', 
                'tree', 'signsymbol', 'fence', 'car', 
@@ -24,4 +113,15 @@ if len(MODEL_CLASSES) == 11:
     N_MODEL_CLASSES = N_TOTAL_CLASSES
 else:
     ALL_CLASSES = False
-    N_MODEL_CLASSES = len(MODEL_CLASSES) + 1
\ No newline at end of file
+    N_MODEL_CLASSES = len(MODEL_CLASSES) + 1
+
+# Maps the index of every class in TOTAL_CLASSES to its mask channel in the model output,
+# classes which are not part of MODEL_CLASSES are mapped to the trailing background channel
+if ALL_CLASSES:
+    CLASS_INDEX_LOOKUP = list(range(N_TOTAL_CLASSES))
+else:
+    CLASS_VALUES = sorted(TOTAL_CLASSES.index(cls.lower()) for cls in MODEL_CLASSES)
+    CLASS_INDEX_LOOKUP = [
+        CLASS_VALUES.index(value) if value in CLASS_VALUES else N_MODEL_CLASSES - 1
+        for value in range(N_TOTAL_CLASSES)
+    ]
@@ -1,28 +1,36 @@
 import os
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 
-import cv2
+import argparse
+import glob
+import hashlib
+import io
+import json
+import multiprocessing
 import pathlib
+import struct
+import time
+
+import cv2
 import numpy as np
 import tensorflow as tf
 from PIL import Image
-import constants
+try:
+    from segmentation_pipeline import constants
+except ImportError:
+    # Executed as script from within the pipeline directory
+    import constants
 
 data_dir = "data/"
-train_img_dir = os.path.join(data_dir, "images_prepped_train/")
-test_img_dir = os.path.join(data_dir, "images_prepped_test/")
-
-train_mask_dir = os.path.join(data_dir, "annotations_prepped_train/")
-test_mask_dir = os.path.join(data_dir, "annotations_prepped_test/")
-
 tfrecords_dir = os.path.join(data_dir, "tfrecords")
-train_record_file = os.path.join(tfrecords_dir, "train/train.tfrecords")
-test_record_file = os.path.join(tfrecords_dir, "test/test.tfrecords")
 
+# Beam (and therefore ImportExampleGen) detects the compression of a record file by its suffix
+COMPRESSION_SUFFIXES = {"none": "", "GZIP": ".gz", "ZLIB": ".deflate"}
+
+# Maps every possible mask value to its class index, values outside of TOTAL_CLASSES become background
+CLASS_INDEX_LOOKUP = np.full(256, constants.N_MODEL_CLASSES - 1, dtype=np.uint8)
+CLASS_INDEX_LOOKUP[:constants.N_TOTAL_CLASSES] = constants.CLASS_INDEX_LOOKUP
 
-pathlib.Path(tfrecords_dir).mkdir(parents=True, exist_ok=True)
-pathlib.Path(os.path.join(tfrecords_dir, "train")).mkdir(parents=True, exist_ok=True)
-pathlib.Path(os.path.join(tfrecords_dir, "test")).mkdir(parents=True, exist_ok=True)
 
 def _bytes_feature(value):
     """Returns a bytes_list from a string / byte."""
@@ -34,13 +42,15 @@ def _int64_feature(value):
     """Returns an int64_list from a bool / enum / int / uint."""
     return tf.train.Feature(int64_list=tf.train.Int64List(value=[value]))
 
-def image_example(img_string, mask_string):
+def image_example(img_string, mask_string, image_shape=None, mask_shape=None):
     """Returns tf.Example containing image and mask as byteslist
     
 
     Args:
         img_string: bytes string of image
         mask_string: bytes string of mask
+        image_shape: Optional (height, width, depth) of a raw image
+        mask_shape: Optional (height, width, depth) of a raw mask
 
     Returns:
         tf.train.Example which will be serialized and written to tfrecord
@@ -49,55 +59,442 @@ def image_example(img_string, mask_string):
         constants.IMAGE_KEY: _bytes_feature(img_string),
         constants.MASK_KEY: _bytes_feature(mask_string)
     }
+    # Raw records need the shapes to reshape the decoded bytes
+    if image_shape is not None:
+        feature["height"] = _int64_feature(image_shape[0])
+        feature["width"] = _int64_feature(image_shape[1])
+        feature["depth"] = _int64_feature(image_shape[2])
+    if mask_shape is not None:
+        feature["mask_depth"] = _int64_feature(mask_shape[2])
 
     return tf.train.Example(features=tf.train.Features(feature=feature))
 
 
-def resize_and_save_image(filepath, height, width):
-    """Function to resize and save images which do not have the prespecified image shape of (height, width, 3).
+def load_and_resize_image(filepath, height, width, interpolation=cv2.INTER_LINEAR):
+    """Reads an image once and resizes it in memory if it does not have the shape (height, width).
+
+    Only the image header is parsed to check the shape, so images of the right size are passed
+    through as their original bytes without being decoded. Other images are decoded once, resized
+    and re-encoded into an in-memory buffer of the same format. The source file is never modified.
 
     Args:
         filepath: String of imagepath
         height: Int
         width: Int
+        interpolation: cv2 interpolation flag, masks have to use cv2.INTER_NEAREST to keep their class values
 
     Returns:
-        None
+        Tuple of (encoded bytes of the image with shape (height, width), original bytes of the file)
 
     """
-    img = cv2.imread(filepath)
-    h, w, d = img.shape
-    
-    if h != height or w != width:
-        res = cv2.resize(img, dsize=(height, width))
-        cv2.imwrite(filepath, res)
-        print("{} resized from shape {} to shape (360, 480, 3)".format(filepath, (h, w, d)))
+    content = open(filepath, "rb").read()
+    w, h = Image.open(io.BytesIO(content)).size
+    if h == height and w == width:
+        return content, content
+
+    img = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    res = cv2.resize(img, dsize=(width, height), interpolation=interpolation)
+    _, buffer = cv2.imencode(os.path.splitext(filepath)[1], res)
+    return buffer.tobytes(), content
+
+def load_decoded_image(filepath, height, width, interpolation=cv2.INTER_LINEAR):
+    """Reads an image and returns its pixels decoded and resized to (height, width) as raw uint8 RGB bytes.
+
+    Args:
+        filepath: String of imagepath
+        height: Int
+        width: Int
+        interpolation: cv2 interpolation flag, masks have to use cv2.INTER_NEAREST to keep their class values
+
+    Returns:
+        Tuple of (raw bytes of the image, shape of the image, original bytes of the file)
+
+    """
+    content = open(filepath, "rb").read()
+    img = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_COLOR)
+    if img.shape[:2] != (height, width):
+        img = cv2.resize(img, dsize=(width, height), interpolation=interpolation)
+    img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+    return img.tobytes(), img.shape, content
+
+def load_class_index_mask(filepath, height, width, record_format):
+    """Reads a mask and converts it to a single channel uint8 mask of MODEL_CLASSES indices.
+
+    The mask values are remapped with constants.CLASS_INDEX_LOOKUP, so all classes which are not
+    part of MODEL_CLASSES become the background class. Resizing uses nearest-neighbour
+    interpolation, which keeps every pixel a valid class index.
+
+    Args:
+        filepath: String of maskpath
+        height: Int
+        width: Int
+        record_format: "encoded" to return PNG bytes or "raw" to return the uint8 pixels
+
+    Returns:
+        Tuple of (bytes of the class index mask, original bytes of the file)
+
+    """
+    content = open(filepath, "rb").read()
+    mask = cv2.imdecode(np.frombuffer(content, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if mask.ndim == 3:
+        mask = mask.max(axis=-1)
+    if mask.shape != (height, width):
+        mask = cv2.resize(mask, dsize=(width, height), interpolation=cv2.INTER_NEAREST)
+    mask = CLASS_INDEX_LOOKUP[mask]
+
+    if record_format == "raw":
+        return mask.tobytes(), content
+    _, buffer = cv2.imencode(".png", mask)
+    return buffer.tobytes(), content
+
+def convert_image_and_mask(img_path, mask_path, height, width, record_format, mask_format):
+    """Converts a single image and its mask to a tf.Example.
+
+    Args:
+        img_path: String of imagepath
+        mask_path: String of maskpath
+        height: Int
+        width: Int
+        record_format: "encoded" to store the PNG bytes or "raw" to store decoded uint8 pixels
+        mask_format: "rgb" to store the mask as it is or "class_index" to store a single channel mask of model class indices
+
+    Returns:
+        Tuple of (tf.train.Example, original bytes of the image file, original bytes of the mask file)
+    """
+    image_shape, mask_shape = None, None
+    if record_format == "raw":
+        image_string, image_shape, image_content = load_decoded_image(img_path, height, width)
+    else:
+        image_string, image_content = load_and_resize_image(img_path, height, width)
+
+    if mask_format == "class_index":
+        # Class index masks always have the model input shape, so Transform does not resize them
+        mask_string, mask_content = load_class_index_mask(mask_path, constants.HEIGHT, constants.WIDTH, record_format)
+        if record_format == "raw":
+            mask_shape = (constants.HEIGHT, constants.WIDTH, 1)
+    elif record_format == "raw":
+        mask_string, mask_shape, mask_content = load_decoded_image(mask_path, height, width, cv2.INTER_NEAREST)
+    else:
+        mask_string, mask_content = load_and_resize_image(mask_path, height, width, cv2.INTER_NEAREST)
+
+    return image_example(image_string, mask_string, image_shape, mask_shape), image_content, mask_content
+
+def list_image_files(img_dir, mask_dir):
+    """Collects all images of img_dir together with their masks of the same filename in mask_dir.
 
-def write_files_to_tfrecord(record_file, img_dir, mask_dir, height, width):
-    """Write train files to TFRecord
-    
     Args:
-        record_file: String of filepath the tfrecordwriter should write to
         img_dir: String of directory of images
         mask_dir: String of directory of masks
+
+    Returns:
+        List of (image_path, mask_path) tuples sorted by filename
+    """
+    return [
+        (os.path.join(img_dir, filename), os.path.join(mask_dir, filename))
+        for filename in sorted(os.listdir(img_dir))
+    ]
+
+def shard_filename(split, shard, num_shards, compression="none"):
+    """Returns the filename of a shard, e.g. train-00000-of-00032.tfrecords or train-00000-of-00032.tfrecords.gz"""
+    return "{}-{:05d}-of-{:05d}.tfrecords{}".format(split, shard, num_shards, COMPRESSION_SUFFIXES[compression])
+
+def index_filename(record_file):
+    """Returns the filename of the index sidecar of a shard, e.g. train-00000-of-00032.json"""
+    return os.path.basename(record_file).split(".tfrecords")[0] + ".json"
+
+def write_index(index_file, record_file, offsets, class_counts=None, compression="none"):
+    """Writes the index sidecar of a shard with its record count and the byte offset of every record.
+
+    Args:
+        index_file: String of filepath of the index
+        record_file: String of filepath of the shard
+        offsets: List of byte offsets of the records in the shard
+        class_counts: Optional dict mapping labels to their number of records
+        compression: Compression of the shard, offsets are only stored for uncompressed shards
+
+    Returns:
+        None
+    """
+    index = {"record_file": os.path.basename(record_file), "num_records": len(offsets)}
+    if compression == "none":
+        index["offsets"] = offsets
+    else:
+        index["compression"] = compression
+    if class_counts is not None:
+        index["class_counts"] = {str(label): count for label, count in sorted(class_counts.items())}
+    with open(index_file, "w") as f:
+        json.dump(index, f)
+
+def load_split_index(index_dir):
+    """Sums up the index sidecars of all shards of a split.
+
+    Args:
+        index_dir: String of the index directory of a split
+
+    Returns:
+        Dict with the total num_records and class_counts of the split
+    """
+    num_records, class_counts = 0, {}
+    for index_file in sorted(glob.glob(os.path.join(index_dir, "*.json"))):
+        with open(index_file) as f:
+            index = json.load(f)
+        num_records += index["num_records"]
+        for label, count in index.get("class_counts", {}).items():
+            class_counts[label] = class_counts.get(label, 0) + count
+    return {"num_records": num_records, "class_counts": class_counts}
+
+def read_record_at(record_file, offset):
+    """Reads a single serialized tf.Example at a byte offset of an uncompressed shard, e.g. for debugging or sampling.
+
+    Args:
+        record_file: String of filepath of the shard
+        offset: Int byte offset of the record as stored in the index
+
+    Returns:
+        Bytes of the serialized tf.Example
+    """
+    with open(record_file, "rb") as f:
+        f.seek(offset)
+        length = struct.unpack("<Q", f.read(8))[0]
+        f.read(4)  # masked crc32c of the length
+        return f.read(length)
+
+def split_into_shards(files, num_shards):
+    """Distributes files round robin over num_shards shards, keeping the shard sizes within one file of each other.
+
+    Args:
+        files: List of files
+        num_shards: Int
+
+    Returns:
+        List of num_shards lists of files
+    """
+    return [files[shard::num_shards] for shard in range(num_shards)]
+
+def file_fingerprint(filepath, content=None):
+    """Returns size, modification time and sha256 content hash of a file.
+
+    Args:
+        filepath: String of filepath
+        content: Optional bytes of the file, avoids reading the file a second time
+
+    Returns:
+        Dict with keys size, mtime and sha256
+    """
+    if content is None:
+        content = open(filepath, "rb").read()
+    stat = os.stat(filepath)
+    return {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": hashlib.sha256(content).hexdigest()}
+
+def is_unchanged(filepath, fingerprint):
+    """Checks a file against its manifest fingerprint. The content is only hashed if size matches but mtime does not.
+
+    Args:
+        filepath: String of filepath
+        fingerprint: Dict as returned by file_fingerprint
+
+    Returns:
+        Bool - True if the file content did not change
+    """
+    stat = os.stat(filepath)
+    if stat.st_size != fingerprint["size"]:
+        return False
+    if stat.st_mtime == fingerprint["mtime"]:
+        return True
+    if file_fingerprint(filepath)["sha256"] == fingerprint["sha256"]:
+        # Only touched, remember the new mtime to skip hashing on the next run
+        fingerprint["mtime"] = stat.st_mtime
+        return True
+    return False
+
+def load_manifest(manifest_file):
+    """Loads the conversion manifest or returns an empty one if none exists yet."""
+    if not os.path.exists(manifest_file):
+        return {"last_span": -1, "splits": {}}
+    with open(manifest_file) as f:
+        return json.load(f)
+
+def save_manifest(manifest, manifest_file):
+    """Atomically writes the conversion manifest."""
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+def filter_converted(files, root_dir, split_manifest):
+    """Removes all image/mask pairs from the list which were already converted and did not change since.
+
+    Changed pairs are converted again into the new span, their previous version stays in the span
+    it was written to.
+
+    Args:
+        files: List of (image_path, mask_path) tuples
+        root_dir: String of directory the manifest paths are relative to
+        split_manifest: Dict mapping relative image paths to the fingerprints of image and mask
+
+    Returns:
+        List of (image_path, mask_path) tuples which still need to be converted
+    """
+    pending = []
+    changed = 0
+    for img_path, mask_path in files:
+        entry = split_manifest.get(os.path.relpath(img_path, root_dir))
+        if entry is None:
+            pending.append((img_path, mask_path))
+        elif not (is_unchanged(img_path, entry["image"]) and is_unchanged(mask_path, entry["mask"])):
+            pending.append((img_path, mask_path))
+            changed += 1
+    if changed:
+        print("{} changed image/mask pairs are converted again, their previous versions are trained on as well "
+              "as long as their spans are within SPAN_WINDOW".format(changed))
+    return pending
+
+def write_shard(shard_args):
+    """Write the images and masks of a single shard to a TFRecord file. Runs inside a worker process.
+
+    Args:
+        shard_args: Tuple of (record_file, index_file, files, height, width, record_format, mask_format, compression)
+
+    Returns:
+        Dict mapping the image path of every written example to the fingerprints of image and mask
+    """
+    record_file, index_file, files, height, width, record_format, mask_format, compression = shard_args
+    fingerprints = {}
+    offsets = []
+    offset = 0
+    options = tf.io.TFRecordOptions(compression_type="" if compression == "none" else compression)
+    with tf.io.TFRecordWriter(record_file, options) as writer:
+        for img_path, mask_path in files:
+            tf_example, image_content, mask_content = convert_image_and_mask(
+                img_path, mask_path, height, width, record_format, mask_format)
+            serialized_example = tf_example.SerializeToString()
+            writer.write(serialized_example)
+            fingerprints[img_path] = {
+                "image": file_fingerprint(img_path, image_content),
+                "mask": file_fingerprint(mask_path, mask_content)
+            }
+
+            offsets.append(offset)
+            # A record consists of its length, the crc of the length, the data and the crc of the data,
+            # for compressed shards these are offsets into the uncompressed stream
+            offset += 8 + 4 + len(serialized_example) + 4
+    write_index(index_file, record_file, offsets, compression=compression)
+    return fingerprints
+
+def write_files_to_tfrecord(files, record_dir, split, height, width, num_shards, num_workers, record_format="encoded", mask_format="rgb", compression="none"):
+    """Write the files of a split to num_shards balanced TFRecord shards using a process pool.
+    
+    Args:
+        files: List of (image_path, mask_path) tuples
+        record_dir: String of directory the shards are written to
+        split: String of split name used as shard prefix
         height: Int
         width: Int
+        num_shards: Int
+        num_workers: Int, 0 means one worker per available cpu
+        record_format: "encoded" to store the PNG bytes or "raw" to store decoded uint8 pixels
+        mask_format: "rgb" to store the masks as they are or "class_index" to store single channel masks of model class indices
+        compression: "none", "GZIP" or "ZLIB"
 
     Returns:
-        None
+        Dict mapping the image path of every written example to the fingerprints of image and mask
     """
-    with tf.io.TFRecordWriter(record_file) as writer:
-        for num, filename in enumerate(sorted(os.listdir(img_dir))):
-                if num % 100 == 0:
-                    print("Image number {}".format(num))
+    num_shards = max(1, min(num_shards, len(files)))
+    num_workers = num_workers or os.cpu_count()
+
+    # The index sidecars are kept in a sibling index/ directory, since "split/*" must only match TFRecord files
+    index_dir = os.path.join(os.path.dirname(os.path.normpath(record_dir)), "index", split)
+
+    pathlib.Path(record_dir).mkdir(parents=True, exist_ok=True)
+    pathlib.Path(index_dir).mkdir(parents=True, exist_ok=True)
+    # Remove the shards of a previous conversion, otherwise "split/*" would pick them up as well
+    stale_files = glob.glob(os.path.join(record_dir, "{}-*-of-*.tfrecords*".format(split)))
+    stale_files += glob.glob(os.path.join(record_dir, "{}.tfrecords*".format(split)))
+    stale_files += glob.glob(os.path.join(index_dir, "{}-*-of-*.json".format(split)))
+    for stale_file in stale_files:
+        os.remove(stale_file)
 
-                resize_and_save_image(os.path.join(img_dir, filename), height, width)
-                resize_and_save_image(os.path.join(mask_dir, filename), height, width)
+    shard_args = []
+    for shard, shard_files in enumerate(split_into_shards(files, num_shards)):
+        record_file = os.path.join(record_dir, shard_filename(split, shard, num_shards, compression))
+        shard_args.append(
+            (record_file, os.path.join(index_dir, index_filename(record_file)), shard_files, height, width, record_format, mask_format, compression))
+
+    start = time.time()
+    fingerprints = {}
+    if num_workers == 1:
+        for shard_arg in shard_args:
+            fingerprints.update(write_shard(shard_arg))
+    else:
+        # TensorFlow is not fork-safe, therefore the workers are spawned
+        with multiprocessing.get_context("spawn").Pool(processes=num_workers) as pool:
+            for shard_num, shard_fingerprints in enumerate(pool.imap_unordered(write_shard, shard_args)):
+                fingerprints.update(shard_fingerprints)
+                print("Shard {} of {} finished, {} examples written".format(shard_num + 1, num_shards, len(fingerprints)))
+
+    duration = time.time() - start
+    print("Wrote {} examples into {} shards with {} workers in {:.1f}s ({:.1f} images/s)".format(
+        len(fingerprints), num_shards, num_workers, duration, len(fingerprints) / max(duration, 1e-6)))
+    return fingerprints
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Convert the segmentation images and masks to sharded TFRecord files.")
+    parser.add_argument("--data_dir", default=data_dir, help="Directory containing the images_prepped_* and annotations_prepped_* directories")
+    parser.add_argument("--tfrecords_dir", default=tfrecords_dir, help="Output directory of the TFRecord files")
+    parser.add_argument("--height", type=int, default=constants.RECORD_HEIGHT, help="Height of the encoded images and masks in the records")
+    parser.add_argument("--width", type=int, default=constants.RECORD_WIDTH, help="Width of the encoded images and masks in the records")
+    parser.add_argument("--record_format", choices=["encoded", "raw"], default=constants.RECORD_FORMAT,
+                        help="Store encoded PNG bytes or decoded uint8 pixels resized to (constants.HEIGHT, constants.WIDTH)")
+    parser.add_argument("--num_shards", type=int, default=32, help="Number of shards per split")
+    parser.add_argument("--num_workers", type=int, default=0, help="Number of worker processes, 0 uses all cpus")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only convert images missing from the manifest and write them as a new span-N directory")
+    parser.add_argument("--compression", choices=sorted(COMPRESSION_SUFFIXES), default="none",
+                        help="Compression of the TFRecord files, the shards get the matching suffix for ImportExampleGen")
+    parser.add_argument("--mask_format", choices=["rgb", "class_index"], default=constants.MASK_FORMAT,
+                        help="Store the masks as they are or as single channel MODEL_CLASSES indices of shape (constants.HEIGHT, constants.WIDTH)")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.record_format == "raw":
+        args.height, args.width = constants.HEIGHT, constants.WIDTH
+
+    splits = ["train", "test"]
+    split_files = {
+        split: list_image_files(
+            os.path.join(args.data_dir, "images_prepped_{}/".format(split)),
+            os.path.join(args.data_dir, "annotations_prepped_{}/".format(split))
+            )
+        for split in splits
+    }
 
-                image_string = open(os.path.join(img_dir, filename), "rb").read()
-                mask_string = open(os.path.join(mask_dir, filename), "rb").read()
-                tf_example = image_example(image_string, mask_string)
-                writer.write(tf_example.SerializeToString())
+    if not args.incremental:
+        for split in splits:
+            write_files_to_tfrecord(
+                split_files[split], os.path.join(args.tfrecords_dir, split), split,
+                args.height, args.width, args.num_shards, args.num_workers, args.record_format, args.mask_format, args.compression
+                )
+    else:
+        manifest_file = os.path.join(args.tfrecords_dir, "manifest.json")
+        manifest = load_manifest(manifest_file)
+        for split in splits:
+            split_files[split] = filter_converted(
+                split_files[split], args.data_dir, manifest["splits"].setdefault(split, {}))
 
-write_files_to_tfrecord(train_record_file, train_img_dir, train_mask_dir, 360, 480)
-write_files_to_tfrecord(test_record_file, test_img_dir, test_mask_dir, 360, 480)
\ No newline at end of file
+        if any(split_files.values()):
+            # Every split is written, possibly as an empty shard, so that all patterns of the span match
+            span = manifest["last_span"] + 1
+            for split in splits:
+                fingerprints = write_files_to_tfrecord(
+                    split_files[split], os.path.join(args.tfrecords_dir, "span-{}".format(span), split), split,
+                    args.height, args.width, args.num_shards, args.num_workers, args.record_format, args.mask_format, args.compression
+                    )
+                for img_path, fingerprint in fingerprints.items():
+                    fingerprint["span"] = span
+                    manifest["splits"][split][os.path.relpath(img_path, args.data_dir)] = fingerprint
+            manifest["last_span"] = span
+        else:
+            print("No new images found, no span written")
+        save_manifest(manifest, manifest_file)
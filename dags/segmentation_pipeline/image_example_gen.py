@@ -0,0 +1,70 @@
+import os
+os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
+
+from typing import Any, Dict, Text
+
+import apache_beam as beam
+import tensorflow as tf
+from tfx.components.example_gen.base_example_gen_executor import BaseExampleGenExecutor
+
+from segmentation_pipeline import constants
+from segmentation_pipeline import convert_data_to_tfrecord as converter
+from pipeline_common.example_counts import ExampleCountsMixin
+
+
+def _mask_path(img_path: Text) -> Text:
+    """Returns the path of the mask of an image, e.g. images_prepped_train/x.png -> annotations_prepped_train/x.png"""
+    img_dir = os.path.dirname(img_path)
+    mask_dir = os.path.join(os.path.dirname(img_dir), os.path.basename(img_dir).replace("images_", "annotations_", 1))
+    return os.path.join(mask_dir, os.path.basename(img_path))
+
+
+def _image_and_mask_to_example(img_path: Text) -> tf.train.Example:
+    """Converts an image and its mask to a tf.Example."""
+    if constants.RECORD_FORMAT == "raw":
+        height, width = constants.HEIGHT, constants.WIDTH
+    else:
+        height, width = constants.RECORD_HEIGHT, constants.RECORD_WIDTH
+    tf_example, _, _ = converter.convert_image_and_mask(
+        img_path, _mask_path(img_path), height, width, constants.RECORD_FORMAT, constants.MASK_FORMAT)
+    return tf_example
+
+
+@beam.ptransform_fn
+@beam.typehints.with_input_types(beam.Pipeline)
+@beam.typehints.with_output_types(tf.train.Example)
+def _ImageToExample(
+    pipeline: beam.Pipeline,
+    exec_properties: Dict[Text, Any],
+    split_pattern: Text) -> beam.pvalue.PCollection:
+    """Reads the images matching split_pattern together with their masks and transforms them to tf.Examples.
+
+    Args:
+        pipeline: beam pipeline.
+        exec_properties: A dict of execution properties, input_base is the data directory.
+        split_pattern: Split.pattern in Input config, glob pattern of the images relative to input_base,
+                       e.g. "images_prepped_train/*".
+
+    Returns:
+        PCollection of tf.Example.
+    """
+    image_pattern = os.path.join(exec_properties["input_base"], split_pattern)
+    image_files = tf.io.gfile.glob(image_pattern)
+    if not image_files:
+        raise RuntimeError("Split pattern {} does not match any files.".format(image_pattern))
+
+    return (
+        pipeline
+        | "CreateFileList" >> beam.Create(sorted(image_files))
+        # Redistribute the file list, so that all workers of the direct runner decode images
+        | "Reshuffle" >> beam.Reshuffle()
+        | "ImageToExample" >> beam.Map(_image_and_mask_to_example)
+        )
+
+
+class ImageExampleGenExecutor(ExampleCountsMixin, BaseExampleGenExecutor):
+    """ExampleGen executor which converts image and mask directories to tf.Examples inside the Beam pipeline and counts the examples of every split."""
+
+    def GetInputSourceToExamplePTransform(self) -> beam.PTransform:
+        """Returns PTransform for converting images and masks to tf.Examples."""
+        return _ImageToExample
@@ -1,8 +1,7 @@
 import os
 os.environ["TF_CPP_MIN_LOG_LEVEL"] = "2"
 
-from typing import Union, List, Text
-import random
+from typing import Dict, Union, List, Text
 
 import numpy as np
 import albumentations as A
@@ -12,6 +11,7 @@ import tensorflow as tf
 import tensorflow_transform as tft
 import tensorflow_advanced_segmentation_models as tasm
 from segmentation_pipeline import constants
+from pipeline_common import trainer_utils
 
 
 def _transformed_name(key: Text) -> Text:
@@ -27,7 +27,7 @@ def _gzip_reader_fn(filenames):
 def _get_serve_image_fn(model):
   """Returns a function that feeds the input tensor into the model."""
 
-  @tf.function
+  @tf.function(experimental_compile=constants.XLA_COMPILE)
   def serve_image_fn(image_tensor):
     """Returns the output to be used in the serving signature.
     
@@ -43,6 +43,115 @@ def _get_serve_image_fn(model):
   return serve_image_fn
 
 
+def _get_serve_image_bytes_fn(model, tf_transform_output):
+  """Returns a function that applies the transform graph to encoded images and feeds them into the model."""
+
+  # Tracked by the model, so that the transform graph is exported with it
+  model.tft_layer = tf_transform_output.transform_features_layer()
+  # The decode can not be compiled with XLA, only the model call is
+  predict = tf.function(model, experimental_compile=constants.XLA_COMPILE)
+
+  @tf.function
+  def serve_image_bytes_fn(image_bytes):
+    """Returns the output to be used in the image bytes serving signature.
+
+    Args:
+        image_bytes: A string tensor of shape [batch_size] of encoded PNG images
+                     (or of raw uint8 pixels if constants.RECORD_FORMAT is "raw").
+
+    Returns:
+        The model's predicton on the transformed images
+    """
+    raw_features = {constants.IMAGE_KEY: tf.reshape(image_bytes, [-1, 1])}
+    # Only the image is fed, the parts of the transform graph which depend on other features are pruned
+    transformed_features = model.tft_layer(raw_features)
+    model_inputs = _prepare_model_inputs({
+        _transformed_name(constants.IMAGE_KEY): transformed_features[_transformed_name(constants.IMAGE_KEY)]
+    })
+    return predict(model_inputs[_transformed_name(constants.IMAGE_KEY)])
+
+  return serve_image_bytes_fn
+
+
+def _decode_images(encoded_images: tf.Tensor, channels: int, height: int, width: int, method: Text = "bilinear") -> tf.Tensor:
+    """Decodes a batch of encoded PNG images in parallel into a tensor of fixed shape.
+
+    The converter writes all images with the same shape, so every decode has a static output
+    shape and the following resize and mask operations run vectorized over the whole batch.
+    Images of another shape, e.g. sent to the serving signature, are resized to (height, width) first.
+
+    Args:
+        encoded_images: String tensor of shape [batch_size, 1]
+        channels: Number of channels of the decoded images
+        height: Height of the encoded images
+        width: Width of the encoded images
+        method: tf.image.resize method of images of another shape, "nearest" keeps the class values of masks intact
+
+    Returns:
+        uint8 tensor of shape [batch_size, height, width, channels]
+    """
+    image_shape = [height, width, channels]
+
+    def decode(encoded_image):
+        image = tf.io.decode_png(encoded_image[0], channels=channels)
+        image = tf.cond(
+            tf.reduce_all(tf.equal(tf.shape(image)[:2], [height, width])),
+            lambda: image,
+            lambda: tf.cast(tf.image.resize(image, [height, width], method=method), tf.uint8)
+            )
+        return tf.ensure_shape(image, image_shape)
+
+    return tf.map_fn(
+        decode,
+        encoded_images,
+        fn_output_signature=tf.TensorSpec(image_shape, tf.uint8),
+        parallel_iterations=constants.DECODE_PARALLEL_ITERATIONS
+        )
+
+
+def _normalize_images(image_features: tf.Tensor) -> tf.Tensor:
+    """Normalizes a batch of float32 images with pixel values in [0, 255] for the model."""
+    return tf.image.per_image_standardization(image_features)
+
+
+def _encode_transformed_images(image_features: tf.Tensor) -> tf.Tensor:
+    """Stores a batch of float32 images with pixel values in [0, 255] with the precision of constants.TRANSFORMED_IMAGE_DTYPE.
+
+    tf.Transform only outputs int64, float32 and string features, therefore uint8 pixels are stored
+    as int64 and float16 pixels as the int64 of their bit pattern, both as varints of 1 to 3 bytes.
+
+    Args:
+        image_features: float32 tensor of shape [batch_size, HEIGHT, WIDTH, 3]
+
+    Returns:
+        int64 tensor of the same shape
+    """
+    if constants.TRANSFORMED_IMAGE_DTYPE == "uint8":
+        image_features = tf.cast(tf.round(tf.clip_by_value(image_features, 0.0, 255.0)), tf.uint8)
+    else:
+        image_features = tf.bitcast(tf.cast(image_features, tf.float16), tf.uint16)
+    return tf.cast(image_features, tf.int64)
+
+
+def _decode_transformed_images(image_features: tf.Tensor) -> tf.Tensor:
+    """Restores the float32 images stored by _encode_transformed_images and normalizes them.
+
+    Args:
+        image_features: Tensor of transformed images as read from the transformed examples
+
+    Returns:
+        Normalized float32 tensor of shape [batch_size, HEIGHT, WIDTH, 3]
+    """
+    if constants.TRANSFORMED_IMAGE_DTYPE == "float32":
+        # Already normalized by preprocessing_fn
+        return image_features
+    if constants.TRANSFORMED_IMAGE_DTYPE == "uint8":
+        image_features = tf.cast(image_features, tf.float32)
+    else:
+        image_features = tf.cast(tf.bitcast(tf.cast(image_features, tf.uint16), tf.float16), tf.float32)
+    return _normalize_images(image_features)
+
+
 def preprocessing_fn(inputs: tf.Tensor) -> tf.Tensor:
     """tf.transform's callback function for preprocessing inputs.
 
@@ -55,87 +164,182 @@ def preprocessing_fn(inputs: tf.Tensor) -> tf.Tensor:
     outputs = {}
 
     # Image Preprocessing
-    image_features = tf.map_fn(
-        lambda x: tf.io.decode_png(x[0], channels=3),
-        inputs[constants.IMAGE_KEY],
-        dtype=tf.uint8
-        )
-
-    # image_features = tf.cast(image_features, tf.float32)
-    image_features = tf.image.resize(image_features, [constants.HEIGHT, constants.WIDTH])
-    image_features = tf.image.per_image_standardization(image_features)
-
-    # Mask Preprocessing
-    # Mask features need to be heavily transformed, such that each output class has its own mask channel
-    mask_features = tf.map_fn(
-        lambda x: tf.io.decode_png(x[0], channels=3),
-        inputs[constants.MASK_KEY],
-        dtype=tf.uint8
-        )
-
-    mask_features = tf.image.resize(mask_features, [constants.HEIGHT, constants.WIDTH])
-    mask_features = tf.math.reduce_max(mask_features, axis=-1)
-    mask_features = tf.cast(mask_features, dtype=tf.int32)
-    mask_features = tf.one_hot(indices=mask_features, depth=constants.N_TOTAL_CLASSES)
-    class_values = [constants.TOTAL_CLASSES.index(cls.lower()) for cls in constants.MODEL_CLASSES]
-    if not constants.ALL_CLASSES:
-        fg_list = []
-        bg_list = []
-        for mask_num in range(constants.N_TOTAL_CLASSES):
-            if mask_num in class_values:
-                # Add mask of a class to new_mask
-                fg_list.append(mask_features[:, :, :, mask_num])
-            else:
-                # add all class masks belonging to the background to the background class of the new_mask
-                bg_list.append(mask_features[:, :, :, mask_num])
-
-        bg = tf.math.reduce_sum(tf.stack(bg_list, axis=-1), axis=-1, keepdims=False)
-        fg_list.append(bg)
-        mask_features = tf.stack(fg_list, axis=-1)
+    if constants.RECORD_FORMAT == "raw":
+        # Images are already decoded and resized by convert_data_to_tfrecord.py
+        image_features = tf.io.decode_raw(inputs[constants.IMAGE_KEY], tf.uint8)
+        image_features = tf.reshape(image_features, [-1, constants.HEIGHT, constants.WIDTH, 3])
+        image_features = tf.cast(image_features, tf.float32)
+    else:
+        image_features = _decode_images(
+            inputs[constants.IMAGE_KEY], 3, constants.RECORD_HEIGHT, constants.RECORD_WIDTH)
+
+        # image_features = tf.cast(image_features, tf.float32)
+        image_features = tf.image.resize(image_features, [constants.HEIGHT, constants.WIDTH])
+    if constants.TRANSFORMED_IMAGE_DTYPE == "float32":
+        image_features = _normalize_images(image_features)
+    else:
+        # Stored with reduced precision, the Trainer normalizes the images in _input_fn
+        image_features = _encode_transformed_images(image_features)
+
+    # Mask Preprocessing, masks are emitted as single channel MODEL_CLASSES indices
+    # and only expanded to one channel per class by _input_fn
+    if constants.MASK_FORMAT == "class_index":
+        # Masks are already resized single channel class indices with the MODEL_CLASSES remapping applied
+        if constants.RECORD_FORMAT == "raw":
+            mask_features = tf.io.decode_raw(inputs[constants.MASK_KEY], tf.uint8)
+        else:
+            mask_features = _decode_images(inputs[constants.MASK_KEY], 1, constants.HEIGHT, constants.WIDTH, method="nearest")
+        mask_features = tf.reshape(mask_features, [-1, constants.HEIGHT, constants.WIDTH])
+    else:
+        if constants.RECORD_FORMAT == "raw":
+            mask_features = tf.io.decode_raw(inputs[constants.MASK_KEY], tf.uint8)
+            mask_features = tf.reshape(mask_features, [-1, constants.HEIGHT, constants.WIDTH, 3])
+        else:
+            mask_features = _decode_images(
+                inputs[constants.MASK_KEY], 3, constants.RECORD_HEIGHT, constants.RECORD_WIDTH, method="nearest")
+
+            # Nearest neighbour interpolation keeps the class values of the mask intact
+            mask_features = tf.image.resize(mask_features, [constants.HEIGHT, constants.WIDTH], method="nearest")
+        mask_features = tf.math.reduce_max(mask_features, axis=-1)
+        mask_features = tf.clip_by_value(tf.cast(mask_features, dtype=tf.int32), 0, constants.N_TOTAL_CLASSES - 1)
+        # Maps every class of TOTAL_CLASSES to its model class, all other classes to the background class
+        mask_features = tf.gather(tf.constant(constants.CLASS_INDEX_LOOKUP, dtype=tf.int32), mask_features)
+    # tf.Transform can not output uint8, the int64 class indices are stored as one byte varints
+    mask_features = tf.cast(mask_features, dtype=tf.int64)
 
     outputs[_transformed_name(constants.IMAGE_KEY)] = image_features
     outputs[_transformed_name(constants.MASK_KEY)] = mask_features
     return outputs
 
 
-def _image_and_mask_augmentation(image_features, mask_features):
-    """Perform image augmentation on batches of images .
-    
+def _random_rotate_and_scale(features, angle_seed, scale_seed):
+    """Rotates and scales every example of a batch by a random angle and factor around its center.
+
+    Args:
+        features: a batch of concatenated image and mask features
+        angle_seed: int64 Tensor of shape [2] of the rotation angles
+        scale_seed: int64 Tensor of shape [2] of the scale factors
+
+    Returns:
+        The transformed features, sampled with nearest neighbour interpolation so the masks stay one-hot
+    """
+    batch_size = tf.shape(features)[0]
+    min_scale, max_scale = constants.AUGMENTATION_SCALE_RANGE or (1.0, 1.0)
+    angles = tf.random.stateless_uniform(
+        [batch_size], seed=angle_seed, minval=-constants.AUGMENTATION_MAX_ROTATION, maxval=constants.AUGMENTATION_MAX_ROTATION)
+    scales = tf.random.stateless_uniform(
+        [batch_size], seed=scale_seed, minval=min_scale, maxval=max_scale)
+
+    cos = tf.cos(angles) / scales
+    sin = tf.sin(angles) / scales
+    center_x = (constants.WIDTH - 1) / 2
+    center_y = (constants.HEIGHT - 1) / 2
+    zeros = tf.zeros_like(angles)
+    # Maps every output pixel to the input pixel it is sampled from
+    transforms = tf.stack([
+        cos, -sin, center_x - cos * center_x + sin * center_y,
+        sin, cos, center_y - sin * center_x - cos * center_y,
+        zeros, zeros
+    ], axis=1)
+    return tf.raw_ops.ImageProjectiveTransformV2(
+        images=features,
+        transforms=transforms,
+        output_shape=[constants.HEIGHT, constants.WIDTH],
+        interpolation="NEAREST",
+        fill_mode="REFLECT")
+
+
+def _image_and_mask_augmentation(image_features, mask_features, seed):
+    """Perform image augmentation on batches of images and masks in one pass.
+
+    Image and mask channels are concatenated, so every flip, transform and crop moves both alike.
+    The random values only depend on seed, which the input pipeline draws for every batch.
+
     Args:
         image_features: a batch of image features
-        mask_features: a batch of mask features
-    
+        mask_features: a batch of one-hot mask features
+        seed: int64 Tensor of shape [2]
+
     Returns:
         The augmented image and mask features
     """
     batch_size = tf.shape(image_features)[0]
-    seed = random.random()
-    image_features = tf.image.random_flip_left_right(image_features, seed=seed)
-    mask_features = tf.image.random_flip_left_right(mask_features, seed=seed)
-    image_features = tf.image.resize_with_crop_or_pad(image_features, constants.HEIGHT + 30, constants.WIDTH + 30)
-    mask_features = tf.image.resize_with_crop_or_pad(mask_features, constants.HEIGHT + 30, constants.WIDTH + 30)
-    image_features = tf.image.random_crop(image_features, (batch_size, constants.HEIGHT, constants.WIDTH, 3), seed=seed)
-    mask_features = tf.image.random_crop(mask_features, (batch_size, constants.HEIGHT, constants.WIDTH, len(constants.MODEL_CLASSES) + 1), seed=seed)
-    return image_features, mask_features
+    n_channels = 3 + constants.N_MODEL_CLASSES
+    features = tf.concat([image_features, tf.cast(mask_features, image_features.dtype)], axis=-1)
+    # Every random draw gets its own seed, draws with the same seed would be correlated
+    flip_seed, angle_seed, scale_seed, crop_seed = [seed + tf.constant([0, offset], tf.int64) for offset in range(4)]
+
+    # Every example is flipped on its own
+    flip = tf.random.stateless_uniform([batch_size], seed=flip_seed) < 0.5
+    features = tf.where(flip[:, tf.newaxis, tf.newaxis, tf.newaxis], tf.reverse(features, axis=[2]), features)
+
+    if constants.AUGMENTATION_MAX_ROTATION or constants.AUGMENTATION_SCALE_RANGE:
+        features = _random_rotate_and_scale(features, angle_seed, scale_seed)
+
+    # The whole batch is cropped at one offset
+    padding = constants.AUGMENTATION_CROP_PADDING
+    features = tf.image.resize_with_crop_or_pad(features, constants.HEIGHT + padding, constants.WIDTH + padding)
+    offset = tf.random.stateless_uniform(
+        [2], seed=crop_seed, maxval=padding + 1, dtype=tf.int32)
+    features = features[:, offset[0]:offset[0] + constants.HEIGHT, offset[1]:offset[1] + constants.WIDTH, :]
+    features = tf.ensure_shape(features, [None, constants.HEIGHT, constants.WIDTH, n_channels])
+
+    return features[..., :3], tf.cast(features[..., 3:], mask_features.dtype)
 
 
-def _data_augmentation(feature_dict, mask_features):
+def _data_augmentation(feature_dict, mask_features, seed):
     """Perform data augmentation on batches of data.
     
     Args:
         feature_dict: a dict containing features of samples
+        mask_features: a batch of one-hot mask features
+        seed: int64 Tensor of shape [2] of the stateless random ops
     
     Returns:
-        The feature dict with augmented features
+        The feature dict with augmented features and the augmented mask features
     """
-    # print(feature_dict)
-    # print(mask_dict)
     image_features = feature_dict[_transformed_name(constants.IMAGE_KEY)]
-    image_features, mask_features = _image_and_mask_augmentation(image_features, mask_features)
+    image_features, mask_features = _image_and_mask_augmentation(image_features, mask_features, seed)
     feature_dict[_transformed_name(constants.IMAGE_KEY)] = image_features
     return feature_dict, mask_features
 
 
+def _one_hot_mask(mask_features):
+    """Expands a batch of class index masks of shape [batch_size, HEIGHT, WIDTH] to one channel per model class."""
+    return tf.one_hot(tf.cast(mask_features, tf.int32), depth=constants.N_MODEL_CLASSES)
+
+
+def _input_pipeline_profile() -> Union[Dict, None]:
+    """Returns the tf.data settings of constants.INPUT_PIPELINE_PROFILE, None for the defaults."""
+    return constants.INPUT_PIPELINE_PROFILES[constants.INPUT_PIPELINE_PROFILE]
+
+
+def _num_parallel_calls() -> Union[int, None]:
+    """Returns the num_parallel_calls of the dataset maps of _input_fn."""
+    profile = _input_pipeline_profile()
+    return profile["num_parallel_calls"] if profile else None
+
+
+def _cache_key(file_pattern: List[Text], tf_transform_output: tft.TFTransformOutput, **settings) -> Text:
+    """Returns the trainer_utils.cache_key of the input, which also depends on constants.MATERIALIZE_TRANSFORMED."""
+    return trainer_utils.cache_key(
+        file_pattern, tf_transform_output, materialize_transformed=constants.MATERIALIZE_TRANSFORMED, **settings)
+
+
+def _prepare_model_inputs(feature_dict):
+    """Restores the float32 normalized images of a batch of transformed features.
+
+    Args:
+        feature_dict: a dict containing features of samples
+
+    Returns:
+        The feature dict with the model inputs
+    """
+    feature_dict[_transformed_name(constants.IMAGE_KEY)] = _decode_transformed_images(
+        feature_dict[_transformed_name(constants.IMAGE_KEY)])
+    return feature_dict
+
+
 def _input_fn(file_pattern: List[Text], 
               tf_transform_output: tft.TFTransformOutput, 
               batch_size=4,
@@ -144,7 +348,7 @@ def _input_fn(file_pattern: List[Text],
     """Generates features and label for tuning/training.
     
     Args:
-        file_pattern: input tfrecord file pattern.
+        file_pattern: input tfrecord file pattern, of the raw examples if not constants.MATERIALIZE_TRANSFORMED.
         tf_transform_output: A TFTransformOutput.
         batch_size: representing the number of consecutive elements of returned
                     dataset to combine in a single batch
@@ -154,23 +358,53 @@ def _input_fn(file_pattern: List[Text],
         A dataset that contains (features, indices) tuple where features is a
         dictionary of Tensors, and indices is a single Tensor of label indices.
     """
-    transformed_feature_spec = (
-        tf_transform_output.transformed_feature_spec().copy()
+    if constants.MATERIALIZE_TRANSFORMED:
+        feature_spec = tf_transform_output.transformed_feature_spec().copy()
+        tft_layer = None
+    else:
+        # Transform only wrote the transform graph, the raw examples are transformed on the fly
+        feature_spec = tf_transform_output.raw_feature_spec().copy()
+        tft_layer = tf_transform_output.transform_features_layer()
+
+    cache_path = None
+    if constants.DATASET_CACHE_DIR:
+        # The workers of a multi-worker Trainer read different shards of the same files
+        key = _cache_key(file_pattern, tf_transform_output, batch_size=batch_size, is_train=is_train, task=_tf_config().get("task"))
+        cache_path = trainer_utils.dataset_cache_path(constants.DATASET_CACHE_DIR, key, constants.DATASET_CACHE_MAX_BYTES)
+
+    dataset = trainer_utils.read_examples(
+        file_pattern,
+        feature_spec,
+        batch_size,
+        is_train,
+        _input_pipeline_profile(),
+        num_epochs=1 if cache_path else constants.EPOCHS,
+        prefetch_buffer_size=2
         )
 
-    dataset = tf.data.experimental.make_batched_features_dataset(
-        file_pattern=file_pattern,
-        batch_size=batch_size,
-        features=transformed_feature_spec,
-        reader=_gzip_reader_fn,
-        label_key=_transformed_name(constants.MASK_KEY),
-        prefetch_buffer_size=2,
-        num_epochs=constants.EPOCHS
-        )
+    def to_model_inputs(features):
+        if tft_layer is not None:
+            features = dict(tft_layer(features))
+        mask_features = features.pop(_transformed_name(constants.MASK_KEY))
+        return _prepare_model_inputs(features), _one_hot_mask(mask_features)
+
+    dataset = dataset.map(to_model_inputs, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+    if cache_path:
+        # The cache is written before training, the augmentation after it still differs in every epoch
+        dataset = trainer_utils.fill_dataset_cache(dataset, cache_path, _tf_config())
+        if is_train:
+            dataset = dataset.shuffle(constants.DATASET_CACHE_SHUFFLE_BATCHES)
+        dataset = dataset.repeat(constants.EPOCHS)
 
     if is_train:
-        dataset = dataset.map(lambda x, y: (_data_augmentation(x, y)))
+        # One stateless seed per batch, the augmentation changes with every epoch and is reproducible across runs
+        seeds = tf.data.experimental.RandomDataset(seed=constants.AUGMENTATION_SEED).batch(2)
+        dataset = tf.data.Dataset.zip((dataset, seeds)).map(
+            lambda inputs, seed: _data_augmentation(inputs[0], inputs[1], seed), num_parallel_calls=_num_parallel_calls())
 
+    if _input_pipeline_profile():
+        dataset = dataset.prefetch(_input_pipeline_profile()["prefetch_buffer_size"])
     return dataset
 
 
@@ -178,6 +412,13 @@ def _input_fn(file_pattern: List[Text],
 # Model code
 #########################################################################################################
 
+def _tf_config() -> Dict:
+    """Returns the parsed TF_CONFIG of a multi-worker Trainer, empty for a single process."""
+    if not constants.MULTI_WORKER_TRAINING:
+        return {}
+    return trainer_utils.parse_tf_config()
+
+
 def get_model(fn_args):
     """
     This function defines a Keras model and returns the model as a Keras object.
@@ -191,14 +432,20 @@ def get_model(fn_args):
         pooling=None
     )
 
+    mixed_precision = constants.MIXED_PRECISION_POLICY not in (None, "float32")
     model = tasm.DANet(
         n_classes=constants.N_MODEL_CLASSES,
         base_model=base_model,
         output_layers=layers,
         backbone_trainable=constants.BACKBONE_TRAINABLE,
         height=constants.HEIGHT,
-        width=constants.WIDTH
+        width=constants.WIDTH,
+        final_activation=None if mixed_precision else "softmax"
     ).model()
+    if mixed_precision:
+        # The softmax runs in float32, bfloat16 probabilities are too coarse for the focal and dice loss
+        outputs = tf.keras.layers.Activation("softmax", dtype="float32")(model.output)
+        model = tf.keras.Model(model.inputs, outputs)
 
     opt = tf.keras.optimizers.SGD(learning_rate=0.2, momentum=0.9)
     metrics = [tasm.metrics.IOUScore(threshold=0.5)]
@@ -209,6 +456,8 @@ def get_model(fn_args):
         loss=categorical_focal_dice_loss,
         metrics=metrics,
     )
+    if constants.XLA_COMPILE:
+        trainer_utils.compile_train_step(model)
     # model.run_eagerly = True
 
     return model
@@ -221,44 +470,83 @@ def run_fn(fn_args):
     Args:
         fn_args: Holds args used to train the model as name/value pairs.
     """
+    # MultiWorkerMirroredStrategy has to be created before any other op
+    strategy = trainer_utils.get_distribution_strategy(_tf_config(), constants.MULTI_WORKER_COMMUNICATION)
+    trainer_utils.set_mixed_precision_policy(constants.MIXED_PRECISION_POLICY)
+    # Every worker reads batches of the configured size, the model steps on the global batch
+    train_batch_size = constants.TRAIN_BATCH_SIZE * strategy.num_replicas_in_sync
+    eval_batch_size = constants.EVAL_BATCH_SIZE * strategy.num_replicas_in_sync
+
     tf_transform_output = tft.TFTransformOutput(fn_args.transform_output)
 
+    # The datasets are auto-sharded across the workers, by file if there are enough files, otherwise by example
     TrainSetwoAug = _input_fn(
         fn_args.train_files,
         tf_transform_output,
-        constants.TRAIN_BATCH_SIZE,
+        train_batch_size,
         is_train=True
     )
 
     ValidationSet = _input_fn(
         fn_args.eval_files,
         tf_transform_output,
-        constants.EVAL_BATCH_SIZE,
+        eval_batch_size,
         is_train=False
     )
 
-    model = get_model(fn_args)
+    with strategy.scope():
+        model = get_model(fn_args)
+        trainer_utils.warm_start(model, fn_args, constants.WARM_START)
 
     try:
         log_dir = fn_args.model_run_dir
     except KeyError:
         # TODO(b/158106209): use ModelRun instead of Model artifact for logging.
         log_dir = os.path.join(os.path.dirname(fn_args.serving_model_dir), 'logs')
+    log_dir = trainer_utils.worker_path(log_dir, _tf_config())
 
     callbacks = [
                  tf.keras.callbacks.ReduceLROnPlateau(monitor="iou_score", factor=0.2, patience=6, verbose=1, mode="max"),
                  tf.keras.callbacks.EarlyStopping(monitor="iou_score", patience=16, mode="max", verbose=1, restore_best_weights=True),
-                 tf.keras.callbacks.TensorBoard(log_dir=log_dir, update_freq="batch")
+                 tf.keras.callbacks.TensorBoard(
+                     log_dir=log_dir,
+                     update_freq="batch",
+                     # The profile tab of TensorBoard then contains the input pipeline analysis,
+                     # only one profiler can run at a time, PROFILE_STEPS traces in the PerformanceCallback
+                     profile_batch=0 if constants.PROFILE_STEPS else (
+                         constants.INPUT_PIPELINE_PROFILE_BATCHES if constants.INPUT_PIPELINE_STATS else 2)
+                     )
     ]
+    if constants.BACKUP_AND_RESTORE:
+        # Restores the model and the epoch of an interrupted attempt and removes the backup after training
+        key = _cache_key(
+            list(fn_args.train_files) + list(fn_args.eval_files),
+            tf_transform_output,
+            backbone=constants.BACKBONE_NAME,
+            warm_start=constants.WARM_START)
+        callbacks.append(tf.keras.callbacks.experimental.BackupAndRestore(trainer_utils.backup_dir(fn_args, key, constants.BACKUP_DIR)))
+    if constants.PERFORMANCE_SUMMARY:
+        callbacks.append(trainer_utils.PerformanceCallback(
+            TrainSetwoAug,
+            train_batch_size,
+            log_dir,
+            summary_file=os.path.join(os.path.dirname(fn_args.serving_model_dir), "performance.json") if trainer_utils.is_chief(_tf_config()) else None,
+            probe_steps=constants.PERFORMANCE_PROBE_STEPS,
+            profile_steps=constants.PROFILE_STEPS
+        ))
 
     print("Start Training")
 
+    train_steps = trainer_utils.num_steps(trainer_utils.num_examples(fn_args.train_files), train_batch_size, constants.TRAIN_STEPS)
+    eval_steps = trainer_utils.num_steps(trainer_utils.num_examples(fn_args.eval_files), eval_batch_size, constants.EVAL_STEPS)
+    print("Training for {} steps per epoch with {} validation steps".format(train_steps, eval_steps))
+
     model.fit(
         TrainSetwoAug,
         epochs=constants.EPOCHS,
-        steps_per_epoch=constants.TRAIN_STEPS,
+        steps_per_epoch=train_steps,
         validation_data=ValidationSet,
-        validation_steps=constants.EVAL_STEPS,
+        validation_steps=eval_steps,
         callbacks=callbacks,
     )
 
@@ -272,9 +560,22 @@ def run_fn(fn_args):
                     dtype=tf.float32,
                     name=_transformed_name(constants.IMAGE_KEY)
                 )
+            ),
+        # Accepts the encoded images and applies decode, resize and normalization in-graph
+        'serving_image_bytes':
+            _get_serve_image_bytes_fn(model, tf_transform_output).get_concrete_function(
+                tf.TensorSpec(
+                    shape=[None],
+                    dtype=tf.string,
+                    name=constants.IMAGE_KEY
+                )
             )
     }
 
-    model.save(fn_args.serving_model_dir, save_format='tf', signatures=signatures)
+    # Every worker has to save the model, only the model of the chief is kept
+    model_dir = trainer_utils.worker_path(fn_args.serving_model_dir, _tf_config())
+    model.save(model_dir, save_format='tf', signatures=signatures)
+    if not trainer_utils.is_chief(_tf_config()):
+        tf.io.gfile.rmtree(model_dir)
 
     print("Model Saved")
\ No newline at end of file